@@ -0,0 +1,14 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+'''
+benchmarks for the host side of the ioLabs library.
+run from the top level directory, e.g.
+
+    python -m bench.latency --emulator --save baseline.json
+    python -m bench.latency --baseline baseline.json
+
+on platforms without HID support (e.g. Linux) the emulator has to be
+selected for the hid module to load:
+
+    IOLABS_HID_MODULE=hid.emulator python -m bench.codec
+'''
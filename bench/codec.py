@@ -0,0 +1,145 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+'''
+micro-benchmarks of the pure python hot paths (no device I/O):
+
+* REPORT.parse for common reports
+* the packing functions created by messages._create_packing_function
+* sending a command via Commands attribute lookup
+* dict_struct construction
+* looking up the line objects of a port
+* hid.cparser.parse and tokenizer
+
+for each one the number of calls per second and the objects allocated
+per call are recorded.  use --history to keep results per commit, e.g.
+
+    python -m bench.codec --history bench_history.jsonl
+'''
+
+import gc
+import sys
+
+from bench.common import clock, environment, option_parser, finish
+from ioLabs import REPORT, COMMAND, Commands, Port0_2, dict_struct
+from hid import HIDDevice
+
+class NullDevice(HIDDevice):
+    '''device that throws away everything sent to it'''
+    def __init__(self):
+        HIDDevice.__init__(self,0,0)
+
+    def is_open(self):
+        return True
+
+    def set_report(self,report_data,report_id=0):
+        pass
+
+    def set_interrupt_report_callback(self,callback,report_buffer_size=8):
+        self._callback=callback
+
+def ops_per_second(fn,min_time=0.2,repeat=3):
+    '''best rate of calling fn over a few runs of at least min_time seconds'''
+    calls=1
+    while True:
+        start=clock()
+        for i in range(calls):
+            fn()
+        elapsed=clock()-start
+        if elapsed >= min_time:
+            break
+        calls*=2
+    best=elapsed
+    for i in range(repeat-1):
+        start=clock()
+        for i in range(calls):
+            fn()
+        best=min(best,clock()-start)
+    return calls/best
+
+def allocations_per_call(fn,calls=1000):
+    '''
+    number of objects allocated per call that are tracked by the garbage
+    collector (containers, instances, functions - but not strings or ints).
+    the results of each call are kept alive while counting, objects that
+    are freed again before the call returns are not counted
+    '''
+    fn() # warm up any caches
+    gc.collect()
+    gc.disable()
+    try:
+        before=len(gc.get_objects())
+        results=[fn() for i in range(calls)]
+        after=len(gc.get_objects())
+    finally:
+        gc.enable()
+    # the results list itself is one new object
+    return (after-before-1)/float(calls)
+
+def benchmarks():
+    '''list of (name,function) to benchmark'''
+    commands=Commands(NullDevice())
+    port=Port0_2(commands,0)
+    keydn=REPORT.keydn(1,123456)
+    pxrep=REPORT.pxrep(0x0F,0xF0,123456)
+    hbrep=REPORT.hbrep(0,30000,123456)
+    vckrep=REPORT.vckrep(0x58,1,2,3,4,5,6)
+    unknown=b'\xff\0\0\0\0\0\0\0'
+    p2set=COMMAND.p2set
+    dirset=COMMAND.dirset
+    debset=COMMAND.debset
+    keydn_pack=REPORT.keydn
+    fn_declaration='IOReturn (*setReport)(void * self, IOHIDReportType reportType, UInt32 reportID, void * reportBuffer, UInt32 reportBufferSize, UInt32 timeoutMS, IOHIDReportCallbackFunction callback, void * callbackTarget, void * callbackRefcon)'
+    var_declaration='unsigned long long * value'
+    fns=[
+        ('parse.KEYDN',lambda: REPORT.parse(keydn)),
+        ('parse.PXREP',lambda: REPORT.parse(pxrep)),
+        ('parse.HBREP',lambda: REPORT.parse(hbrep)),
+        ('parse.VCKREP',lambda: REPORT.parse(vckrep)),
+        ('parse.unknown',lambda: REPORT.parse(unknown)),
+        ('pack.P2SET',lambda: p2set(0x55)),
+        ('pack.DIRSET',lambda: dirset(0,0xFF,0x00)),
+        ('pack.DEBSET',lambda: debset(20,5,20,5,20,5)),
+        ('pack.KEYDN',lambda: keydn_pack(1,123456)),
+        ('commands.lookup',lambda: commands.p2set),
+        ('commands.p2set',lambda: commands.p2set(0x55)),
+        ('port.line3',lambda: port.line3),
+        ('port.lines',lambda: port.lines),
+        ('dict_struct',lambda: dict_struct(name='PXREP',id=0x50,port2_bits=0x0F,port0_bits=0xF0,rtc=123456)),
+    ]
+    # the cparser is only used by hid.osx, so the rest can be run without it
+    try:
+        from hid.cparser import parse, tokenizer
+    except Exception as e:
+        sys.stderr.write('skipping the cparser benchmarks - %s: %s\n' % (type(e).__name__,e))
+        return fns
+    fns+=[
+        ('cparser.parse_function',lambda: parse(fn_declaration)),
+        ('cparser.parse_variable',lambda: parse(var_declaration)),
+        ('cparser.tokenizer',lambda: tokenizer(fn_declaration)),
+    ]
+    return fns
+
+def main(argv):
+    parser=option_parser('usage: %prog [options]')
+    parser.add_option('--min-time',type='float',default=0.2,
+                      help='minimum seconds to time each benchmark for [default: %default]')
+    parser.add_option('--filter',help='only run benchmarks whose name contains FILTER')
+    options,args=parser.parse_args(argv)
+
+    # make sure the logging calls in the hot paths cost what they
+    # do when logging is not configured for INFO
+    import logging
+    logging.getLogger().setLevel(logging.WARNING)
+
+    results=environment(options.label)
+    metrics={}
+    for name,fn in benchmarks():
+        if options.filter and options.filter not in name:
+            continue
+        metrics['%s.ops_per_s'%name]=ops_per_second(fn,options.min_time)
+        metrics['%s.allocs_per_call'%name]=allocations_per_call(fn)
+    results['metrics']=metrics
+    return finish(options,results)
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
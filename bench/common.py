@@ -0,0 +1,153 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+'''
+helpers shared by the benchmarks: timing, statistics and
+saving/comparing results as JSON.
+
+results are a flat dictionary of metric name to value.  metrics
+ending in '_per_s' are rates (bigger is better), all others are
+times or counts (smaller is better).  tail latencies (p99/max) are
+saved but too noisy to be compared against a baseline.
+'''
+
+import json
+import platform
+import sys
+import time
+
+# best timer available
+if hasattr(time,'perf_counter'):
+    clock=time.perf_counter
+elif sys.platform == 'win32':
+    clock=time.clock
+else:
+    clock=time.time
+
+def percentile(sorted_values,fraction):
+    '''value at the given fraction (0-1) through an already sorted list'''
+    if not sorted_values:
+        return None
+    index=int(round(fraction*(len(sorted_values)-1)))
+    return sorted_values[index]
+
+def summarize(name,samples,scale=1e6,unit='us'):
+    '''
+    turn a list of durations (in seconds) into percentile metrics
+    named '<name>.p50_us' etc.
+    '''
+    samples=sorted(samples)
+    metrics={}
+    if not samples:
+        return metrics
+    for label,fraction in [('p50',0.5),('p90',0.9),('p99',0.99),('max',1.0)]:
+        metrics['%s.%s_%s'%(name,label,unit)]=percentile(samples,fraction)*scale
+    metrics['%s.mean_%s'%(name,unit)]=sum(samples)*scale/len(samples)
+    return metrics
+
+def default_label():
+    '''short id of the current git commit (if there is one)'''
+    import subprocess
+    try:
+        process=subprocess.Popen(['git','rev-parse','--short','HEAD'],
+                                 stdout=subprocess.PIPE,stderr=subprocess.PIPE)
+        output=process.communicate()[0]
+    except OSError:
+        return None
+    if process.returncode != 0:
+        return None
+    return output.strip().decode('ascii')
+
+def environment(label=None):
+    '''description of where the results came from'''
+    if label is None:
+        label=default_label()
+    return {
+        'label':label,
+        'python':platform.python_version(),
+        'platform':platform.platform(),
+        'time':time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+
+def save_results(filename,results):
+    out=open(filename,'w')
+    try:
+        json.dump(results,out,indent=2,sort_keys=True)
+    finally:
+        out.close()
+
+def load_results(filename):
+    infile=open(filename)
+    try:
+        return json.load(infile)
+    finally:
+        infile.close()
+
+def append_history(filename,results):
+    '''add the results as a single line to a JSON lines history file'''
+    out=open(filename,'a')
+    try:
+        out.write(json.dumps(results,sort_keys=True))
+        out.write('\n')
+    finally:
+        out.close()
+
+def compare(metrics,baseline,tolerance=0.25):
+    '''
+    compare metrics against the baseline metrics, returning a list
+    of (name,baseline value,current value) for every metric that got
+    worse by more than the tolerance (a fraction)
+    '''
+    regressions=[]
+    for name in sorted(metrics.keys()):
+        if '.p99_' in name or '.max_' in name:
+            continue
+        current=metrics[name]
+        previous=baseline.get(name)
+        if current is None or not previous:
+            continue
+        if name.endswith('_per_s'):
+            worse=current < previous/(1.0+tolerance)
+        else:
+            worse=current > previous*(1.0+tolerance)
+        if worse:
+            regressions.append((name,previous,current))
+    return regressions
+
+def report(results,baseline=None,tolerance=0.25,out=sys.stdout):
+    '''
+    print the results as JSON, then any regressions against the baseline.
+    returns the number of regressions found
+    '''
+    json.dump(results,out,indent=2,sort_keys=True)
+    out.write('\n')
+    if baseline is None:
+        return 0
+    regressions=compare(results['metrics'],baseline['metrics'],tolerance)
+    for name,previous,current in regressions:
+        sys.stderr.write('REGRESSION %s: %.3f -> %.3f\n'%(name,previous,current))
+    return len(regressions)
+
+def option_parser(usage):
+    '''option parser with the options every benchmark understands'''
+    from optparse import OptionParser
+    parser=OptionParser(usage=usage)
+    parser.add_option('--label',help='label to store with the results [default: current git commit]')
+    parser.add_option('--save',metavar='FILE',help='save results as JSON to FILE (e.g. a new baseline)')
+    parser.add_option('--baseline',metavar='FILE',help='compare results against a saved baseline')
+    parser.add_option('--history',metavar='FILE',help='append results to a JSON lines history FILE')
+    parser.add_option('--tolerance',type='float',default=0.25,
+                      help='fraction a metric may get worse before it is a regression [default: %default]')
+    return parser
+
+def finish(options,results):
+    '''save/report results as requested by the options, returns an exit code'''
+    if options.save:
+        save_results(options.save,results)
+    if options.history:
+        append_history(options.history,results)
+    baseline=None
+    if options.baseline:
+        baseline=load_results(options.baseline)
+    if report(results,baseline,options.tolerance):
+        return 1
+    return 0
@@ -0,0 +1,294 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+'''
+end-to-end benchmark of the command/report path:
+
+* round trip latency of Commands.send_wait_reply for every command
+* sustained report ingest rate from the HIDDevice callback through to
+  the user's callbacks (via Commands.process_received_reports)
+* wall time and number of round trips of USBBox.reset_box, and of the
+  same settings made one property at a time (as reset_box used to)
+* time from a KEYDN arriving to its callback being called, with the
+  report queued (and polled for) or dispatched directly, and the time
+  spent on each stage on the device's thread (see DispatchTiming)
+
+runs against the first box found, or the emulator with --emulator
+'''
+
+import sys
+import threading
+import time
+
+from bench.common import clock, summarize, environment, option_parser, finish
+from ioLabs import USBBox, COMMAND, REPORT, DispatchTiming
+
+# commands that are answered by a report in form (command,report,arguments)
+# arguments leave the box in the state reset_box() puts it in, a function
+# taking the USBBox may be given instead to work them out
+ROUND_TRIP_COMMANDS=[
+    ('VERGET','VERREP',()),
+    ('NUMGET','NUMREP',()),
+    ('RESRTC','KEYREP',()),
+    ('RTCGET','RTCREP',()),
+    ('SEROUT','SERIN',(0,0,0,0,0,0,0)),
+    ('VCKSET','VCKREP',lambda usbbox: (0xA9,usbbox.int0.primary_gain,0,0,0)),
+    ('VCKGET','VCKREP',()),
+    ('MSKSET','MSKREP',(0x0C,0xFF)),
+    ('MSKGET','MSKREP',()),
+    ('KEYGET','KEYREP',()),
+    ('DEBSET','DEBREP',(20,5,20,5,20,5)),
+    ('DEBGET','DEBREP',()),
+    ('DIRSET','DIRREP',(0,0,0)),
+    ('DIRGET','DIRREP',()),
+    ('LOGSET','LOGREP',(0,0)),
+    ('LOGGET','LOGREP',()),
+    ('P0SET','PXREP',(0xFF,)),
+    ('P0AND','PXREP',(0xFF,)),
+    ('P0_OR','PXREP',(0x00,)),
+    ('P0XOR','PXREP',(0x00,)),
+    ('P2SET','PXREP',(0xFF,)),
+    ('P2AND','PXREP',(0xFF,)),
+    ('P2_OR','PXREP',(0x00,)),
+    ('P2XOR','PXREP',(0x00,)),
+    ('PXSET','PXREP',(0xFF,0xFF)),
+    ('PXAND','PXREP',(0xFF,0xFF)),
+    ('PX_OR','PXREP',(0x00,0x00)),
+    ('PXXOR','PXREP',(0x00,0x00)),
+    ('PXGET','PXREP',()),
+    ('PXPGET','PXPREP',()),
+]
+
+# commands the box does not reply to, only the time to send them is measured
+# (PACSET is left out as it changes the product authorisation code)
+SEND_ONLY_COMMANDS=[
+    ('HBSET',(30000,)),
+    ('QPURGE',()),
+]
+
+def bench_round_trips(usbbox,repeat):
+    metrics={}
+    commands=usbbox.commands
+    for command_name,report_name,args in ROUND_TRIP_COMMANDS:
+        command_id=getattr(COMMAND,command_name)
+        report_id=getattr(REPORT,report_name)
+        if callable(args):
+            args=args(usbbox)
+        samples=[]
+        timeouts=0
+        for i in range(repeat):
+            start=clock()
+            rep=commands.send_wait_reply(command_id,report_id,*args)
+            samples.append(clock()-start)
+            if rep is None:
+                timeouts+=1
+        metrics.update(summarize('send_wait_reply.%s'%command_name,samples))
+        metrics['send_wait_reply.%s.timeouts'%command_name]=timeouts
+
+    for command_name,args in SEND_ONLY_COMMANDS:
+        send=getattr(commands,command_name.lower())
+        samples=[]
+        for i in range(repeat):
+            start=clock()
+            send(*args)
+            samples.append(clock()-start)
+        metrics.update(summarize('send.%s'%command_name,samples))
+    return metrics
+
+def ingest_reports(count):
+    '''a mix of the reports seen during an experiment'''
+    templates=[
+        REPORT.keydn(0,0),
+        REPORT.keyup(0,0),
+        REPORT.pxrep(0xFF,0xFF,0),
+        REPORT.hbrep(0,30000,0),
+    ]
+    return [templates[i % len(templates)] for i in range(count)]
+
+def bench_ingest(usbbox,count):
+    '''
+    feed reports in at the HIDDevice callback and measure how fast they
+    get through to the user's callbacks
+    '''
+    commands=usbbox.commands
+    device=usbbox.device
+    commands.process_received_reports()
+
+    received=[0]
+    def callback(report):
+        received[0]+=1
+    for report_id in REPORT.ALL_IDS():
+        commands.add_callback(report_id,callback)
+
+    reports=ingest_reports(count)
+    report_callback=device._callback
+    try:
+        start=clock()
+        for report_data in reports:
+            report_callback(device,report_data)
+        ingested=clock()
+        commands.process_received_reports()
+        processed=clock()
+    finally:
+        for report_id in REPORT.ALL_IDS():
+            commands.remove_callback(report_id,callback)
+
+    return {
+        'ingest.callback_per_s':count/(ingested-start),
+        'ingest.process_per_s':received[0]/(processed-ingested),
+        'ingest.end_to_end_per_s':received[0]/(processed-start),
+        'ingest.lost':count-received[0],
+    }
+
+def bench_dispatch(usbbox,count,poll_interval=0.001):
+    '''
+    feed KEYDN reports in at the HIDDevice callback (from another thread,
+    as the device would) and time how long they take to reach the user's
+    callback, when polled for every poll_interval seconds and when
+    dispatched directly
+    '''
+    commands=usbbox.commands
+    device=usbbox.device
+    commands.process_received_reports()
+    report_data=REPORT.keydn(0,0)
+    report_callback=device._callback
+
+    sent=[0]
+    samples=[]
+    received=threading.Event()
+    def callback(report):
+        samples.append(clock()-sent[0])
+        received.set()
+
+    def feed():
+        for i in range(count):
+            received.clear()
+            sent[0]=clock()
+            report_callback(device,report_data)
+            received.wait(1)
+
+    metrics={}
+    commands.add_callback(REPORT.KEYDN,callback)
+    try:
+        # queued, with the experiment polling for reports
+        feeder=threading.Thread(target=feed)
+        feeder.start()
+        while feeder.is_alive():
+            time.sleep(poll_interval)
+            commands.process_received_reports()
+        metrics.update(summarize('dispatch.queued',samples,scale=1e6,unit='us'))
+
+        del samples[:]
+        timing=commands.timing=DispatchTiming()
+        commands.dispatch_directly(REPORT.KEYDN)
+        feed()
+        metrics.update(summarize('dispatch.direct',samples,scale=1e6,unit='us'))
+        for stage in DispatchTiming.STAGES:
+            if timing.count[stage]:
+                metrics['dispatch.stage.%s.mean_us'%stage]=timing.mean(stage)*1e6
+                metrics['dispatch.stage.%s.max_us'%stage]=timing.max[stage]*1e6
+    finally:
+        commands.timing=None
+        commands.dispatch_queued(REPORT.KEYDN)
+        commands.remove_callback(REPORT.KEYDN,callback)
+    return metrics
+
+def reset_box_sequential(usbbox):
+    '''the settings reset_box makes, using the properties one at a time'''
+    usbbox.disable_loopback()
+    usbbox.heartbeat=30000
+    usbbox.buttons.debounce_up=5
+    usbbox.buttons.debounce_down=20
+    usbbox.int0.debounce_up=5
+    usbbox.int0.debounce_down=20
+    usbbox.int1.debounce_up=5
+    usbbox.int1.debounce_down=20
+    usbbox.port0.logic=0
+    usbbox.port0.state=0xff
+    usbbox.port2.logic=0
+    usbbox.port2.state=0xff
+    usbbox.buttons.enabled=0xff
+    usbbox.int0.enabled=1
+    usbbox.int1.enabled=1
+    usbbox.reset_clock()
+    usbbox.purge_queue()
+
+class RoundTripCounter(object):
+    '''
+    counts the times the caller waits on the box: each send_wait_reply
+    and each transaction (however many commands it has)
+    '''
+    def __init__(self,commands):
+        self.commands=commands
+        self.count=0
+    
+    def install(self):
+        commands=self.commands
+        send_wait_reply=commands.send_wait_reply
+        transaction=commands.transaction
+        def counted_send_wait_reply(*args):
+            self.count+=1
+            return send_wait_reply(*args)
+        def counted_transaction():
+            self.count+=1
+            return transaction()
+        commands.send_wait_reply=counted_send_wait_reply
+        commands.transaction=counted_transaction
+    
+    def remove(self):
+        del self.commands.send_wait_reply
+        del self.commands.transaction
+
+def bench_reset_box(usbbox,repeat):
+    metrics={}
+    for name,reset in [('reset_box',usbbox.reset_box),
+                       ('reset_box_sequential',lambda: reset_box_sequential(usbbox))]:
+        samples=[]
+        for i in range(repeat):
+            counter=RoundTripCounter(usbbox.commands)
+            counter.install()
+            try:
+                start=clock()
+                reset()
+                samples.append(clock()-start)
+            finally:
+                counter.remove()
+        metrics.update(summarize(name,samples,scale=1e3,unit='ms'))
+        metrics['%s.round_trips'%name]=counter.count
+    return metrics
+
+def emulated_device(latency,jitter):
+    from hid.emulator import EmulatedHIDDevice, BoxFirmware
+    return EmulatedHIDDevice(BoxFirmware(latency=latency,jitter=jitter))
+
+def main(argv):
+    parser=option_parser('usage: %prog [options]')
+    parser.add_option('--emulator',action='store_true',help='benchmark against the emulated box')
+    parser.add_option('--latency',type='float',default=0.0005,help='emulator reply latency in seconds [default: %default]')
+    parser.add_option('--jitter',type='float',default=0.0,help='emulator reply jitter in seconds [default: %default]')
+    parser.add_option('--repeat',type='int',default=50,help='round trips per command [default: %default]')
+    parser.add_option('--reports',type='int',default=20000,help='reports for the ingest test [default: %default]')
+    parser.add_option('--keys',type='int',default=500,help='KEYDN reports for the dispatch test [default: %default]')
+    parser.add_option('--resets',type='int',default=5,help='number of reset_box calls [default: %default]')
+    options,args=parser.parse_args(argv)
+
+    device=None
+    if options.emulator:
+        device=emulated_device(options.latency,options.jitter)
+    usbbox=USBBox(device=device)
+
+    results=environment(options.label)
+    results['device']=str(usbbox.device)
+    results['emulator']=bool(options.emulator)
+    metrics={}
+    try:
+        metrics.update(bench_round_trips(usbbox,options.repeat))
+        metrics.update(bench_ingest(usbbox,options.reports))
+        metrics.update(bench_reset_box(usbbox,options.resets))
+        metrics.update(bench_dispatch(usbbox,options.keys))
+    finally:
+        usbbox.reset_box()
+    results['metrics']=metrics
+    return finish(options,results)
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -8,11 +8,26 @@ and interacting with those devices.
 import logging
 
 import os
+import time
 
 import logging
-from threading import Thread 
+from collections import deque
+from threading import Thread, Lock, Event, current_thread
+from ctypes import addressof, memmove, memset, sizeof, string_at, c_char, c_ubyte
 
-__all__ = ['find_hid_devices','HIDDevice']
+# checked before logging in the per-report paths, so that
+# the call (and any formatting) only happens when needed
+_log_enabled=logging.getLogger().isEnabledFor
+
+__all__ = ['find_hid_devices','devices_changed','DeviceCache','DevicePool','HIDDevice',
+           'SharedHIDDevice','ReportReader','host_ns']
+
+if hasattr(time,'monotonic_ns'):
+    host_ns=time.monotonic_ns
+else:
+    def host_ns():
+        '''host clock in nanoseconds (used to time stamp received reports)'''
+        return int(time.time()*1e9) # python 2 - not monotonic
 
 class HIDDevice(object):
     '''
@@ -22,18 +37,28 @@ class HIDDevice(object):
         self.vendor=vendor
         self.product=product
         self._callback=None
+        # host time (ns, see host_ns) the report being passed to the callback was read
+        self.report_timestamp_ns=None
         self._running=False
         self._thread=None
+        # the ReportReader reading from the device, instead of its own thread
+        self._reader=None
+        # buffer reused for outgoing reports (see _copy_to_output_buffer)
+        self._output_buffer=None
+        self._write_lock=Lock()
     
     def __del__(self):
         '''
-        closes the device
+        closes the device (if it was opened)
         '''
-        self.close()
+        if self.is_open():
+            self.close()
         
     def close(self):
         '''close the device and stop the callback thread'''
         self._running=False
+        if self._reader is not None:
+            self._reader.remove(self)
         if self._thread:
             self._thread.join(1)
         self._thread=None
@@ -41,6 +66,22 @@ class HIDDevice(object):
     def is_open(self):
         raise RuntimeError("not implemented")
     
+    def copy(self):
+        '''a new (unopened) HIDDevice for the same device'''
+        raise RuntimeError("not implemented")
+    
+    def physical_id(self):
+        '''
+        value identifying the physical device, the same for all the
+        copies of a HIDDevice (see DevicePool)
+        '''
+        raise RuntimeError("not implemented")
+    
+    def matches(self,vendor=None,product=None):
+        '''whether the device has the vendor and product ids (if given)'''
+        return ((vendor is None or self.vendor == vendor) and
+                (product is None or self.product == product))
+    
     def open(self):
         '''
         open this HID device for use (must be called before setting callbacks
@@ -55,7 +96,29 @@ class HIDDevice(object):
         if not self.is_open():
             raise RuntimeError("device not open")
         
-        logging.info('set_report(%r)',report_data)
+        if _log_enabled(logging.INFO):
+            logging.info('set_report(%r)',report_data)
+    
+    def _copy_to_output_buffer(self,report_data,offset=0):
+        '''
+        copy report_data (any bytes-like object) into the ctypes buffer kept
+        for outgoing reports, leaving offset bytes free at the start.
+        returns the buffer and the number of bytes of it that are used.
+        callers must hold _write_lock while using the buffer
+        '''
+        size=len(report_data)
+        report_buffer=self._output_buffer
+        if report_buffer is None or sizeof(report_buffer) < size+offset:
+            report_buffer=self._output_buffer=(c_ubyte*(size+offset))()
+        if not isinstance(report_data,bytes):
+            try:
+                # writable buffers (bytearray, ctypes arrays) can be used in place
+                report_data=(c_char*size).from_buffer(report_data)
+            except TypeError:
+                # read-only buffers have to be copied
+                report_data=bytes(bytearray(report_data))
+        memmove(addressof(report_buffer)+offset,report_data,size)
+        return report_buffer,size+offset
     
     
     def set_interrupt_report_callback(self,callback,report_buffer_size=8):
@@ -71,7 +134,7 @@ class HIDDevice(object):
             raise RuntimeError("device not open")
         
         self._callback=callback
-        if not self._running:
+        if not self._running and self._reader is None:
             self._running=True
             
             class CallbackLoop(Thread):
@@ -84,28 +147,479 @@ class HIDDevice(object):
                     self.device._run_interrupt_callback_loop(self.report_buffer_size)
             
             self._thread=CallbackLoop(self,report_buffer_size)
-            self._thread.setDaemon(True)
+            self._thread.daemon=True
             self._thread.start()
     
     def _run_interrupt_callback_loop(self,report_buffer_size):
+        '''
+        run on a thread to handle reading events from the device
+        '''
+        if not self.is_open():
+            raise RuntimeError("device not open")
+        
+        logging.info("starting _run_interrupt_callback_loop")
+        
+        self._start_reading(report_buffer_size)
+        try:
+            while self._running and self.is_open():
+                self._wait_for_reports([self],0.1)
+        finally:
+            self._stop_reading()
+    
+    def _start_reading(self,report_buffer_size):
+        '''
+        start reading reports from the device.  they are passed on to the
+        callback on the calling thread, while it is in _wait_for_reports
+        '''
+        raise RuntimeError("not implemented")
+    
+    def _stop_reading(self):
+        '''stop reading reports (on the thread that started reading)'''
+        raise RuntimeError("not implemented")
+    
+    @classmethod
+    def _wait_for_reports(cls,devices,timeout):
+        '''
+        wait up to timeout seconds for reports from devices (all of this
+        class, and reading on the calling thread), delivering any that arrive
+        '''
         raise RuntimeError("not implemented")
     
+    def _deliver_report(self,report_buffer,size,offset=0):
+        '''
+        pass a report that has been read into report_buffer (a ctypes array)
+        on to the callback.  the report is copied out of the buffer in one go,
+        starting at offset, and the buffer cleared ready for the next read
+        (so we don't get weird-ness if it's not fully written to later).
+        the time it arrived is put in report_timestamp_ns first
+        '''
+        self.report_timestamp_ns=host_ns()
+        report_data=string_at(addressof(report_buffer)+offset,size)
+        memset(report_buffer,0,sizeof(report_buffer))
+        if _log_enabled(logging.INFO):
+            logging.info('interrupt_report_callback(%r)',report_data)
+        callback=self._callback
+        if callback is not None:
+            callback(self,report_data)
+    
     def __str__(self):
         return "(vendor=0x%04x,product=0x%04x)" % (self.vendor,self.product)
 
+class ReportReader(Thread):
+    '''
+    a single thread reading reports from several devices (of the same
+    class), in place of the thread each device would start for itself.
+    devices must be added before their callback is set, e.g.
+    
+        reader=ReportReader()
+        for device in devices:
+            device.open()
+            reader.add(device)
+        reader.start()
+        ...
+        reader.stop()
+    
+    the callbacks for all the devices are called on this thread, so
+    reports are delivered (and time stamped) in the order they arrive
+    '''
+    def __init__(self,timeout=0.1):
+        Thread.__init__(self)
+        self.daemon=True
+        self.timeout=timeout
+        '''longest time (seconds) before devices added or removed are noticed'''
+        self.devices=[]
+        '''the devices being read from'''
+        self._lock=Lock()
+        self._changes=[] # (device,report_buffer_size or None to remove,Event)
+        self._running=True
+    
+    def add(self,device,report_buffer_size=8):
+        '''start reading reports from device (which must be open)'''
+        if not device.is_open():
+            raise RuntimeError("device not open")
+        for other in self.devices:
+            if other.__class__ is not device.__class__:
+                raise ValueError("can only read from devices of one class: %s" % other.__class__.__name__)
+        device._reader=self
+        self._change(device,report_buffer_size)
+    
+    def remove(self,device):
+        '''stop reading reports from device (called when it's closed)'''
+        if device._reader is not self:
+            return
+        device._reader=None
+        self._change(device,None)
+    
+    def _change(self,device,report_buffer_size):
+        done=Event()
+        self._lock.acquire()
+        try:
+            self._changes.append((device,report_buffer_size,done))
+        finally:
+            self._lock.release()
+        # wait for the change to be made, if this thread is reading
+        if self.is_alive() and self is not current_thread():
+            done.wait(self.timeout+1)
+    
+    def _make_changes(self):
+        self._lock.acquire()
+        try:
+            changes,self._changes=self._changes,[]
+        finally:
+            self._lock.release()
+        for device,report_buffer_size,done in changes:
+            try:
+                if report_buffer_size is None:
+                    if device in self.devices:
+                        self.devices.remove(device)
+                        device._stop_reading()
+                elif device not in self.devices:
+                    device._start_reading(report_buffer_size)
+                    self.devices.append(device)
+            except Exception:
+                logging.exception('error changing device %s',device)
+            done.set()
+    
+    def run(self):
+        logging.info("starting ReportReader")
+        try:
+            while self._running:
+                if self._changes:
+                    self._make_changes()
+                devices=self.devices
+                if devices:
+                    devices[0]._wait_for_reports(devices,self.timeout)
+                else:
+                    time.sleep(self.timeout)
+        finally:
+            for device in self.devices:
+                device._reader=None
+                device._stop_reading()
+            self.devices=[]
+    
+    def stop(self):
+        '''stop reading from all the devices'''
+        self._running=False
+        if self.is_alive() and self is not current_thread():
+            self.join(self.timeout+1)
+
+class SharedHIDDevice(HIDDevice):
+    '''
+    one owner's handle on a device shared through a DevicePool.  the
+    device is only opened once, and read by one thread, whatever the
+    number of handles: every report is passed on to the callbacks of all
+    the handles, apart from replies to commands sent with send_expecting,
+    which only go to the handle that sent the command.  the device is
+    closed when the last handle is
+    '''
+    def __init__(self,pool,device):
+        HIDDevice.__init__(self,device.vendor,device.product)
+        self.device=device
+        '''the HIDDevice being shared'''
+        self._pool=pool
+        self._open=False
+    
+    def is_open(self):
+        return self._open
+    
+    def open(self):
+        if not self._open:
+            self._pool._add(self)
+            self._open=True
+    
+    def close(self):
+        if self._open:
+            self._open=False
+            self._pool._remove(self)
+        HIDDevice.close(self)
+    
+    def physical_id(self):
+        return self.device.physical_id()
+    
+    def set_report(self,report_data,report_id=0):
+        if not self._open:
+            raise RuntimeError("device not open")
+        self.device.set_report(report_data,report_id)
+    
+    def send_expecting(self,report_id,send,*args):
+        '''
+        call send(*args) to write a command that the box replies to with a
+        report with report_id, which is then only passed on to this handle.
+        the box replies in the order the commands arrive, so replies are
+        given to the handles in the order their commands were written
+        '''
+        if not self._open:
+            raise RuntimeError("device not open")
+        self._pool._send_expecting(self,report_id,send,args)
+    
+    def cancel_expected(self,report_id):
+        '''
+        stop waiting for the oldest reply (with report_id) asked for with
+        send_expecting, e.g. if it didn't arrive in time
+        '''
+        self._pool._cancel_expected(self,report_id)
+    
+    def set_interrupt_report_callback(self,callback,report_buffer_size=8):
+        if not self._open:
+            raise RuntimeError("device not open")
+        self._callback=callback
+        self._pool._listen(self,report_buffer_size)
+    
+    def _deliver(self,device,report_data):
+        callback=self._callback
+        if callback is not None:
+            self.report_timestamp_ns=device.report_timestamp_ns
+            callback(self,report_data)
+    
+    def __str__(self):
+        return str(self.device)
+
+class _Shared(object):
+    '''a device in a DevicePool, and the handles open on it'''
+    def __init__(self,device):
+        self.device=device
+        self.handles=()
+        # report id -> deque of the handles expecting replies, in the
+        # order they sent the commands
+        self.expected={}
+        self.expected_lock=Lock()
+        # held while sending a command that expects a reply, so the
+        # handles are added to expected in the order the commands go out
+        self.send_lock=Lock()
+    
+    def take_expected(self,report_id):
+        '''the handle the next reply with report_id is for, or None'''
+        self.expected_lock.acquire()
+        try:
+            expected=self.expected.get(report_id)
+            if not expected:
+                return None
+            return expected.popleft()
+        finally:
+            self.expected_lock.release()
+
+class DevicePool(object):
+    '''
+    hands out SharedHIDDevices, so that a physical device (going by
+    HIDDevice.physical_id) is only opened once however many times it's
+    asked for, e.g.
+    
+        handle=device_pool.acquire(device) # an open SharedHIDDevice
+        ...
+        handle.close() # the device is closed with the last handle
+    '''
+    def __init__(self):
+        self._lock=Lock()
+        self._shared={} # physical id -> _Shared
+    
+    def acquire(self,device):
+        '''
+        return an open SharedHIDDevice for device (which is opened if
+        it isn't already being shared)
+        '''
+        handle=SharedHIDDevice(self,device)
+        handle.open()
+        return handle
+    
+    def __len__(self):
+        '''number of devices being shared'''
+        return len(self._shared)
+    
+    def handles(self,device):
+        '''number of open handles on a device'''
+        shared=self._shared.get(device.physical_id())
+        if shared is None:
+            return 0
+        return len(shared.handles)
+    
+    def _add(self,handle):
+        key=handle.device.physical_id()
+        self._lock.acquire()
+        try:
+            shared=self._shared.get(key)
+            if shared is None:
+                handle.device.open()
+                shared=self._shared[key]=_Shared(handle.device)
+            else:
+                # use the device that's already open
+                handle.device=shared.device
+            shared.handles=shared.handles+(handle,)
+        finally:
+            self._lock.release()
+    
+    def _remove(self,handle):
+        key=handle.device.physical_id()
+        self._lock.acquire()
+        try:
+            shared=self._shared.get(key)
+            if shared is None:
+                return
+            shared.handles=tuple([other for other in shared.handles if other is not handle])
+            # replies the handle was waiting for go to everyone
+            shared.expected_lock.acquire()
+            try:
+                for expected in shared.expected.values():
+                    while handle in expected:
+                        expected.remove(handle)
+            finally:
+                shared.expected_lock.release()
+            if shared.handles:
+                return
+            del self._shared[key]
+        finally:
+            self._lock.release()
+        # so it's listened to again if it's shared again
+        shared.device._callback=None
+        shared.device.close()
+    
+    def _send_expecting(self,handle,report_id,send,args):
+        shared=self._shared[handle.device.physical_id()]
+        shared.send_lock.acquire()
+        try:
+            shared.expected_lock.acquire()
+            try:
+                expected=shared.expected.get(report_id)
+                if expected is None:
+                    expected=shared.expected[report_id]=deque()
+                expected.append(handle)
+            finally:
+                shared.expected_lock.release()
+            try:
+                send(*args)
+            except:
+                shared.expected_lock.acquire()
+                try:
+                    # (still the last, as nothing else was sent)
+                    if expected and expected[-1] is handle:
+                        expected.pop()
+                finally:
+                    shared.expected_lock.release()
+                raise
+        finally:
+            shared.send_lock.release()
+    
+    def _cancel_expected(self,handle,report_id):
+        shared=self._shared.get(handle.device.physical_id())
+        if shared is None:
+            return
+        shared.expected_lock.acquire()
+        try:
+            expected=shared.expected.get(report_id)
+            if expected is not None and handle in expected:
+                expected.remove(handle)
+        finally:
+            shared.expected_lock.release()
+    
+    def _listen(self,handle,report_buffer_size):
+        device=handle.device
+        self._lock.acquire()
+        try:
+            if device._callback is not None:
+                return
+            shared=self._shared[device.physical_id()]
+            def fan_out(device,report_data):
+                # a reply goes to the handle that sent the command,
+                # anything else to the handles open when it arrived
+                handles=shared.handles
+                if shared.expected:
+                    expecting=shared.take_expected(ord(report_data[:1]))
+                    if expecting is not None:
+                        handles=(expecting,)
+                for handle in handles:
+                    try:
+                        handle._deliver(device,report_data)
+                    except Exception:
+                        # don't let one owner stop the others getting it
+                        logging.exception('error in callback for %s',device)
+            device.set_interrupt_report_callback(fan_out,report_buffer_size)
+        finally:
+            self._lock.release()
+
+class DeviceCache(object):
+    '''
+    keeps the devices found by enumerate(vendor,product) (e.g. a hid
+    module's find_hid_devices, which lists devices with the vendor and
+    product ids, if given) for ttl seconds, or until invalidate() is
+    called (e.g. when a device is plugged in or removed).  find() takes
+    the same arguments and returns copies of the devices (see
+    HIDDevice.copy), so each caller gets devices of its own to open
+    '''
+    def __init__(self,enumerate,ttl=10.0):
+        self.enumerate=enumerate
+        self.ttl=ttl
+        self.enumerations=0
+        '''number of times enumerate has been called'''
+        self._lock=Lock()
+        self._found={} # (vendor,product) -> (host_ns when found,devices)
+    
+    def _cached(self,key):
+        found=self._found.get(key)
+        if found is not None and host_ns()-found[0] < self.ttl*1e9:
+            return found[1]
+        return None
+    
+    def find(self,vendor=None,product=None):
+        '''
+        copies of the devices with the vendor and product ids (if given),
+        enumerating them again only if the ones found before are out of date
+        '''
+        self._lock.acquire()
+        try:
+            devices=self._cached((vendor,product))
+            if devices is None:
+                # devices listed without filtering will do
+                devices=self._cached((None,None))
+                if devices is not None:
+                    devices=[device for device in devices if device.matches(vendor,product)]
+            if devices is None:
+                devices=self.enumerate(vendor,product)
+                self.enumerations+=1
+                self._found[(vendor,product)]=(host_ns(),devices)
+        finally:
+            self._lock.release()
+        return [device.copy() for device in devices]
+    
+    def invalidate(self):
+        '''forget the devices found, they are looked for again next time'''
+        self._lock.acquire()
+        try:
+            self._found={}
+        finally:
+            self._lock.release()
+
 module_names=['hid.win32','hid.osx']
 
+# a particular module can be forced, e.g. IOLABS_HID_MODULE=hid.emulator
+# to run against the emulated box (it's never used otherwise, so an
+# experiment can't end up running without a real box)
+if os.environ.get('IOLABS_HID_MODULE'):
+    module_names=[os.environ['IOLABS_HID_MODULE']]
+
 find_hid_devices=None
+_load_errors=[]
 
 for name in module_names:
-    # try loading modules until we find one that works
+    # try loading modules until we find one that works (the others fail
+    # on import, e.g. hid.win32 can't find windll on other systems)
     try:
         hid=__import__(name,globals(),locals(),['find_hid_devices'])
         logging.info("loading HID code from: %s" % name)
-        find_hid_devices=hid.find_hid_devices
+        device_cache=DeviceCache(hid.find_hid_devices)
+        find_hid_devices=device_cache.find
         break
-    except:
-        pass
+    except Exception as e:
+        logging.info("could not load HID code from: %s" % name,exc_info=True)
+        _load_errors.append('%s (%s: %s)' % (name,type(e).__name__,e))
 
 if find_hid_devices is None:
-    raise RuntimeError("could not find a module for this operating system")
+    raise RuntimeError("could not find a module for this operating system - tried %s"
+                       % ', '.join(_load_errors))
+
+device_pool=DevicePool()
+
+def devices_changed():
+    '''
+    hotplug hook: call when a device is plugged in or removed, so
+    find_hid_devices looks for them again
+    '''
+    device_cache.invalidate()
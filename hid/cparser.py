@@ -3,6 +3,11 @@
 from ctypes import *
 import re
 
+try:
+    basestring
+except NameError:
+    basestring=str # python 3
+
 TOKENS=re.compile(r'[\w_]+|[()*,]')
 WORD=re.compile(r'^[_\w]+$')
 
@@ -42,7 +47,7 @@ define('wchar_t*', c_wchar_p)
 
 def _parse_type(type_str):
     # see if the type is there
-    if _types.has_key(type_str):
+    if type_str in _types:
         return _types[type_str]
     if type_str.endswith('*'):
         type_str=type_str[:-1]
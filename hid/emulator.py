@@ -0,0 +1,647 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+'''
+In-process emulation of the ioLab USB button box firmware.
+Only loaded when selected with the IOLABS_HID_MODULE environment
+variable (IOLABS_HID_MODULE=hid.emulator), so the rest of the library
+can be exercised and profiled without a physical box.
+Refer to the hid module for available functions
+'''
+
+import heapq
+import logging
+import random
+import struct
+import threading
+import time
+from ctypes import c_ubyte, memmove
+
+from hid import HIDDevice
+
+IO_LABS_VENDOR_ID=0x19BC
+BUTTON_BOX_PRODUCT_ID=0x0001
+
+# commands understood by the firmware in form id : ('name','unpack format')
+# (formats follow the identity byte, as in ioLabs.COMMAND_SUMMARY)
+FIRMWARE_COMMANDS={
+    0x21 : ('PACSET', 'BBBBBBB'),
+    0x59 : ('VERGET', 'xxxxxxx'),
+    0x5A : ('NUMGET', 'xxxxxxx'),
+    0x52 : ('RESRTC', 'xxxxxxx'),
+    0x54 : ('RTCGET', 'xxxxxxx'),
+    0x48 : ('HBSET',  'Hxxxxx'),
+    0x51 : ('QPURGE', 'xxxxxxx'),
+    0x53 : ('SEROUT', 'BBBBBBB'),
+    0x43 : ('VCKSET', 'BBBBBxx'),
+    0x56 : ('VCKGET', 'xxxxxxx'),
+    0x4D : ('MSKSET', 'xBBxxxx'),
+    0x3F : ('MSKGET', 'xxxxxxx'),
+    0x47 : ('KEYGET', 'xxxxxxx'),
+    0x4A : ('DEBSET', 'xBBBBBB'),
+    0x46 : ('DEBGET', 'xxxxxxx'),
+    0x57 : ('DIRSET', 'BBBxxxx'),
+    0x44 : ('DIRGET', 'xxxxxxx'),
+    0x4C : ('LOGSET', 'xBBxxxx'),
+    0x42 : ('LOGGET', 'xxxxxxx'),
+    0x30 : ('P0SET',  'Bxxxxxx'),
+    0x41 : ('P0AND',  'Bxxxxxx'),
+    0x4F : ('P0_OR',  'Bxxxxxx'),
+    0x58 : ('P0XOR',  'Bxxxxxx'),
+    0x32 : ('P2SET',  'Bxxxxxx'),
+    0x61 : ('P2AND',  'Bxxxxxx'),
+    0x6F : ('P2_OR',  'Bxxxxxx'),
+    0x78 : ('P2XOR',  'Bxxxxxx'),
+    0x3D : ('PXSET',  'xBBxxxx'),
+    0x26 : ('PXAND',  'xBBxxxx'),
+    0x2B : ('PX_OR',  'xBBxxxx'),
+    0x5E : ('PXXOR',  'xBBxxxx'),
+    0x50 : ('PXGET',  'xxxxxxx'),
+    0x4E : ('PXPGET', 'xxxxxxx'),
+}
+
+# reports produced by the firmware in form 'name' : (id,'pack format')
+FIRMWARE_REPORTS={
+    'VERREP' : (0x59, 'BBBBBxx'),
+    'NUMREP' : (0x5A, 'Bx5s'),
+    'RTCREP' : (0x54, 'BxxI'),
+    'HBREP'  : (0x48, 'BHI'),
+    'SERIN'  : (0x53, 'BBBBBBB'),
+    'VCKREP' : (0x56, 'BBBBBBB'),
+    'DEBREP' : (0x4A, 'xBBBBBB'),
+    'KEYDN'  : (0x44, 'xxBI'),
+    'KEYUP'  : (0x55, 'xxBI'),
+    'KEYREP' : (0x4B, 'xBBI'),
+    'PXREP'  : (0x50, 'xBBI'),
+    'PXPREP' : (0x4E, 'xBBI'),
+    'MSKREP' : (0x4D, 'xBBI'),
+    'DIRREP' : (0x57, 'BBBI'),
+    'LOGREP' : (0x4C, 'xBBI'),
+    'ERROR'  : (0x45, 'BBBBBBB'),
+}
+
+# voice key status codes
+VCK_OK=0x58
+VCK_NAK=0x48
+VCK_BAD_ACTION=0x15
+
+# serial port status codes
+SERIAL_SENT=0xF0
+
+# bits on port 3 used by the interrupts
+INT_MASKS=(1<<2,1<<3)
+
+
+def _pack_report(name,*values):
+    report_id,format=FIRMWARE_REPORTS[name]
+    return struct.pack('>B'+format,report_id,*values)
+
+
+class VirtualClock(object):
+    '''
+    clock used by the emulator.  runs at 'rate' times real time (so a rate
+    of 10 makes 1 second of box time pass in 0.1 seconds) and can be moved
+    forward explicitly with advance()
+    '''
+    def __init__(self,rate=1.0):
+        if rate <= 0:
+            raise ValueError("clock rate must be positive")
+        self.rate=float(rate)
+        self._origin=time.time()
+        self._offset=0.0
+
+    def now(self):
+        '''current virtual time (in seconds)'''
+        return self._offset+(time.time()-self._origin)*self.rate
+
+    def advance(self,seconds):
+        '''jump the clock forward by the given number of (virtual) seconds'''
+        self._offset+=seconds
+
+    def real_delay(self,seconds):
+        '''convert a virtual delay into the real time it will take'''
+        return seconds/self.rate
+
+
+class BoxFirmware(object):
+    '''
+    model of the button box firmware.  commands are fed in with command()
+    and the resulting reports are collected with wait_for_reports().
+    button presses, interrupts and serial input can be simulated with
+    press()/release(), trigger()/untrigger() and receive_serial().
+    drift_ppm makes the box's clock (rtc) run fast (or slow, if negative)
+    by that many parts per million, as a real box's crystal does
+    '''
+    def __init__(self,serial_num='00001',version=(3,2),voice_version=(1,4),
+                 latency=0.0005,jitter=0.0,clock=None,seed=None,vck_write_time=0.02,
+                 drift_ppm=0.0):
+        self.vendor=IO_LABS_VENDOR_ID
+        self.product=BUTTON_BOX_PRODUCT_ID
+        self.serial_num=serial_num
+        self.version=version
+        self.voice_version=voice_version
+        self.latency=latency
+        self.jitter=jitter
+        self.clock=clock or VirtualClock()
+        self.vck_write_time=vck_write_time
+        self.drift_ppm=drift_ppm
+
+        self._random=random.Random(seed)
+        self._lock=threading.Condition()
+        # Events set whenever a report is scheduled (see EmulatedHIDDevice)
+        self._wakeups=[]
+        self._outgoing=[] # heap of (due,seq,report or report function,purgeable)
+        self._seq=0
+        self._last_reply_due=0.0
+        self._handlers={}
+        for command_id,(name,format) in FIRMWARE_COMMANDS.items():
+            self._handlers[command_id]=(struct.Struct('>B'+format),getattr(self,'_do_'+name.lower()))
+
+        self.serial_out=[] # bytes written to the serial port
+        self.commands_received=0
+        self.power_on()
+
+    def power_on(self):
+        '''put registers back to their power on values'''
+        self._lock.acquire()
+        try:
+            self.pac=(0,)*7
+            self.port0=0
+            self.port2=0
+            self.port2_mode=0
+            self.dir_port0=0
+            self.dir_port2=0
+            self.logic_port0=0
+            self.logic_port2=0
+            self.mask_port1=0xFF
+            self.mask_port3=INT_MASKS[0] | INT_MASKS[1]
+            self.debounce=[20,5,20,5,20,5]
+            self.min_duration=0
+            self.min_silence=0
+            self.trigger_level=0
+            self.peak_level=0
+            self.primary_gain=0
+            self.secondary_gain=0
+            self.mic_pass_thru=0
+            self._vck_busy_until=0.0
+            self.keys_port1=0
+            self.keys_port3=0
+            self._input_changes={}
+            self.heartbeat_rate=0
+            self._heartbeat_seq=0
+            self._rtc_origin=self.clock.now()
+            del self._outgoing[:]
+        finally:
+            self._lock.release()
+
+    def rtc(self,now=None):
+        '''the box clock (32-bit milliseconds since last reset)'''
+        if now is None:
+            now=self.clock.now()
+        return int((now-self._rtc_origin)*(1000+self.drift_ppm*1e-3)) & 0xFFFFFFFF
+
+    def queue_len(self):
+        '''number of reports waiting to be sent to the host'''
+        return min(len(self._outgoing),0xFF)
+
+    #################################
+    # scheduling of outgoing reports
+
+    def _schedule(self,due,report,purgeable=True):
+        self._seq+=1
+        heapq.heappush(self._outgoing,(due,self._seq,report,purgeable))
+        self._lock.notify()
+        for wakeup in self._wakeups:
+            wakeup.set()
+
+    def _reply(self,report):
+        '''queue a reply after the configured latency (keeping replies in order)'''
+        due=self.clock.now()+self.latency
+        if self.jitter:
+            due+=self._random.uniform(0,self.jitter)
+        due=max(due,self._last_reply_due)
+        self._last_reply_due=due
+        self._schedule(due,report)
+
+    def command(self,data):
+        '''process a single command sent from the host'''
+        data=bytes(bytearray(data))
+        if len(data) < 8:
+            data=data+b'\0'*(8-len(data))
+        command_id=struct.unpack_from('>B',data)[0]
+        self._lock.acquire()
+        try:
+            self.commands_received+=1
+            handler=self._handlers.get(command_id)
+            if handler is None:
+                logging.info("emulator: unknown command id: 0x%02x",command_id)
+                self._reply(_pack_report('ERROR',command_id,0,0,0,0,0,0))
+                return
+            unpacker,do_command=handler
+            do_command(*unpacker.unpack(data[:8])[1:])
+        finally:
+            self._lock.release()
+
+    def next_report_delay(self):
+        '''real time (seconds) until the next report is due, None if there are none'''
+        self._lock.acquire()
+        try:
+            if not self._outgoing:
+                return None
+            return self.clock.real_delay(self._outgoing[0][0]-self.clock.now())
+        finally:
+            self._lock.release()
+
+    def wait_for_reports(self,timeout):
+        '''
+        block for up to timeout (real) seconds waiting for reports to become
+        due, then return all due reports as a list of strings
+        '''
+        self._lock.acquire()
+        try:
+            now=self.clock.now()
+            if not self._outgoing or self._outgoing[0][0] > now:
+                wait=timeout
+                if self._outgoing:
+                    wait=min(wait,self.clock.real_delay(self._outgoing[0][0]-now))
+                if wait > 0:
+                    self._lock.wait(wait)
+                now=self.clock.now()
+            reports=[]
+            while self._outgoing and self._outgoing[0][0] <= now:
+                due,seq,report,purgeable=heapq.heappop(self._outgoing)
+                if callable(report):
+                    report=report(due)
+                if report is not None:
+                    reports.append(report)
+            return reports
+        finally:
+            self._lock.release()
+
+    #################################
+    # simulated inputs
+
+    def press(self,line):
+        '''press a button (line 0-7 on port 1)'''
+        self._input(line,True)
+
+    def release(self,line):
+        '''release a button (line 0-7 on port 1)'''
+        self._input(line,False)
+
+    def trigger(self,int_num):
+        '''activate interrupt 0 (voice key) or 1 (optic key)'''
+        self._input(8+(2+int_num),True)
+
+    def untrigger(self,int_num):
+        self._input(8+(2+int_num),False)
+
+    def _input(self,key_code,down):
+        '''
+        change the state of an input line.  the change is only
+        reported once it has been stable for the debounce time
+        '''
+        self._lock.acquire()
+        try:
+            if key_code < 8:
+                debounce=self.debounce[0 if down else 1]
+            else:
+                int_num=key_code-10
+                debounce=self.debounce[2+2*int_num+(0 if down else 1)]
+
+            # any later change of this input cancels the pending one
+            change=self._input_changes.get(key_code,0)+1
+            self._input_changes[key_code]=change
+
+            def settle(due):
+                if self._input_changes[key_code] != change or self._key_down(key_code) == down:
+                    return None
+                self._set_key(key_code,down)
+                if self.port2_mode and key_code < 8:
+                    # loopback - leds follow buttons
+                    self.port2=self._set_bit(self.port2,1<<key_code,down)
+                if not self._key_enabled(key_code):
+                    return None
+                return _pack_report('KEYDN' if down else 'KEYUP',key_code,self.rtc(due))
+            self._schedule(self.clock.now()+debounce/1000.0,settle)
+        finally:
+            self._lock.release()
+
+    def receive_serial(self,data):
+        '''simulate bytes arriving at the serial port'''
+        data=bytearray(data)
+        self._lock.acquire()
+        try:
+            for i in range(0,len(data),6):
+                chunk=list(data[i:i+6])
+                num_bytes=len(chunk)
+                chunk+=[0]*(6-num_bytes)
+                self._reply(_pack_report('SERIN',num_bytes,*chunk))
+        finally:
+            self._lock.release()
+
+    def _key_down(self,key_code):
+        if key_code < 8:
+            return bool(self.keys_port1 & (1<<key_code))
+        return bool(self.keys_port3 & (1<<(key_code-8)))
+
+    def _key_enabled(self,key_code):
+        if key_code < 8:
+            return bool(self.mask_port1 & (1<<key_code))
+        return bool(self.mask_port3 & (1<<(key_code-8)))
+
+    def _set_key(self,key_code,down):
+        if key_code < 8:
+            self.keys_port1=self._set_bit(self.keys_port1,1<<key_code,down)
+        else:
+            self.keys_port3=self._set_bit(self.keys_port3,1<<(key_code-8),down)
+
+    def _set_bit(self,bits,mask,high):
+        if high:
+            return bits | mask
+        return bits & (mask ^ 0xFF)
+
+    #################################
+    # report builders
+
+    def _pxrep(self):
+        return _pack_report('PXREP',self.port2,self.port0,self.rtc())
+
+    def _dirrep(self):
+        return _pack_report('DIRREP',self.port2_mode,self.dir_port2,self.dir_port0,self.rtc())
+
+    def _logrep(self):
+        return _pack_report('LOGREP',self.logic_port2,self.logic_port0,self.rtc())
+
+    def _mskrep(self):
+        return _pack_report('MSKREP',self.mask_port3,self.mask_port1,self.rtc())
+
+    def _keyrep(self):
+        return _pack_report('KEYREP',self.keys_port3,self.keys_port1,self.rtc())
+
+    def _debrep(self):
+        return _pack_report('DEBREP',*self.debounce)
+
+    def _vckrep(self,status_code=VCK_OK):
+        return _pack_report('VCKREP',status_code,self.min_duration,self.min_silence,
+            self.trigger_level,self.peak_level,self.primary_gain,self.secondary_gain)
+
+    def _heartbeat(self,seq):
+        '''returns a function to build the next heartbeat (if still wanted)'''
+        def heartbeat(due):
+            if seq != self._heartbeat_seq or not self.heartbeat_rate:
+                return None
+            self._schedule(due+self.heartbeat_rate/1000.0,self._heartbeat(seq),False)
+            return _pack_report('HBREP',self.queue_len(),self.heartbeat_rate,self.rtc(due))
+        return heartbeat
+
+    #################################
+    # command handlers (one per COMMAND)
+
+    def _do_pacset(self,*data):
+        self.pac=data
+
+    def _do_verget(self):
+        self._reply(_pack_report('VERREP',0,self.version[0],self.version[1],
+            self.voice_version[0],self.voice_version[1]))
+
+    def _do_numget(self):
+        self._reply(_pack_report('NUMREP',0,self.serial_num.encode('ascii')))
+
+    def _do_resrtc(self):
+        self._rtc_origin=self.clock.now()
+        self._reply(self._keyrep())
+
+    def _do_rtcget(self):
+        self._reply(_pack_report('RTCREP',self.queue_len(),self.rtc()))
+
+    def _do_hbset(self,rate):
+        self.heartbeat_rate=rate
+        self._heartbeat_seq+=1
+        if rate:
+            self._schedule(self.clock.now()+rate/1000.0,self._heartbeat(self._heartbeat_seq),False)
+
+    def _do_qpurge(self):
+        # drop everything waiting to be sent, bar the heartbeat
+        self._outgoing[:]=[entry for entry in self._outgoing if not entry[3]]
+        heapq.heapify(self._outgoing)
+
+    def _do_serout(self,nb_data,*data):
+        self.serial_out.extend(data[:min(nb_data,6)])
+        self._reply(_pack_report('SERIN',SERIAL_SENT,0,0,0,0,0,0))
+
+    def _do_vckset(self,action,data1,data2,data3,data4):
+        now=self.clock.now()
+        if action == 0xB8:
+            self.min_duration=data1
+            self.min_silence=data2
+            self.trigger_level=data3
+            self.mic_pass_thru=data4
+        elif action == 0xA9:
+            self.primary_gain=data1
+        elif action == 0xAA:
+            self.secondary_gain=data1
+        else:
+            self._reply(self._vckrep(VCK_BAD_ACTION))
+            return
+        self._reply(self._vckrep())
+        # the voice board takes a little while to store the values
+        self._vck_busy_until=now+self.vck_write_time
+
+    def _do_vckget(self):
+        if self.clock.now() < self._vck_busy_until:
+            self._reply(self._vckrep(VCK_NAK))
+        else:
+            self._reply(self._vckrep())
+
+    def _do_mskset(self,port3_bits,port1_bits):
+        self.mask_port3=port3_bits
+        self.mask_port1=port1_bits
+        self._reply(self._mskrep())
+
+    def _do_mskget(self):
+        self._reply(self._mskrep())
+
+    def _do_keyget(self):
+        self._reply(self._keyrep())
+
+    def _do_debset(self,*debounce):
+        self.debounce=list(debounce)
+        self._reply(self._debrep())
+
+    def _do_debget(self):
+        self._reply(self._debrep())
+
+    def _do_dirset(self,port2_mode,port2_bits,port0_bits):
+        self.port2_mode=port2_mode
+        self.dir_port2=port2_bits
+        self.dir_port0=port0_bits
+        self._reply(self._dirrep())
+
+    def _do_dirget(self):
+        self._reply(self._dirrep())
+
+    def _do_logset(self,port2_bits,port0_bits):
+        self.logic_port2=port2_bits
+        self.logic_port0=port0_bits
+        self._reply(self._logrep())
+
+    def _do_logget(self):
+        self._reply(self._logrep())
+
+    def _do_p0set(self,bits):
+        self.port0=bits
+        self._reply(self._pxrep())
+
+    def _do_p0and(self,bits):
+        self.port0&=bits
+        self._reply(self._pxrep())
+
+    def _do_p0_or(self,bits):
+        self.port0|=bits
+        self._reply(self._pxrep())
+
+    def _do_p0xor(self,bits):
+        self.port0^=bits
+        self._reply(self._pxrep())
+
+    def _do_p2set(self,bits):
+        self.port2=bits
+        self._reply(self._pxrep())
+
+    def _do_p2and(self,bits):
+        self.port2&=bits
+        self._reply(self._pxrep())
+
+    def _do_p2_or(self,bits):
+        self.port2|=bits
+        self._reply(self._pxrep())
+
+    def _do_p2xor(self,bits):
+        self.port2^=bits
+        self._reply(self._pxrep())
+
+    def _do_pxset(self,port2_bits,port0_bits):
+        self.port2,self.port0=port2_bits,port0_bits
+        self._reply(self._pxrep())
+
+    def _do_pxand(self,port2_bits,port0_bits):
+        self.port2&=port2_bits
+        self.port0&=port0_bits
+        self._reply(self._pxrep())
+
+    def _do_px_or(self,port2_bits,port0_bits):
+        self.port2|=port2_bits
+        self.port0|=port0_bits
+        self._reply(self._pxrep())
+
+    def _do_pxxor(self,port2_bits,port0_bits):
+        self.port2^=port2_bits
+        self.port0^=port0_bits
+        self._reply(self._pxrep())
+
+    def _do_pxget(self):
+        self._reply(self._pxrep())
+
+    def _do_pxpget(self):
+        # pin levels are the port state after the logic inversion
+        self._reply(_pack_report('PXPREP',self.port2 ^ self.logic_port2,
+            self.port0 ^ self.logic_port0,self.rtc()))
+
+
+class EmulatedHIDDevice(HIDDevice):
+    '''
+    HID device backed by a BoxFirmware instance instead of real hardware
+    '''
+    def __init__(self,firmware):
+        HIDDevice.__init__(self,firmware.vendor,firmware.product)
+        self.firmware=firmware
+        self._open=False
+
+    def is_open(self):
+        return self._open
+
+    def copy(self):
+        return EmulatedHIDDevice(self.firmware)
+
+    def physical_id(self):
+        return id(self.firmware)
+
+    def open(self):
+        if not self.is_open():
+            logging.info("opening emulated device")
+            self._open=True
+
+    def close(self):
+        self._open=False
+        HIDDevice.close(self)
+
+    def set_report(self,report_data,report_id=0):
+        '''
+        "set" a report - send the data to the emulated firmware
+        '''
+        HIDDevice.set_report(self,report_data,report_id)
+        self.firmware.command(report_data)
+
+    def _start_reading(self,report_buffer_size):
+        # reports are "read" into a buffer, as they would be by the OS
+        self._report_buffer=(c_ubyte*report_buffer_size)()
+        # one Event per reading thread, set when any of its boxes schedules a report
+        wakeup=getattr(_reading,'wakeup',None)
+        if wakeup is None:
+            wakeup=_reading.wakeup=threading.Event()
+        self._wakeup=wakeup
+        self.firmware._wakeups.append(wakeup)
+
+    def _stop_reading(self):
+        try:
+            self.firmware._wakeups.remove(self._wakeup)
+        except ValueError:
+            pass
+        self._report_buffer=None
+
+    def _deliver_due_reports(self):
+        report_buffer=self._report_buffer
+        for report_data in self.firmware.wait_for_reports(0):
+            if self._callback is not None and self.is_open():
+                size=min(len(report_data),len(report_buffer))
+                memmove(report_buffer,report_data,size)
+                self._deliver_report(report_buffer,len(report_buffer))
+
+    @classmethod
+    def _wait_for_reports(cls,devices,timeout):
+        '''
+        deliver reports from the firmware of all the devices as they fall due
+        '''
+        wakeup=devices[0]._wakeup
+        end_time=time.time()+timeout
+        while True:
+            # cleared first, so a report scheduled from now on will wake us
+            wakeup.clear()
+            wait=end_time-time.time()
+            for device in devices:
+                device._deliver_due_reports()
+                delay=device.firmware.next_report_delay()
+                if delay is not None:
+                    wait=min(wait,delay)
+            if end_time <= time.time():
+                break
+            if wait > 0:
+                wakeup.wait(wait)
+
+
+# per thread state of the threads reading from emulated devices
+_reading=threading.local()
+
+# the emulated boxes that are "plugged in" (call hid.devices_changed()
+# after changing them)
+boxes=[BoxFirmware()]
+
+def find_hid_devices(vendor=None,product=None):
+    '''
+    return a list of devices, one for each of the emulated boxes (with
+    the vendor and product ids, if given)
+    '''
+    devices=[EmulatedHIDDevice(firmware) for firmware in boxes]
+    return [device for device in devices if device.matches(vendor,product)]
+
+__all__ = ['find_hid_devices','EmulatedHIDDevice','BoxFirmware','VirtualClock','boxes']
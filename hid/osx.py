@@ -10,7 +10,6 @@ from ctypes import *
 from ctypes.util import find_library
 
 import logging
-import struct
 
 # common code for OS X and win32
 from hid import HIDDevice
@@ -238,6 +237,7 @@ CFRelease=parse('void CFRelease (CFTypeRef cf)').from_lib(cf)
 CFUUIDGetConstantUUIDWithBytes=parse('CFUUIDRef CFUUIDGetConstantUUIDWithBytes(CFAllocatorRef alloc, UInt8 byte0, UInt8 byte1, UInt8 byte2, UInt8 byte3, UInt8 byte4, UInt8 byte5, UInt8 byte6, UInt8 byte7, UInt8 byte8, UInt8 byte9, UInt8 byte10, UInt8 byte11, UInt8 byte12, UInt8 byte13, UInt8 byte14, UInt8 byte15)').from_lib(cf)
 CFUUIDGetUUIDBytes=parse('CFUUIDBytes CFUUIDGetUUIDBytes(CFUUIDRef uuid)').from_lib(cf)
 CFRunLoopAddSource=parse('void CFRunLoopAddSource(CFRunLoopRef rl, CFRunLoopSourceRef source, CFStringRef mode)').from_lib(cf)
+CFRunLoopRemoveSource=parse('void CFRunLoopRemoveSource(CFRunLoopRef rl, CFRunLoopSourceRef source, CFStringRef mode)').from_lib(cf)
 CFRunLoopGetCurrent=parse('CFRunLoopRef CFRunLoopGetCurrent()').from_lib(cf)
 CFRunLoopRunInMode=parse('SInt32 CFRunLoopRunInMode(CFStringRef mode, CFTimeInterval seconds, Boolean returnAfterSourceHandled)').from_lib(cf)
 
@@ -256,6 +256,7 @@ iokit=CDLL(iokitLibraryLocation)
 # IOKit functions we'll be using
 IOIteratorNext=parse('io_object_t IOIteratorNext(io_iterator_t iterator )').from_lib(iokit)
 IOObjectRelease=parse('kern_return_t IOObjectRelease(io_object_t object)').from_lib(iokit)
+IOObjectRetain=parse('kern_return_t IOObjectRetain(io_object_t object)').from_lib(iokit)
 IOServiceMatching=parse('CFMutableDictionaryRef IOServiceMatching(char* name )').from_lib(iokit)
 IOServiceGetMatchingServices=parse('kern_return_t IOServiceGetMatchingServices(mach_port_t masterPort,'
                                         'CFDictionaryRef matching, io_iterator_t * existing )').from_lib(iokit)
@@ -280,17 +281,17 @@ kIOHIDDeviceInterfaceID = CFUUIDGetConstantUUIDWithBytes(None,
     0x78, 0xBD, 0x42, 0x0C, 0x6F, 0x14, 0x11, 0xD4,
     0x94, 0x74, 0x00, 0x05, 0x02, 0x8F, 0x18, 0xD5)
 
-def find_hid_devices():
+def find_hid_devices(vendor=None,product=None):
     '''
     query the host computer for all available USB *HID* devices
-    and returns a list of any found
+    (with the vendor and product ids, if given) and returns a list of any found
     '''
-    return find_usb_devices(kIOHIDDeviceKey, kIOHIDVendorIDKey, kIOHIDProductIDKey, OSXHIDDevice)
+    return find_usb_devices(kIOHIDDeviceKey, kIOHIDVendorIDKey, kIOHIDProductIDKey, OSXHIDDevice, vendor, product)
 
-def find_usb_devices(device_key,vendor_id_key,product_id_key,device_class):
+def find_usb_devices(device_key,vendor_id_key,product_id_key,device_class,vendor=None,product=None):
     '''
-    query the host computer for all available USB devices
-    and returns a list of any found
+    query the host computer for all available USB devices (with the
+    vendor and product ids, if given) and returns a list of any found
     '''
     devices=[]
 
@@ -333,7 +334,8 @@ def find_usb_devices(device_key,vendor_id_key,product_id_key,device_class):
                 dev.product=product
 
             logging.info("find_usb_devices: found device vendor=0x%04x product=0x%04x",dev.vendor,dev.product)
-            devices.append(dev)
+            if dev.matches(vendor,product):
+                devices.append(dev)
     finally:
         IOObjectRelease(objectIterator)
     return devices
@@ -351,6 +353,8 @@ class OSXHIDDevice(HIDDevice):
         self.IOObjectRelease=IOObjectRelease # need to hold onto reference to release function
         self._hidDevice=hidDevice
         self._hidInterface=None
+        self._null_report_callback=IOHIDReportCallbackFunction()
+        self._read_state=None
     
     def __del__(self):
         HIDDevice.__del__(self)
@@ -359,10 +363,10 @@ class OSXHIDDevice(HIDDevice):
             self.IOObjectRelease(self._hidDevice)
     
     def close(self):
-        # should be sufficient to get callback thread to quit
+        # stop reading first, as that needs the interface
+        HIDDevice.close(self)
         if self._hidInterface:
             self._hidInterface=None
-        HIDDevice.close(self)
     
     def is_open(self):
         '''
@@ -370,6 +374,14 @@ class OSXHIDDevice(HIDDevice):
         '''
         return self._hidInterface is not None
     
+    def copy(self):
+        # the new device releases its own reference
+        IOObjectRetain(self._hidDevice)
+        return OSXHIDDevice(self._hidDevice,self.vendor,self.product)
+    
+    def physical_id(self):
+        return self._hidDevice
+    
     def open(self):
         '''
         open the HID device - must be called prior to registering callbacks
@@ -401,29 +413,26 @@ class OSXHIDDevice(HIDDevice):
         '''
         HIDDevice.set_report(self,report_data,report_id)
         
-        # copy data into a ctypes buffer
-        report_buffer=(c_ubyte*len(report_data))()
-        for i,c in enumerate(report_data):
-            report_buffer[i]=struct.unpack('B',c)[0]
-        
-        self._hidInterface.setReport(
-            kIOHIDReportTypeOutput,
-            report_id,
-            report_buffer,
-            len(report_buffer),
-            100, # 100ms
-            IOHIDReportCallbackFunction(), None, None # NULL callback
-        )
+        self._write_lock.acquire()
+        try:
+            # copy data into a ctypes buffer
+            report_buffer,size=self._copy_to_output_buffer(report_data)
+            
+            self._hidInterface.setReport(
+                kIOHIDReportTypeOutput,
+                report_id,
+                report_buffer,
+                size,
+                100, # 100ms
+                self._null_report_callback, None, None # NULL callback
+            )
+        finally:
+            self._write_lock.release()
     
-    def _run_interrupt_callback_loop(self,report_buffer_size):
+    def _start_reading(self,report_buffer_size):
         '''
-        run on a thread to handle reading events from the device
+        add the device's event source to this thread's run loop
         '''
-        if not self.is_open():
-            raise RuntimeError("device not open")
-        
-        logging.info("starting _run_interrupt_callback_loop")
-        
         # create the report buffer
         report_buffer=(c_ubyte*report_buffer_size)() # TODO should query device to find report size
         
@@ -431,13 +440,7 @@ class OSXHIDDevice(HIDDevice):
         def callback(target, result, refcon, sender, size):
             # copy data out of report buffer
             if self._callback is not None:
-                report_data="".join([struct.pack('B',b) for b in report_buffer])
-                # zero buffer after to ensure we don't get weird-ness
-                # if it's not fully written to later
-                for i in range(len(report_buffer)):
-                    report_buffer[i]=0
-                logging.info('interrupt_report_callback(%r)',report_data)
-                self._callback(self,report_data)
+                self._deliver_report(report_buffer,report_buffer_size)
         
         # make sure we hold into the callback, so it doesn't get gc-ed
         # (leads to weird behaviour)
@@ -457,10 +460,23 @@ class OSXHIDDevice(HIDDevice):
         
         # kick off the queues etc
         self._hidInterface.startAllQueues()
-        CFRunLoopAddSource(CFRunLoopGetCurrent(), eventSource, kCFRunLoopDefaultMode)
-        logging.info("running CFRunLoopRunInMode")
-        
-        while self._running and self.is_open():
-            CFRunLoopRunInMode(kCFRunLoopDefaultMode,0.1,False)
+        runLoop=CFRunLoopGetCurrent()
+        CFRunLoopAddSource(runLoop, eventSource, kCFRunLoopDefaultMode)
+        self._read_state=(report_buffer,hid_callback,runLoop,eventSource)
+    
+    def _stop_reading(self):
+        if self._read_state is None:
+            return
+        report_buffer,hid_callback,runLoop,eventSource=self._read_state
+        CFRunLoopRemoveSource(runLoop, eventSource, kCFRunLoopDefaultMode)
+        if self._hidInterface:
+            self._hidInterface.stopAllQueues()
+        # the buffer and callback are kept, in case a report is on its way
+    
+    @classmethod
+    def _wait_for_reports(cls,devices,timeout):
+        # the callbacks of all the devices reading on this thread are run
+        # by its run loop
+        CFRunLoopRunInMode(kCFRunLoopDefaultMode,timeout,False)
     
 __all__ = ['find_hid_devices','OSXHIDDevice']
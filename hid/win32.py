@@ -10,7 +10,7 @@ Refer to the hid module for available functions
 #http://permalink.gmane.org/gmane.comp.python.ctypes/2410
 
 import logging
-import struct
+import re
 
 from ctypes import *
 from ctypes.wintypes import *
@@ -143,10 +143,22 @@ class Win32HIDDevice(HIDDevice):
         
         self._device_handle=None
         self._CloseHandle=Kernel32.CloseHandle
+        self._reading=False
+        self._read_state=None
+        
+        def completion_callback(dwErrorCode,dwNumberOfBytesTransfered,lpOverlapped):
+            pass
+        self._write_completion=LPOVERLAPPED_COMPLETION_ROUTINE(completion_callback)
     
     def is_open(self):
         return self._device_handle is not None
     
+    def copy(self):
+        return Win32HIDDevice(self._device_path,self.vendor,self.product)
+    
+    def physical_id(self):
+        return self._device_path
+    
     def _open_handle(self):
         return Kernel32.CreateFileA(
             self._device_path,
@@ -193,65 +205,87 @@ class Win32HIDDevice(HIDDevice):
         '''
         HIDDevice.set_report(self,report_data,report_id)
         
-        report_buffer=(c_ubyte*(len(report_data)+1))()
-        report_buffer[0]=report_id # first byte is report id
-        for i,c in enumerate(report_data):
-            report_buffer[i+1]=struct.unpack('B',c)[0]
-                
-        def completion_callback(dwErrorCode,dwNumberOfBytesTransfered,lpOverlapped):
-            pass
-        
-        overlap_completion=LPOVERLAPPED_COMPLETION_ROUTINE(completion_callback)
-        
-        result=WriteFileEx(
-            self._device_handle,
-            report_buffer,
-            len(report_buffer),
-            self._write_overlapped,
-            overlap_completion )
-        
-        if not result:
-            raise RuntimeError("WriteFileEx failed")
-        
-        if Kernel32.SleepEx(100,1) == 0:
-            raise RuntimeError("timed out when writing to device")
+        self._write_lock.acquire()
+        try:
+            # leave room for the report id in the first byte
+            report_buffer,size=self._copy_to_output_buffer(report_data,1)
+            report_buffer[0]=report_id
+            
+            result=WriteFileEx(
+                self._device_handle,
+                report_buffer,
+                size,
+                self._write_overlapped,
+                self._write_completion )
+            
+            if not result:
+                raise RuntimeError("WriteFileEx failed")
+            
+            if Kernel32.SleepEx(100,1) == 0:
+                raise RuntimeError("timed out when writing to device")
+        finally:
+            self._write_lock.release()
     
     
-    def _run_interrupt_callback_loop(self,report_buffer_size):
+    def _start_reading(self,report_buffer_size):
         '''
-        run on a thread to handle reading events from the device
+        start an async read, which is started again each time it completes.
+        the completion routine is run while the thread is in an alertable
+        wait (SleepEx)
         '''
-        if not self.is_open():
-            raise RuntimeError("device not open")
-        
-        logging.info("starting _run_interrupt_callback_loop")
-        
         # +1 to allow for report id byte
         report_buffer=(c_ubyte*(report_buffer_size+1))()
         overlapped=OVERLAPPED()
         
         def completion_callback(dwErrorCode,dwNumberOfBytesTransfered,lpOverlapped):
-            report_data="".join([struct.pack('B',b) for b in report_buffer])
-            report_data=report_data[1:] # remove first byte (report id)
-            self._callback(self,report_data)
+            if not self._reading or dwErrorCode:
+                return # cancelled
+            # skip the first byte (report id)
+            self._deliver_report(report_buffer,report_buffer_size,1)
+            read()
         
-        overlap_completion=LPOVERLAPPED_COMPLETION_ROUTINE(completion_callback)
-        
-        # do async reads until the thread stops
-        while self._running and self.is_open():
+        def read():
             result=ReadFileEx(self._device_handle,report_buffer,len(report_buffer),byref(overlapped),overlap_completion)
             if not result:
                 raise RuntimeError("ReadFileEx failed")
-            Kernel32.SleepEx(100,1)
         
-        # thread is stopping so make sure we won't receive any more messages
-        Kernel32.CancelIo(self._device_handle)
+        overlap_completion=LPOVERLAPPED_COMPLETION_ROUTINE(completion_callback)
+        
+        # hold onto the buffers and callback, so they don't get gc-ed while
+        # a read is in progress (they're replaced when reading starts again)
+        self._read_state=(report_buffer,overlapped,overlap_completion)
+        self._reading=True
+        read()
+    
+    def _stop_reading(self):
+        # make sure we won't receive any more messages
+        self._reading=False
+        if self._device_handle:
+            Kernel32.CancelIo(self._device_handle)
+            # let the cancelled read complete
+            Kernel32.SleepEx(0,1)
+    
+    @classmethod
+    def _wait_for_reports(cls,devices,timeout):
+        # reads started on this thread complete while it sleeps
+        Kernel32.SleepEx(int(timeout*1000),1)
         
         
-def find_hid_devices():
+# the vendor and product ids in a device path, e.g. \\?\hid#vid_19bc&pid_0001#...
+_PATH_IDS=re.compile(b'vid_([0-9a-f]{4})&pid_([0-9a-f]{4})')
+
+def _path_ids(device_path):
+    '''(vendor,product) from a device path, or None if they're not in it'''
+    match=_PATH_IDS.search(device_path.lower())
+    if match is None:
+        return None
+    return int(match.group(1),16),int(match.group(2),16)
+
+def find_hid_devices(vendor=None,product=None):
     '''
-    query the host computer for all available HID devices
-    and returns a list of any found
+    query the host computer for all available HID devices (with the
+    vendor and product ids, if given) and returns a list of any found.
+    devices are only opened to read their ids if they're not in the path
     '''
     devices=[]
     hDevInfo=setupapi_dll.SetupDiGetClassDevsA(byref(HidGuid),None,None,DIGCF_PRESENT | DIGCF_DEVICEINTERFACE)
@@ -276,6 +310,13 @@ def find_hid_devices():
             
             if not setupapi_dll.SetupDiGetDeviceInterfaceDetailA(hDevInfo,byref(deviceInterface),byref(detailData),requiredSize,None,None):
                 raise RuntimeError(GetLastErrorMessage())
+            
+            ids=_path_ids(detailData.DevicePath)
+            if ids is not None:
+                device=Win32HIDDevice(detailData.DevicePath,ids[0],ids[1])
+                if device.matches(vendor,product):
+                    devices.append(device)
+                continue
 
             DeviceHandle=None
             try:
@@ -300,7 +341,8 @@ def find_hid_devices():
 
                     if result:
                         device=Win32HIDDevice(detailData.DevicePath,Attributes.VendorID,Attributes.ProductID)
-                        devices.append(device)
+                        if device.matches(vendor,product):
+                            devices.append(device)
                 else:
                     logging.info("failed to open device to read attributes")
 
@@ -5,6 +5,8 @@ the module for interfacing with an ioLan button box.
 USBBox is the main class that should be used from this module
 '''
 
+from __future__ import print_function
+
 __version__='3.2'
 
 # turn on logging so we can see what's going on
@@ -14,9 +16,20 @@ import logging
 
 import time
 import struct
-from Queue import Queue, Empty
+import pickle
+from collections import deque
+from threading import Lock, Event
+try:
+    from Queue import Empty
+except ImportError:
+    from queue import Empty # python 3
 import hid
 
+if hasattr(time,'perf_counter'):
+    _now=time.perf_counter
+else:
+    _now=time.time # python 2
+
 IO_LABS_VENDOR_ID=0x19BC
 BUTTON_BOX_PRODUCT_ID=0x0001
 
@@ -40,6 +53,44 @@ class dict_struct:
             attribs.append('%s=%r'%(key,value))
         return "dict_struct(%s)" % ','.join(attribs)
 
+class message_struct(object):
+    '''
+    base class for the compact classes created for each type of message
+    (see messages._create_message_class).  the name and id are stored on
+    the class and the fields of the message in __slots__, so instances
+    are much smaller than a dict_struct, but print the same way.
+    timestamp_ns is the host time the report was received (see
+    hid.host_ns), or None
+    '''
+    __slots__=('timestamp_ns',)
+    name=None
+    id=None
+    _fields=()
+    
+    def copy(self):
+        return self.__class__(self.timestamp_ns,self.id,*[getattr(self,field) for field in self._fields])
+    
+    def __reduce__(self):
+        # the classes can't be found by name, so they're found again (in
+        # COMMAND or REPORT) by _message_from_fields when unpickling
+        if _message_class(self.name,self.id) is not self.__class__:
+            raise pickle.PicklingError("can only pickle COMMAND and REPORT messages, not: %s" % self.name)
+        return (_message_from_fields,(self.name,self.timestamp_ns,self.id)+tuple([getattr(self,field) for field in self._fields]))
+    
+    def _items(self):
+        items=[('name',self.name),('id',self.id)]
+        for field in self._fields:
+            items.append((field,getattr(self,field)))
+        if self.timestamp_ns is not None:
+            items.append(('timestamp_ns',self.timestamp_ns))
+        return items
+    
+    def __str__(self):
+        return ','.join(['%s=%s'%item for item in self._items()])
+    
+    def __repr__(self):
+        return "dict_struct(%s)" % ','.join(['%s=%r'%item for item in self._items()])
+
 # commands in form id : ('name','pack format','field names')
 # formats ignore identity byte (it's assumed to always be there)
 # see "struct" module documentation for details of pack format strings
@@ -105,54 +156,108 @@ class messages:
     '''class to handle message id lookup, and packing message objects into binary'''
     def __init__(self,message_summaries):
         self.message_summaries=message_summaries
+        # parsers indexed by the id byte (None for unknown ids)
+        self._parsers=[None]*256
         for message_id,message_summary in message_summaries.items():
             # add field for the ID
             message_name=message_summary[0]
             self.__dict__[message_name]=message_id
             # add function to pack args
             self.__dict__[message_name.lower()]=self._create_packing_function(message_id,message_summary)
+            self._parsers[message_id]=self._create_parser(message_id,message_summary)
     
     def ALL_IDS(self):
         return self.message_summaries.keys()
     
-    def _create_packing_function(self,message_id,message_summary):
+    def _create_packing_function(self,message_id,message_summary,output=None):
+        '''
+        create a function that packs its arguments into the message.
+        if output is given the function passes the packed message to it
+        (e.g. to send it) and returns the result
+        '''
         # always big endian format
-        format='>B'+message_summary[1]
+        pack=struct.Struct('>B'+message_summary[1]).pack
         expected_args=message_summary[2]
-        def packing_function(*args):
+        def check_args(args):
+            # only called if packing failed, to give a better error
             if len(args) != len(expected_args):
                 raise RuntimeError("wrong number of args for: %s(), expected: %s" % (message_summary[0].lower(),expected_args))
-            return struct.pack(format,message_id,*args)
+        if output is None:
+            def packing_function(*args):
+                try:
+                    return pack(message_id,*args)
+                except struct.error:
+                    check_args(args)
+                    raise
+        else:
+            def packing_function(*args):
+                try:
+                    message_data=pack(message_id,*args)
+                except struct.error:
+                    check_args(args)
+                    raise
+                return output(message_data)
         return packing_function
     
+    def create_sender(self,message_id,output):
+        '''
+        create a function that packs its arguments into the given message
+        and passes the result to output
+        '''
+        return self._create_packing_function(message_id,self.message_summaries[message_id],output)
+    
     def name_from_id(self,message_id):
         '''
         get the 'name' from the id of the message
         '''
         return self.message_summaries[message_id][0]
     
-    def parse(self,message_data):
+    def _create_message_class(self,message_id,message_summary):
+        '''
+        create a class with a slot for each field of the message.
+        it's __init__ takes the timestamp then the values in the order they
+        are unpacked (so starting with the id byte)
+        '''
+        name,format,field_names=message_summary
+        args=''.join([','+field for field in field_names])
+        source='def __init__(self,timestamp_ns,id%s):\n' % args
+        for field in field_names:
+            source+='    self.%s=%s\n' % (field,field)
+        source+='    self.timestamp_ns=timestamp_ns\n'
+        namespace={}
+        exec(source,namespace)
+        return type(name,(message_struct,),{
+            '__slots__':field_names,
+            '__init__':namespace['__init__'],
+            '__module__':__name__,
+            'name':name,
+            'id':message_id,
+            '_fields':field_names,
+        })
+    
+    def _create_parser(self,message_id,message_summary):
+        '''precompile the struct used to unpack a message (including the id byte)'''
+        unpacker=struct.Struct('>B'+message_summary[1])
+        # check now, rather than every time a message is unpacked
+        if len(message_summary[2])+1 != len(unpacker.unpack(b'\0'*unpacker.size)):
+            raise RuntimeError("format does not match fields for: %s" % message_summary[0])
+        return (unpacker.unpack,self._create_message_class(message_id,message_summary))
+    
+    def parse(self,message_data,timestamp_ns=None):
         '''
-        convert raw binary data into a structure
+        convert raw binary data into a structure.  timestamp_ns is the
+        host time it was received, if known
         '''
-        id_byte=struct.unpack('B',message_data[0])[0]
+        id_byte=ord(message_data[:1]) # bytes or str
         # see if we know how to parse this message
-        if self.message_summaries.has_key(id_byte):
-            summary=self.message_summaries[id_byte]
-        
-            format='>B'+summary[1]
-            unpacked=struct.unpack(format,message_data)
-            msg_fields={'name':summary[0]}
-            field_names=('id',)+summary[2]
-            if len(field_names) != len(unpacked):
-                raise RuntimeError("message did not unpack correctly: %r"%message_data)
-            for name,value in zip(field_names,unpacked):
-                msg_fields[name]=value
-            return dict_struct(**msg_fields)
+        parser=self._parsers[id_byte]
+        if parser is not None:
+            unpack,message_class=parser
+            return message_class(timestamp_ns,*unpack(message_data))
         else:
             # otherwise just return it in a raw format
             logging.info("unknown message id: %d",id_byte)
-            return dict_struct(id=id_byte,message_data=message_data)
+            return dict_struct(id=id_byte,message_data=message_data,timestamp_ns=timestamp_ns)
 
 #################################
 # objects for accessing commands and reports
@@ -161,6 +266,574 @@ class messages:
 COMMAND=messages(COMMAND_SUMMARY)
 REPORT=messages(REPORT_SUMMARY)
 
+def _message_class(name,message_id):
+    '''the class of COMMAND or REPORT messages with the given name and id (None if there isn't one)'''
+    for message_types in (COMMAND,REPORT):
+        parser=message_types._parsers[message_id]
+        if parser is not None and parser[1].name == name:
+            return parser[1]
+    return None
+
+def _message_from_fields(name,timestamp_ns,message_id,*fields):
+    '''unpickles a message_struct'''
+    return _message_class(name,message_id)(timestamp_ns,message_id,*fields)
+
+# what a ReportQueue does with a report when it is full
+DROP_OLDEST='drop-oldest'
+DROP_NEWEST='drop-newest'
+
+class _Droppable(object):
+    '''
+    holds a report with an id in ReportQueue.drop_ids while it's on the
+    queue.  dropping it to make room just empties the holder, so it
+    doesn't have to be found and taken out of the middle of the queue
+    '''
+    __slots__=('report',)
+    
+    def __init__(self,report):
+        self.report=report
+
+class ReportQueue(object):
+    '''
+    bounded queue for received reports.
+    reports are put on by the device thread without taking a lock (deque
+    appends and pops are thread-safe), the lock is only needed when the queue
+    is full or a reader has to wait.  when full, any queued reports with
+    an id in drop_ids (e.g. REPORT.HBREP) are dropped first, then the
+    overflow policy decides whether to drop the oldest report on the queue
+    or the new one.  dropped reports are counted by id in 'dropped'.
+    can be used in place of a Queue.Queue
+    '''
+    def __init__(self,capacity=65536,overflow=DROP_OLDEST,drop_ids=()):
+        if overflow not in (DROP_OLDEST,DROP_NEWEST):
+            raise ValueError("unknown overflow policy: %r" % overflow)
+        self.capacity=capacity
+        self.overflow=overflow
+        self.drop_ids=frozenset(drop_ids)
+        self.dropped={}
+        self._reports=deque()
+        # the _Droppables on _reports still holding a report, oldest first
+        self._droppable=deque()
+        # number of emptied _Droppables still on _reports
+        self._emptied=0
+        self._lock=Lock()
+        self._not_empty=Event()
+        self._waiting=0
+    
+    def __len__(self):
+        return len(self._reports)-self._emptied
+    
+    def qsize(self):
+        return len(self._reports)-self._emptied
+    
+    def empty(self):
+        return len(self._reports) <= self._emptied
+    
+    def _get_dropped_total(self):
+        return sum(self.dropped.values())
+    dropped_total=property(_get_dropped_total)
+    '''total number of reports dropped'''
+    
+    def put(self,report,block=True,timeout=None):
+        '''add a report (never blocks - block and timeout are ignored)'''
+        reports=self._reports
+        if len(reports)-self._emptied >= self.capacity and not self._make_room(report):
+            return
+        if self.drop_ids and report.id in self.drop_ids:
+            self._put_droppable(report)
+        else:
+            reports.append(report)
+        if self._waiting:
+            self._not_empty.set()
+    
+    def _put_droppable(self,report):
+        droppable=_Droppable(report)
+        self._lock.acquire()
+        try:
+            self._droppable.append(droppable)
+            self._reports.append(droppable)
+        finally:
+            self._lock.release()
+    
+    def _take(self,droppable):
+        '''
+        the report held by a _Droppable just taken off the queue, None if
+        it was dropped to make room
+        '''
+        self._lock.acquire()
+        try:
+            report=droppable.report
+            if report is None:
+                self._emptied-=1
+            else:
+                # (nearly always the first)
+                self._droppable.remove(droppable)
+            return report
+        finally:
+            self._lock.release()
+    
+    def _drop(self,report):
+        self.dropped[report.id]=self.dropped.get(report.id,0)+1
+    
+    def _make_room(self,report):
+        '''drop reports to make room, returns False if report should be dropped instead'''
+        self._lock.acquire()
+        try:
+            reports=self._reports
+            while len(reports)-self._emptied >= self.capacity:
+                if report.id in self.drop_ids:
+                    self._drop(report)
+                    return False
+                if self._droppable:
+                    droppable=self._droppable.popleft()
+                    self._drop(droppable.report)
+                    droppable.report=None
+                    self._emptied+=1
+                    continue
+                if self.overflow == DROP_NEWEST:
+                    self._drop(report)
+                    return False
+                try:
+                    queued=reports.popleft()
+                except IndexError:
+                    continue
+                if queued.__class__ is _Droppable:
+                    # nothing is held by the _Droppables left on the queue
+                    self._emptied-=1
+                else:
+                    self._drop(queued)
+            return True
+        finally:
+            self._lock.release()
+    
+    def _pop(self):
+        '''remove and return the oldest report, raises IndexError if there are none'''
+        popleft=self._reports.popleft
+        while True:
+            report=popleft()
+            if report.__class__ is not _Droppable:
+                return report
+            report=self._take(report)
+            if report is not None:
+                return report
+    
+    def get(self,block=True,timeout=None):
+        '''
+        remove and return the oldest report.  raises Queue.Empty if there
+        are no reports (after waiting up to timeout seconds if block is set)
+        '''
+        try:
+            return self._pop()
+        except IndexError:
+            if not block:
+                raise Empty
+        
+        if timeout is not None:
+            end_time=time.time()+timeout
+        self._lock.acquire()
+        self._waiting+=1
+        self._lock.release()
+        try:
+            while True:
+                self._not_empty.clear()
+                # check again, now the put() will signal us
+                try:
+                    return self._pop()
+                except IndexError:
+                    pass
+                if timeout is None:
+                    self._not_empty.wait()
+                else:
+                    remaining=end_time-time.time()
+                    if remaining <= 0:
+                        raise Empty
+                    self._not_empty.wait(remaining)
+        finally:
+            self._lock.acquire()
+            self._waiting-=1
+            self._lock.release()
+    
+    def get_nowait(self):
+        return self.get(False)
+    
+    def drain(self):
+        '''remove and return all the reports on the queue as a list'''
+        popleft=self._reports.popleft
+        reports=[]
+        try:
+            while True:
+                report=popleft()
+                if report.__class__ is _Droppable:
+                    report=self._take(report)
+                    if report is None:
+                        continue
+                reports.append(report)
+        except IndexError:
+            return reports
+
+class ReportFuture(object):
+    '''
+    the reply to a command sent with Commands.submit.  filled in by the
+    thread receiving reports from the device, result() waits for it
+    '''
+    def __init__(self,report_id,match=None):
+        self.report_id=report_id
+        self.match=match
+        self._report=None
+        self._done=Event()
+        self._cancelled=False
+        self._callbacks=[]
+        self._lock=Lock()
+    
+    def accepts(self,report):
+        '''whether report is a reply to this request'''
+        return self.match is None or self.match(report)
+    
+    def done(self):
+        '''true once the reply has arrived (or the request was cancelled)'''
+        return self._done.is_set()
+    
+    def cancelled(self):
+        return self._cancelled
+    
+    def result(self,timeout=None):
+        '''
+        wait up to timeout seconds (forever if None) for the reply and
+        return it.  returns None if it did not arrive in time
+        '''
+        self._done.wait(timeout)
+        return self._report
+    
+    def add_done_callback(self,callback):
+        '''
+        call callback with this future once the reply arrives. note that
+        this happens on the thread receiving reports, not the caller's
+        '''
+        self._lock.acquire()
+        try:
+            if not self._done.is_set():
+                self._callbacks.append(callback)
+                return
+        finally:
+            self._lock.release()
+        callback(self)
+    
+    def _set_result(self,report):
+        self._report=report
+        self._finish()
+    
+    def _cancel(self):
+        self._cancelled=True
+        self._finish()
+    
+    def _finish(self):
+        self._lock.acquire()
+        try:
+            self._done.set()
+            callbacks,self._callbacks=self._callbacks,[]
+        finally:
+            self._lock.release()
+        for callback in callbacks:
+            callback(self)
+
+class Transaction(object):
+    '''
+    a batch of commands that are written to the box back to back, with the
+    replies collected in one pass at the end (rather than waiting for each
+    reply before sending the next command).  get one from
+    Commands.transaction(), e.g.
+    
+        transaction=commands.transaction()
+        transaction.add(COMMAND.DEBGET,REPORT.DEBREP)
+        transaction.add(COMMAND.HBSET,None,1000)
+        transaction.add(COMMAND.MSKGET,REPORT.MSKREP)
+        debounce,nothing,mask=transaction.run()
+    '''
+    max_in_flight=16
+    '''most commands sent before their replies start being collected'''
+    
+    def __init__(self,commands):
+        self._commands=commands
+        self._requests=[]
+    
+    def __len__(self):
+        return len(self._requests)
+    
+    def add(self,command_id,report_id,*args):
+        '''
+        add a command to the transaction.  report_id is the reply to wait
+        for, or None for commands the box does not reply to
+        '''
+        self._requests.append((command_id,report_id,args))
+    
+    def run(self):
+        '''
+        send the commands and return a list of the replies in the same
+        order (None for commands without a reply, or if one did not
+        arrive).  the transaction is empty again afterwards
+        '''
+        requests,self._requests=self._requests,[]
+        commands=self._commands
+        timeout=commands.reply_timeout
+        futures=[]
+        in_flight=deque()
+        for command_id,report_id,args in requests:
+            if report_id is None:
+                commands._senders[command_id](*args)
+                futures.append(None)
+                continue
+            if len(in_flight) >= self.max_in_flight:
+                in_flight.popleft().result(timeout)
+            future=commands.submit(command_id,report_id,*args)
+            in_flight.append(future)
+            futures.append(future)
+        
+        replies=[]
+        for future in futures:
+            if future is None:
+                replies.append(None)
+                continue
+            report=future.result(timeout)
+            if report is None:
+                if commands.cancel(future):
+                    # the box isn't answering, so don't wait for the rest
+                    timeout=0
+                report=future.result(0)
+            replies.append(report)
+        return replies
+
+# registers ShadowRegisters keeps a copy of: get command -> reply
+_SHADOW_GETS={
+    COMMAND.DIRGET:REPORT.DIRREP,
+    COMMAND.LOGGET:REPORT.LOGREP,
+    COMMAND.MSKGET:REPORT.MSKREP,
+    COMMAND.DEBGET:REPORT.DEBREP,
+    COMMAND.VCKGET:REPORT.VCKREP,
+    COMMAND.PXGET:REPORT.PXREP,
+}
+
+_SHADOW_OPS={
+    'set':lambda old,new: new,
+    'and':lambda old,new: old & new,
+    'or':lambda old,new: old | new,
+    'xor':lambda old,new: old ^ new,
+}
+
+# how the set commands change the registers:
+# set command -> (reply,fields set by the command's arguments,operation)
+_SHADOW_SETS={
+    COMMAND.DIRSET:(REPORT.DIRREP,('port2_mode','port2_bits','port0_bits'),'set'),
+    COMMAND.LOGSET:(REPORT.LOGREP,('port2_bits','port0_bits'),'set'),
+    COMMAND.MSKSET:(REPORT.MSKREP,('port3_bits','port1_bits'),'set'),
+    COMMAND.DEBSET:(REPORT.DEBREP,('port1_down','port1_up','int0_down','int0_up','int1_down','int1_up'),'set'),
+}
+for _op,_suffix in [('set','SET'),('and','AND'),('or','_OR'),('xor','XOR')]:
+    _SHADOW_SETS[getattr(COMMAND,'P0'+_suffix)]=(REPORT.PXREP,('port0_bits',),_op)
+    _SHADOW_SETS[getattr(COMMAND,'P2'+_suffix)]=(REPORT.PXREP,('port2_bits',),_op)
+    _SHADOW_SETS[getattr(COMMAND,'PX'+_suffix)]=(REPORT.PXREP,('port2_bits','port0_bits'),_op)
+del _op,_suffix
+
+# voice key replies that mean the values are valid
+_VCK_OK=(0x58,0x28)
+
+class ShadowRegisters(object):
+    '''
+    local copy of the box's settings - direction, logic, masks, debounce,
+    voice key and port state - kept up to date from the commands sent to
+    the box and the reports it sends back.  given to Commands (see the
+    shadow argument of USBBox) it answers get commands without asking the
+    box and skips set commands that would not change anything.
+    
+    nothing is known until the box has been asked (or told) each value.
+    the port state is only kept while loopback is known to be off, and
+    the peak_level of a voice key report is whatever it was when the
+    report arrived.  call invalidate() if the box may have been changed
+    some other way (e.g. it was unplugged or another program used it)
+    '''
+    def __init__(self):
+        self._reports={} # reply id -> last known reply
+        self._lock=Lock()
+    
+    def invalidate(self,report_id=None):
+        '''forget the value of one register (given its reply id), or all of them'''
+        self._lock.acquire()
+        try:
+            if report_id is None:
+                self._reports.clear()
+            else:
+                self._reports.pop(report_id,None)
+        finally:
+            self._lock.release()
+    
+    def get(self,report_id):
+        '''a copy of the last known reply for a register, or None'''
+        self._lock.acquire()
+        try:
+            report=self._reports.get(report_id)
+        finally:
+            self._lock.release()
+        if report is not None:
+            return report.copy()
+        return None
+    
+    def _loopback_off(self):
+        dirrep=self._reports.get(REPORT.DIRREP)
+        return dirrep is not None and dirrep.port2_mode == 0
+    
+    def _store(self,report):
+        if report.id == REPORT.DIRREP and report.port2_mode != 0:
+            # in loopback the leds follow the buttons
+            self._reports.pop(REPORT.PXREP,None)
+        elif report.id == REPORT.PXREP and not self._loopback_off():
+            return
+        self._reports[report.id]=report
+    
+    def _updated(self,command_id,args):
+        '''
+        (reply,changed) for the register after the command, reply is None
+        if the value can't be worked out
+        '''
+        report_id,fields,op=_SHADOW_SETS[command_id]
+        report=self._reports.get(report_id)
+        if report is None:
+            report_fields=REPORT_SUMMARY[report_id][2]
+            if op != 'set' or [field for field in report_fields if field not in fields] not in ([],['rtc']):
+                return None,True
+            # every field (bar the rtc) is being set
+            values=dict(zip(fields,args))
+            pack=getattr(REPORT,REPORT.name_from_id(report_id).lower())
+            return REPORT.parse(pack(*[values.get(field,0) for field in report_fields])),True
+        report=report.copy()
+        combine=_SHADOW_OPS[op]
+        changed=False
+        for field,value in zip(fields,args):
+            old=getattr(report,field)
+            new=combine(old,value)
+            if new != old:
+                setattr(report,field,new)
+                changed=True
+        return report,changed
+    
+    def command_sent(self,command_id,args):
+        '''update the registers for a command about to be sent to the box'''
+        if command_id not in _SHADOW_SETS:
+            return
+        self._lock.acquire()
+        try:
+            report,changed=self._updated(command_id,args)
+            if report is None:
+                self._reports.pop(_SHADOW_SETS[command_id][0],None)
+            elif changed:
+                self._store(report)
+        finally:
+            self._lock.release()
+    
+    def report_received(self,report):
+        '''update the registers from a report sent by the box'''
+        if report.id not in _SHADOWED_REPORTS:
+            return
+        if report.id == REPORT.VCKREP and report.status_code not in _VCK_OK:
+            return
+        self._lock.acquire()
+        try:
+            self._store(report)
+        finally:
+            self._lock.release()
+    
+    def cached_reply(self,command_id,args):
+        '''
+        the reply the box would send to a command, if it's a get command
+        for a known register, or a set command that won't change anything.
+        otherwise None
+        '''
+        report_id=_SHADOW_GETS.get(command_id)
+        self._lock.acquire()
+        try:
+            if report_id is not None:
+                report=self._reports.get(report_id)
+            elif command_id in _SHADOW_SETS and self._reports.get(_SHADOW_SETS[command_id][0]):
+                report,changed=self._updated(command_id,args)
+                if changed:
+                    return None
+            else:
+                return None
+        finally:
+            self._lock.release()
+        if report is not None:
+            return report.copy()
+        return None
+    
+    def watch(self,command_id,sender):
+        '''wrap the function sending a command, so the registers follow it'''
+        if command_id not in _SHADOW_SETS:
+            return sender
+        command_sent=self.command_sent
+        def send(*args):
+            command_sent(command_id,args)
+            try:
+                sender(*args)
+            except:
+                # don't know whether it got to the box or not
+                self.invalidate(_SHADOW_SETS[command_id][0])
+                raise
+        return send
+
+_SHADOWED_REPORTS=frozenset(_SHADOW_GETS.values())
+
+
+class DispatchTiming(object):
+    '''
+    time spent handling received reports on the device's thread, by stage
+    (set Commands.timing to one to collect them):
+    
+    * parse - REPORT.parse
+    * match - raw callbacks (e.g. recording), updating the shadow and
+      handing replies to requests
+    * queue - putting the report on the queue
+    * callbacks - calling the callbacks of directly dispatched reports
+    * total - from the report arriving to it being queued or dispatched
+    
+    and, on the thread calling process_received_reports
+    
+    * queued - from the report arriving to its callbacks being called
+    
+    times are in seconds
+    '''
+    STAGES=('parse','match','queue','callbacks','total','queued')
+    
+    def __init__(self):
+        self.reset()
+    
+    def reset(self):
+        self.count=dict((stage,0) for stage in self.STAGES)
+        self.total=dict((stage,0.0) for stage in self.STAGES)
+        self.max=dict((stage,0.0) for stage in self.STAGES)
+    
+    def add(self,stage,seconds):
+        self.count[stage]+=1
+        self.total[stage]+=seconds
+        if seconds > self.max[stage]:
+            self.max[stage]=seconds
+    
+    def mean(self,stage):
+        '''mean time taken by stage (None if it hasn't happened)'''
+        if not self.count[stage]:
+            return None
+        return self.total[stage]/self.count[stage]
+    
+    def summary(self):
+        '''dictionary of stage -> (count,mean,max)'''
+        return dict((stage,(self.count[stage],self.mean(stage),self.max[stage]))
+                    for stage in self.STAGES)
+    
+    def __str__(self):
+        lines=[]
+        for stage in self.STAGES:
+            if self.count[stage]:
+                lines.append('%-9s n=%d mean=%.1fus max=%.1fus' % (
+                    stage,self.count[stage],self.mean(stage)*1e6,self.max[stage]*1e6))
+        return '\n'.join(lines)
+
 class Commands:
     '''
     class to handle sending reports to device and parsing incoming reports.
@@ -169,19 +842,148 @@ class Commands:
     to make things friendlier when appropriate.
     all received messages are queued up and require a call to 'process_received_reports'
     to trigger the user's callbacks, so as to avoid thread issues.
+    the queue is a ReportQueue, one with a different capacity or overflow
+    policy can be passed in.
+    replies to commands sent with submit (or send_wait_reply) are matched
+    to the request as they arrive, on the device's thread, and never go on
+    the queue.  replies are matched in the order the commands were sent, so
+    several requests (from any number of threads) can be in flight at once.
+    if a ShadowRegisters is given commands are answered from it when they
+    can be, without going to the box.
+    the callbacks for report ids passed to dispatch_directly are instead
+    called straight away on the device's thread, without waiting for
+    process_received_reports (so they must be quick and thread-safe).
     '''
-    def __init__(self,device):
+    reply_timeout=2
+    '''seconds send_wait_reply waits for a reply'''
+    
+    def __init__(self,device,queue=None,shadow=None):
         self.device=device
         self.callbacks={}
         self.default_callbacks=set()
-        self.queue=Queue()
+        if queue is None:
+            # drop heartbeats before anything else if the queue fills up
+            queue=ReportQueue(drop_ids=(REPORT.HBREP,))
+        self.queue=queue
+        self.shadow=shadow
+        # ids of the reports whose callbacks are called on the device's thread
+        self.direct_ids=frozenset()
+        # a DispatchTiming to record how long receiving reports takes
+        self.timing=None
+        # functions called with every report received (see add_raw_callback)
+        self.raw_callbacks=()
+        # requests waiting for a reply: report id -> deque of ReportFutures
+        self._pending={}
+        self._pending_lock=Lock()
+        # create a function to send each command up front, so sending
+        # does not have to go through __getattr__
+        self._senders={}
+        for command_id in COMMAND.ALL_IDS():
+            sender=COMMAND.create_sender(command_id,self.device.set_report)
+            if shadow is not None:
+                sender=shadow.watch(command_id,sender)
+            self._senders[command_id]=sender
+            self.__dict__[COMMAND.name_from_id(command_id).lower()]=sender
+        # requests whose commands were sent with SharedHIDDevice.send_expecting
+        # (None if the device isn't shared)
+        self._expecting=None
+        if isinstance(device,hid.SharedHIDDevice):
+            self._expecting=set()
         self.device.set_interrupt_report_callback(self._report_received)
     
     def _report_received(self,device,report_data):
+        timing=self.timing
+        if timing is not None:
+            start=_now()
         logging.info('%r',report_data)
-        msg=REPORT.parse(report_data)
+        msg=REPORT.parse(report_data,device.report_timestamp_ns)
         logging.info('received msg: %r',msg)
-        self.queue.put(msg)
+        if timing is not None:
+            parsed=_now()
+            timing.add('parse',parsed-start)
+        for callback in self.raw_callbacks:
+            try:
+                callback(report_data,msg)
+            except Exception:
+                # don't let it stop the report being received
+                logging.exception('error in raw callback for %r',msg)
+        if self.shadow is not None:
+            self.shadow.report_received(msg)
+        claimed=self._pending.get(msg.id) and self._claim(msg)
+        if timing is not None:
+            matched=_now()
+            timing.add('match',matched-parsed)
+        if not claimed:
+            if msg.id in self.direct_ids:
+                self._dispatch(msg)
+                stage='callbacks'
+            else:
+                self.queue.put(msg)
+                stage='queue'
+            if timing is not None:
+                timing.add(stage,_now()-matched)
+        if timing is not None:
+            timing.add('total',_now()-start)
+    
+    def _dispatch(self,report):
+        '''call the callbacks for report on the device's thread'''
+        # copy the callbacks, as they may be changed on another thread
+        for callback in tuple(self.callbacks.get(report.id,self.default_callbacks)):
+            try:
+                callback(report)
+            except Exception:
+                # don't let it stop the device's thread
+                logging.exception('error in callback for %r',report)
+    
+    def add_raw_callback(self,callback):
+        '''
+        add a function that is called with the data and the parsed report
+        for every report received, before it is matched to a request or
+        queued.  it is called on the device's thread (so must not block)
+        '''
+        self.raw_callbacks=self.raw_callbacks+(callback,)
+    
+    def remove_raw_callback(self,callback):
+        self.raw_callbacks=tuple([raw_callback for raw_callback in self.raw_callbacks
+                                  if raw_callback != callback])
+    
+    def dispatch_directly(self,*report_ids):
+        '''
+        call the callbacks for reports with these ids as soon as they
+        arrive, on the device's thread, instead of putting the reports on
+        the queue for process_received_reports
+        '''
+        self.direct_ids=self.direct_ids.union(report_ids)
+    
+    def dispatch_queued(self,*report_ids):
+        '''
+        go back to putting reports with these ids (all of them if none
+        are given) on the queue
+        '''
+        if report_ids:
+            self.direct_ids=self.direct_ids.difference(report_ids)
+        else:
+            self.direct_ids=frozenset()
+    
+    def _claim(self,report):
+        '''give report to the oldest request waiting for it, if any'''
+        self._pending_lock.acquire()
+        try:
+            waiting=self._pending.get(report.id)
+            if not waiting:
+                return False
+            for future in waiting:
+                if future.accepts(report):
+                    waiting.remove(future)
+                    break
+            else:
+                return False
+            if self._expecting:
+                self._expecting.discard(future)
+        finally:
+            self._pending_lock.release()
+        future._set_result(report)
+        return True
     
     def process_received_reports(self,block=False,timeout=10):
         '''
@@ -199,6 +1001,9 @@ class Commands:
             block=False 
     
     def _process_report(self,report):
+        timing=self.timing
+        if timing is not None and report.timestamp_ns is not None:
+            timing.add('queued',(hid.host_ns()-report.timestamp_ns)/1e9)
         callbacks=self.callbacks.get(report.id,self.default_callbacks)
         for callback in callbacks:
             callback(report)
@@ -207,16 +1012,11 @@ class Commands:
         '''
         return a list of received reports (removes them from the queue)
         '''
-        reports=[]
-        while not self.queue.empty():
-            msg=self.queue.get()
-            reports.append(msg)
-        return reports
+        return self.queue.drain()
     
     def clear_received_reports(self):
         '''remove all received reports from the queue'''
-        while not self.queue.empty():
-            self.queue.get()
+        self.queue.drain()
     
     def add_callback(self,report_id,report_callback):
         '''
@@ -264,13 +1064,97 @@ class Commands:
         # return the report we received
         return reports[0]
     
+    def submit(self,command_id,report_id,*args,**kw):
+        '''
+        send a command with the given arguments and return a ReportFuture
+        for the reply: the next report with report_id that no earlier
+        request is waiting for.  pass match=function to only accept
+        reports the function returns true for
+        '''
+        future=ReportFuture(report_id,kw.get('match'))
+        if self.shadow is not None:
+            report=self.shadow.cached_reply(command_id,args)
+            if report is not None and report.id == report_id and future.accepts(report):
+                future._set_result(report)
+                return future
+        self._wait_for(future,self._senders[command_id],args)
+        return future
+    
+    def expect(self,report_id,match=None):
+        '''
+        return a ReportFuture for the next report with report_id (that
+        match returns true for, if given) without sending anything, e.g.
+        for the next KEYDN.  the report won't go on the queue
+        '''
+        future=ReportFuture(report_id,match)
+        self._wait_for(future)
+        return future
+    
+    def _wait_for(self,future,send=None,args=()):
+        '''add future to those waiting for a report, then call send(*args)'''
+        # hold the lock while sending so replies are matched in the
+        # same order the commands go out
+        self._pending_lock.acquire()
+        try:
+            waiting=self._pending.get(future.report_id)
+            if waiting is None:
+                waiting=self._pending[future.report_id]=deque()
+            waiting.append(future)
+            if send is not None:
+                try:
+                    if self._expecting is None:
+                        send(*args)
+                    else:
+                        # so the reply isn't given to the device's other owners
+                        self.device.send_expecting(future.report_id,send,*args)
+                        self._expecting.add(future)
+                except:
+                    waiting.remove(future)
+                    raise
+        finally:
+            self._pending_lock.release()
+    
+    def cancel(self,future):
+        '''
+        stop waiting for the reply to a request, returns False if the
+        reply had already arrived
+        '''
+        self._pending_lock.acquire()
+        try:
+            try:
+                self._pending[future.report_id].remove(future)
+            except (KeyError,ValueError):
+                return False
+            if self._expecting is not None and future in self._expecting:
+                self._expecting.discard(future)
+                self.device.cancel_expected(future.report_id)
+        finally:
+            self._pending_lock.release()
+        future._cancel()
+        return True
+    
+    def transaction(self):
+        '''return a new Transaction, for sending a batch of commands'''
+        return Transaction(self)
+    
+    def wait_for_reply(self,future):
+        '''
+        wait up to reply_timeout seconds for the reply to a request made
+        with submit and return it, or None if it did not arrive
+        (user callbacks are not called while waiting)
+        '''
+        report=future.result(self.reply_timeout)
+        if report is None:
+            self.cancel(future)
+            report=future.result(0) # in case it arrived just now
+        return report
+    
     def send_wait_reply(self,command_id,report_id,*args):
         '''
         send a command with the given arguments and wait for the reply
+        (see wait_for_reply)
         '''
-        command_name=COMMAND.name_from_id(command_id).lower()
-        getattr(self,command_name)(*args) # send the command
-        return self.wait_for_report(report_id)
+        return self.wait_for_reply(self.submit(command_id,report_id,*args))
     
     def send_wait_field(self,command_id,report_id,field_name,*args):
         '''
@@ -307,6 +1191,59 @@ class Line(object):
             return bits & (self._mask ^ 0xFF)
 
 
+class PortLine(Line):
+    '''a single line of port 0 or 2'''
+    # state property
+    def _get_state(self):
+        return self._bit_state(self._port.state)
+    
+    def _set_state(self,high):
+        if high:
+            self._port.or_state(self._mask)
+        else:
+            self._port.and_state(self._mask ^ 0xFF) # invert mask
+    
+    state=property(_get_state,_set_state)
+    
+    # direction property
+    def _get_direction(self):
+        return self._bit_state(self._port.direction)
+    
+    def _set_direction(self,high):
+        self._port._update(COMMAND.DIRGET,lambda bits: self._set_bit_state(bits,high))
+    
+    direction=property(_get_direction,_set_direction)
+    
+    # logic property
+    def _get_logic(self):
+        return self._bit_state(self._port.logic)
+    
+    def _set_logic(self,high):
+        self._port._update(COMMAND.LOGGET,lambda bits: self._set_bit_state(bits,high))
+    
+    logic=property(_get_logic,_set_logic)
+
+
+class ButtonLine(Line):
+    '''a single button'''
+    # state property
+    def _get_state(self):
+        return self._bit_state(self._port.state)
+    
+    state=property(_get_state)
+    '''state of the line'''
+    
+    # enabled property
+    def _get_enabled(self):
+        return self._bit_state(self._port.enabled)
+    
+    def _set_enabled(self,high):
+        self._port._update_enabled(lambda bits: self._set_bit_state(bits,high))
+    
+    enabled=property(_get_enabled,_set_enabled)
+    '''get/set whether the line/button is enable or not'''
+
+
 class Port0_2(object):
     '''
     class representing ports 0 and 2 (leds)
@@ -315,18 +1252,25 @@ class Port0_2(object):
         self._commands=commands
         self._port_num=port_num
         self._port_bits='port%d_bits'%port_num
+        # commands for this port (e.g. P0SET or P2SET)
+        self._port_set=getattr(COMMAND,'P%dSET'%port_num)
+        self._port_and=getattr(COMMAND,'P%dAND'%port_num)
+        self._port_or=getattr(COMMAND,'P%d_OR'%port_num)
+        self._port_xor=getattr(COMMAND,'P%dXOR'%port_num)
+        self._lines=tuple([PortLine(self,1<<line_no) for line_no in range(8)])
     
     
     # direction property
     def _get_direction(self):
         return self._commands.send_wait_field(COMMAND.DIRGET,REPORT.DIRREP,self._port_bits)
     
+    def _update(self,get_command,bits):
+        '''change this port's bits in a register (see _read_modify_write)'''
+        _read_modify_write(self._commands,[(get_command,self._port_bits,bits)])
+    
     def _set_direction(self,bits):
-        # get original state
-        rep=self._commands.send_wait_reply(COMMAND.DIRGET,REPORT.DIRREP)
-        setattr(rep,self._port_bits,bits) # update bits for this port
-        # send set command and wait for reply
-        self._commands.send_wait_reply(COMMAND.DIRSET,REPORT.DIRREP,0,rep.port2_bits,rep.port0_bits)
+        # get original state, update bits for this port and set it again
+        self._update(COMMAND.DIRGET,bits)
     
     direction=property(_get_direction,_set_direction)
     '''get/set the direction of the port'''
@@ -336,9 +1280,7 @@ class Port0_2(object):
         return self._commands.send_wait_field(COMMAND.LOGGET,REPORT.LOGREP,self._port_bits)
         
     def _set_logic(self,bits):
-        rep=self._commands.send_wait_reply(COMMAND.LOGGET,REPORT.LOGREP)
-        setattr(rep,self._port_bits,bits)
-        self._commands.send_wait_reply(COMMAND.LOGSET,REPORT.LOGREP,rep.port2_bits,rep.port0_bits)
+        self._update(COMMAND.LOGGET,bits)
     
     logic=property(_get_logic,_set_logic)
     '''get/set the logic on the port'''
@@ -348,86 +1290,62 @@ class Port0_2(object):
         return self._commands.send_wait_field(COMMAND.PXGET,REPORT.PXREP,self._port_bits)
     
     def _set_state(self,bits):
-        port_set=getattr(self._commands,'p%dset'%self._port_num)
-        port_set(bits) # either p0set or p2set
-        # then wait for reply (to avoid messing things up)
-        self._commands.wait_for_report(REPORT.PXREP)
+        # either p0set or p2set, then wait for reply (to avoid messing things up)
+        self._commands.send_wait_reply(self._port_set,REPORT.PXREP,bits)
     
     state=property(_get_state,_set_state)
     '''get/set the port state'''
     
     
     # logic methods (and/or/xor)
-    def _logic_state(self,logic_bits,command_format):
-        port_logic=getattr(self._commands,command_format%self._port_num)
-        port_logic(logic_bits)
-        return getattr(self._commands.wait_for_report(REPORT.PXREP),self._port_bits)
+    def _logic_state(self,logic_bits,port_logic):
+        return self._commands.send_wait_field(port_logic,REPORT.PXREP,self._port_bits,logic_bits)
         
     def and_state(self,and_bits):
         '''logically 'and' the value on the port, returns the port state'''
-        return self._logic_state(and_bits,'p%dand')
+        return self._logic_state(and_bits,self._port_and)
     
     def or_state(self,or_bits):
         '''logically 'or' the value on the port, returns the port state'''
-        return self._logic_state(or_bits,'p%d_or')
+        return self._logic_state(or_bits,self._port_or)
     
     def xor_state(self,xor_bits):
         '''logically 'xor' the value on the port, returns the port state'''
-        return self._logic_state(xor_bits,'p%dxor')
+        return self._logic_state(xor_bits,self._port_xor)
     
     def _get_line(self,line_no):
         '''
         return an object that let's the user modify/query values
         on a single line of the port (1-bit)
         '''
-        #inner class for individual lines
-        class PortLine(Line):            
-            # state property
-            def _get_state(self):
-                return self._bit_state(self._port.state)
-            
-            def _set_state(self,high):
-                if high:
-                    self._port.or_state(self._mask)
-                else:
-                    self._port.and_state(self._mask ^ 0xFF) # invert mask
-            
-            state=property(_get_state,_set_state)
-            
-            # direction property
-            def _get_direction(self):
-                return self._bit_state(self._port.direction)
-            
-            def _set_direction(self,high):
-                self._port.direction=self._set_bit_state(self._port.direction,high)
-            
-            direction=property(_get_direction,_set_direction)
-            
-            # logic property
-            def _get_logic(self):
-                return self._bit_state(self._port.logic)
-            
-            def _set_logic(self,high):
-                self._port.logic=self._set_bit_state(self._port.logic,high)
-            
-            logic=property(_get_logic,_set_logic)
-        
-        mask=1<<line_no
-        # return new PortLine object
-        return PortLine(self,mask)
+        return self._lines[line_no]
+    
+    def set_lines(self,lines):
+        '''
+        change the state of several lines at once with a single write (so
+        they all change together).  lines is either a dict of line number to
+        state, or a sequence of states for lines 0 upwards (e.g. a list of
+        bits or a numpy bool array) where None leaves the line alone.  if
+        some lines go high and others low the port is read first, unless
+        its state is shadowed.  returns the port state
+        '''
+        rep=_set_port_lines(self._commands,**{'port%d'%self._port_num:lines})
+        if rep is None:
+            return self.state
+        return getattr(rep,self._port_bits)
     
     # properties for each individual line
-    line0=property(lambda self: self._get_line(0))
-    line1=property(lambda self: self._get_line(1))
-    line2=property(lambda self: self._get_line(2))
-    line3=property(lambda self: self._get_line(3))
-    line4=property(lambda self: self._get_line(4))
-    line5=property(lambda self: self._get_line(5))
-    line6=property(lambda self: self._get_line(6))
-    line7=property(lambda self: self._get_line(7))
+    line0=property(lambda self: self._lines[0])
+    line1=property(lambda self: self._lines[1])
+    line2=property(lambda self: self._lines[2])
+    line3=property(lambda self: self._lines[3])
+    line4=property(lambda self: self._lines[4])
+    line5=property(lambda self: self._lines[5])
+    line6=property(lambda self: self._lines[6])
+    line7=property(lambda self: self._lines[7])
     
     # property for all 8 lines
-    lines=property(lambda self: [self._get_line(i) for i in range(8)])
+    lines=property(lambda self: list(self._lines))
     '''
     list of individual lines.
     each line has properties for state, direction and logic
@@ -436,47 +1354,192 @@ class Port0_2(object):
     '''
 
 
+def _line_masks(lines):
+    '''
+    convert changes to the lines of a port (see Port0_2.set_lines) into
+    (bits to set,bits to clear)
+    '''
+    if hasattr(lines,'items'):
+        lines=lines.items()
+    else:
+        lines=enumerate(lines)
+    set_bits=0
+    clear_bits=0
+    for line_no,high in lines:
+        if high is None:
+            continue
+        if not 0 <= line_no < 8:
+            raise ValueError("no such line: %r"%line_no)
+        mask=1<<int(line_no)
+        if high:
+            set_bits|=mask
+        else:
+            clear_bits|=mask
+    return set_bits,clear_bits
+
+def _set_port_lines(commands,port0=None,port2=None):
+    '''
+    change lines on ports 0 and 2 with a single write (see
+    _port_line_writes).  returns the PXREP, or None if nothing was changed
+    '''
+    writes=_port_line_writes(commands,port0,port2)
+    if writes is None:
+        rep=commands.send_wait_reply(COMMAND.PXGET,REPORT.PXREP)
+        if rep is None:
+            raise RuntimeError("no reply from the box to PXGET")
+        writes=_port_line_writes(commands,port0,port2,(rep.port2_bits,rep.port0_bits))
+    if not writes:
+        return None
+    transaction=commands.transaction()
+    for command_id,report_id,values in writes:
+        transaction.add(command_id,report_id,*values)
+    return transaction.run()[-1]
+
+def _port_line_writes(commands,port0,port2,current=None):
+    '''
+    the (command,reply,values) to change lines on ports 0 and 2 in one
+    write: a PXSET if every line is given or the port state is known
+    (current is (port2_bits,port0_bits), or it's shadowed), otherwise a
+    PXAND if lines only go low or a PX_OR if they only go high.  returns
+    None if lines go both ways and the port state isn't known, so it has
+    to be read first
+    '''
+    set0,clear0=0,0
+    set2,clear2=0,0
+    if port0 is not None:
+        set0,clear0=_line_masks(port0)
+    if port2 is not None:
+        set2,clear2=_line_masks(port2)
+    if not (set0 | clear0 | set2 | clear2):
+        return []
+    
+    if current is not None:
+        pass
+    elif ((set0 | clear0) & (set2 | clear2)) == 0xFF:
+        current=0,0 # every line is being set anyway
+    elif commands.shadow is not None:
+        rep=commands.shadow.get(REPORT.PXREP)
+        if rep is not None:
+            current=rep.port2_bits,rep.port0_bits
+    if current is not None:
+        port2_bits=(current[0] & (clear2 ^ 0xFF)) | set2
+        port0_bits=(current[1] & (clear0 ^ 0xFF)) | set0
+        return [(COMMAND.PXSET,REPORT.PXREP,(port2_bits,port0_bits))]
+    
+    if not (set0 or set2):
+        return [(COMMAND.PXAND,REPORT.PXREP,(clear2 ^ 0xFF,clear0 ^ 0xFF))]
+    if not (clear0 or clear2):
+        return [(COMMAND.PX_OR,REPORT.PXREP,(set2,set0))]
+    return None
+
+
+# registers that are changed by reading them, altering some fields and
+# writing them back: get command -> (reply,set command,fields to write)
+_REGISTERS={}
+for _get_command,_reply,_set_command in [
+        (COMMAND.DIRGET,REPORT.DIRREP,COMMAND.DIRSET),
+        (COMMAND.LOGGET,REPORT.LOGREP,COMMAND.LOGSET),
+        (COMMAND.MSKGET,REPORT.MSKREP,COMMAND.MSKSET),
+        (COMMAND.DEBGET,REPORT.DEBREP,COMMAND.DEBSET)]:
+    _REGISTERS[_get_command]=(_reply,_set_command,COMMAND_SUMMARY[_set_command][2])
+del _get_command,_reply,_set_command
+
+def _read_modify_write(commands,changes,transaction=None):
+    '''
+    change fields of the registers in _REGISTERS.  changes is a list of
+    (get command,field,value), where value can be a function that is given
+    the current value of the field and returns the new one.
+    all of the registers are read in one transaction and then written back
+    in another, so any number of changes take two round trips (one if the
+    registers are shadowed).  registers that end up unchanged are not
+    written back.  if a transaction is given the writes are added to it
+    instead of being sent
+    '''
+    registers,current=_registers_to_change(commands,changes)
+    unknown=[get_command for get_command in registers if current[get_command] is None]
+    if unknown:
+        reads=commands.transaction()
+        for get_command in unknown:
+            reads.add(get_command,_REGISTERS[get_command][0])
+        current.update(zip(unknown,reads.run()))
+    
+    writes=transaction
+    if writes is None:
+        writes=commands.transaction()
+    for set_command,reply,values in _register_writes(registers,current,changes):
+        writes.add(set_command,reply,*values)
+    if transaction is None and len(writes):
+        writes.run()
+
+def _registers_to_change(commands,changes):
+    '''
+    the registers touched by changes (see _read_modify_write) and a dict of
+    their current values - None where they need reading from the box
+    '''
+    registers=[]
+    for get_command,field,value in changes:
+        if get_command not in registers:
+            registers.append(get_command)
+    current={}
+    for get_command in registers:
+        current[get_command]=None
+        if commands.shadow is not None:
+            current[get_command]=commands.shadow.get(_REGISTERS[get_command][0])
+    return registers,current
+
+def _register_writes(registers,current,changes):
+    '''
+    apply changes to the current values of the registers and return a list
+    of (set command,reply,values) to write back the ones that changed
+    '''
+    values={}
+    for get_command in registers:
+        rep=current[get_command]
+        if rep is None:
+            raise RuntimeError("no reply from box to %s"%COMMAND.name_from_id(get_command))
+        values[get_command]=[getattr(rep,field) for field in _REGISTERS[get_command][2]]
+    
+    for get_command,field,value in changes:
+        rep=current[get_command]
+        if callable(value):
+            value=value(getattr(rep,field))
+        setattr(rep,field,value)
+    
+    writes=[]
+    for get_command in registers:
+        reply,set_command,fields=_REGISTERS[get_command]
+        rep=current[get_command]
+        new_values=[getattr(rep,field) for field in fields]
+        if new_values != values[get_command]:
+            writes.append((set_command,reply,new_values))
+    return writes
 
 def _set_debounce(commands,port1_down=None,port1_up=None,int0_down=None,int0_up=None,int1_down=None,int1_up=None):
     '''helper for setting debounce of a single field'''
-    rep=commands.send_wait_reply(COMMAND.DEBGET,REPORT.DEBREP)
-    
-    if port1_down is not None:
-        rep.port1_down=port1_down
-    if port1_up is not None:
-        rep.port1_up=port1_up
-    if int0_down is not None:
-        rep.int0_down=int0_down
-    if int0_up is not None:
-        rep.int0_up=int0_up
-    if int1_down is not None:
-        rep.int1_down=int1_down
-    if int1_up is not None:
-        rep.int1_up=int1_up
-    
-    commands.send_wait_reply(
-        COMMAND.DEBSET,
-        REPORT.DEBREP,
-        rep.port1_down,rep.port1_up,
-        rep.int0_down,rep.int0_up,
-        rep.int1_down,rep.int1_up)
+    changes=[]
+    for field,debounce in [('port1_down',port1_down),('port1_up',port1_up),
+                           ('int0_down',int0_down),('int0_up',int0_up),
+                           ('int1_down',int1_down),('int1_up',int1_up)]:
+        if debounce is not None:
+            changes.append((COMMAND.DEBGET,field,debounce))
+    _read_modify_write(commands,changes)
 
 
 class Buttons(object):
     '''class that represents the buttons on the USBBox'''
     def __init__(self,commands):
         self._commands=commands
+        self._lines=tuple([ButtonLine(self,1<<line_no) for line_no in range(8)])
     
     def _get_enabled(self):
          return self._commands.send_wait_field(COMMAND.MSKGET,REPORT.MSKREP,'port1_bits')
     
+    def _update_enabled(self,enabled):
+        '''set mask for port 1 - keeping old port3 value (see _read_modify_write)'''
+        _read_modify_write(self._commands,[(COMMAND.MSKGET,'port1_bits',enabled)])
+    
     def _set_enabled(self,enabled):
-        # get previous value
-        rep=self._commands.send_wait_reply(COMMAND.MSKGET,REPORT.MSKREP)
-        # update port 1
-        rep.port1_bits=enabled
-        # set mask - keeping old port3 value
-        self._commands.send_wait_reply(COMMAND.MSKSET,REPORT.MSKREP,rep.port3_bits,rep.port1_bits)
+        self._update_enabled(enabled)
     
     enabled=property(_get_enabled,_set_enabled)
     '''get/set enable/disabled status of all buttons'''
@@ -508,41 +1571,28 @@ class Buttons(object):
         return an object that let's the user modify/query values
         on a single line of the port (1-bit)
         '''
-        #inner class for individual lines
-        class ButtonLine(Line):            
-            # state property
-            def _get_state(self):
-                return self._bit_state(self._port.state)
-            
-            state=property(_get_state)
-            '''state of the line'''
-            
-            # enabled property
-            def _get_enabled(self):
-                return self._bit_state(self._port.enabled)
-            
-            def _set_enabled(self,high):
-                self._port.enabled=self._set_bit_state(self._port.enabled,high)
-            
-            enabled=property(_get_enabled,_set_enabled)
-            '''get/set whether the line/button is enable or not'''
-            
-        mask=1<<line_no
-        # return new ButtonLine object
-        return ButtonLine(self,mask)
+        return self._lines[line_no]
+    
+    def set_lines(self,lines):
+        '''
+        enable/disable several buttons at once, lines is given as for
+        Port0_2.set_lines
+        '''
+        set_bits,clear_bits=_line_masks(lines)
+        self._update_enabled(lambda bits: (bits & (clear_bits ^ 0xFF)) | set_bits)
     
     # properties for each individual line
-    line0=property(lambda self: self._get_line(0))
+    line0=property(lambda self: self._lines[0])
     '''individual line (one button)'''
-    line1=property(lambda self: self._get_line(1))
-    line2=property(lambda self: self._get_line(2))
-    line3=property(lambda self: self._get_line(3))
-    line4=property(lambda self: self._get_line(4))
-    line5=property(lambda self: self._get_line(5))
-    line6=property(lambda self: self._get_line(6))
-    line7=property(lambda self: self._get_line(7))
-    
-    lines=property(lambda self: [self._get_line(i) for i in range(8)])
+    line1=property(lambda self: self._lines[1])
+    line2=property(lambda self: self._lines[2])
+    line3=property(lambda self: self._lines[3])
+    line4=property(lambda self: self._lines[4])
+    line5=property(lambda self: self._lines[5])
+    line6=property(lambda self: self._lines[6])
+    line7=property(lambda self: self._lines[7])
+    
+    lines=property(lambda self: list(self._lines))
     '''property for all 8 lines.
     each line (button) has a state and enabled property
     so each button can be queried/modified separately
@@ -564,14 +1614,15 @@ class Interrupt(object):
             return 0
     
     def _set_enabled(self,enabled):
-        # get previous value
-        rep=self._commands.send_wait_reply(COMMAND.MSKGET,REPORT.MSKREP)
-        # update port 3 value
+        _read_modify_write(self._commands,[self._enabled_change(enabled)])
+    
+    def _enabled_change(self,enabled):
+        '''the change to the port 3 mask to enable/disable the interrupt'''
         if enabled:
-            rep.port3_bits=rep.port3_bits | self._mask
+            update=lambda bits: bits | self._mask
         else:
-            rep.port3_bits=rep.port3_bits & (self._mask ^ 0xFF)
-        self._commands.send_wait_reply(COMMAND.MSKSET,REPORT.MSKREP,rep.port3_bits,rep.port1_bits)
+            update=lambda bits: bits & (self._mask ^ 0xFF)
+        return (COMMAND.MSKGET,'port3_bits',update)
     
     enabled=property(_get_enabled,_set_enabled)
     '''enable/disable the interrupt'''
@@ -708,6 +1759,10 @@ class VoiceKey(Interrupt):
     '''get/set mic pass through state'''
 
 
+def _is_serial_status(report):
+    '''true for SERIN reports that are not bytes received on the serial port'''
+    return report.status_code > 6
+
 class Serial(object):
     '''serial port on the USBBox'''
     def __init__(self,commands):
@@ -732,18 +1787,22 @@ class Serial(object):
     
     def write(self,bytes):
         '''write bytes to the serial port'''
+        if isinstance(bytes,type(u'')):
+            bytes=bytes.encode('latin-1')
+        # convert into ints
+        bytes=bytearray(bytes)
         for i in range(0,len(bytes),6):
             b=list(bytes[i:i+6]) # no more than six bytes at a time
-            # convert into ints
-            b=[struct.unpack('B',byte)[0] for byte in b]
             num_b=len(b)
             while len(b) < 6:
                 b.append(0) # add padding bytes
             
-            # might be receiving bytes at same time, so should loop until we get something
-            # that isn't receiving bytes (those will be dealt with in callback on _serial_in)
+            # might be receiving bytes at same time, so only take a reply that
+            # isn't receiving bytes (those will be dealt with in callback on _serial_in)
             while True:
-                rep=self._commands.send_wait_reply(COMMAND.SEROUT,REPORT.SERIN,num_b,*b)
+                rep=self._commands.wait_for_reply(
+                    self._commands.submit(COMMAND.SEROUT,REPORT.SERIN,num_b,*b,match=_is_serial_status)
+                )
                 if rep.status_code == 0xF0:
                     break # got confirmation we've transmitted ok
     
@@ -754,22 +1813,43 @@ class Serial(object):
         '''
         self._commands.wait_for_report(REPORT.SERIN)
         # return what we've received so far (which may be nothing)
-        bytes = ''.join([struct.pack('B',byte) for byte in self._bytes_received])
+        data=bytes(bytearray(self._bytes_received))
         self._bytes_received[:]=[] # clear received bytes
-        return bytes
+        return data
         
             
 
+def _find_hid_box():
+    '''
+    open the first box found via HID (None if there isn't one).  it's
+    shared with any other USBBoxes using the same box (see hid.DevicePool)
+    '''
+    for retry in (False,True):
+        if retry:
+            # the devices found before may have been unplugged
+            hid.devices_changed()
+        for dev in hid.find_hid_devices(IO_LABS_VENDOR_ID,BUTTON_BOX_PRODUCT_ID):
+            logging.info("found USB button box via HID")
+            try:
+                return hid.device_pool.acquire(dev)
+            except Exception:
+                logging.info("could not open %s",dev)
+    return None
+
 class USBBox(object):
     '''the USBBox itself'''
     
-    def __init__(self,do_reset=True):
-        self._device=None
-        for dev in hid.find_hid_devices():
-            if is_usb_bbox(dev):
-                logging.info("found USB button box via HID")
-                self._device=dev
-                break
+    def __init__(self,do_reset=True,device=None,report_queue=None,shadow=False):
+        '''
+        find the box and open it (or use the given HIDDevice instead).
+        report_queue can be used to give a ReportQueue with a different
+        capacity or overflow policy.  if shadow is set a copy of the box's
+        settings is kept (see ShadowRegisters) so reading them doesn't
+        need a round trip to the box
+        '''
+        self._device=device
+        if self._device is None:
+            self._device=_find_hid_box()
         
         if self._device is None:
             # couldn't find box via HID
@@ -787,9 +1867,14 @@ class USBBox(object):
         
         self._device.open()
         
-        self._commands=Commands(self._device)
+        if shadow:
+            shadow=ShadowRegisters()
+        else:
+            shadow=None
+        self._commands=Commands(self._device,report_queue,shadow)
         
         self._recording=False
+        self._recorder=None
         self.recording_callback=None
         self.report_ids=None
         
@@ -844,7 +1929,7 @@ class USBBox(object):
     '''synonym for int1'''
 
     
-    def send_command(self,command_id,bytes=''):
+    def send_command(self,command_id,bytes=b''):
         '''send a command to the box (one command_id byte and 7 data bytes)'''
         self.device.set_report(struct.pack("B7s",command_id,bytes))
     
@@ -855,13 +1940,24 @@ class USBBox(object):
     def clear_received_reports(self):
         self.commands.clear_received_reports()
     
-    def start_recording(self,report_ids,out_file):
+    def start_recording(self,report_ids,out_file,binary=False):
         '''
         whenever we read a report write it to the given
-        file (if the id is in report_ids)
+        file (if the id is in report_ids).
+        if binary is set the reports are written to out_file (opened in
+        binary mode) as a session file (see ioLabs_session), as they
+        arrive and including the replies to commands, with the time they
+        were received.  returns the SessionRecorder
         '''
         if self._recording:
             raise RuntimeError("sorry already recording, please stop_recording() first")
+        if binary:
+            from ioLabs_session import SessionHeader, SessionRecorder
+            header=SessionHeader(self.serial_num,self.version,self.voice_version)
+            self._recorder=SessionRecorder(out_file,header,report_ids)
+            self.commands.add_raw_callback(self._recorder.record)
+            self._recording=True
+            return self._recorder
         self._recording=True
         # save report to file
         self._recording_callback=lambda report: out_file.write("%s\n"%report)
@@ -871,7 +1967,13 @@ class USBBox(object):
     
     def stop_recording(self):
         '''removes the callbacks we had in place for recording'''
-        if self._recording:
+        if self._recording and self._recorder is not None:
+            self.commands.remove_raw_callback(self._recorder.record)
+            recorder=self._recorder
+            self._recorder=None
+            self._recording=False
+            recorder.close() # raises any error writing the file
+        elif self._recording:
             # make sure we process any remaing reports
             self.process_received_reports()
             self._recording=False
@@ -882,7 +1984,10 @@ class USBBox(object):
     
     # serial_num property
     def _get_serial_num(self):
-        return self.commands.send_wait_field(COMMAND.NUMGET,REPORT.NUMREP,'serial_num')
+        serial_num=self.commands.send_wait_field(COMMAND.NUMGET,REPORT.NUMREP,'serial_num')
+        if not isinstance(serial_num,str):
+            serial_num=serial_num.decode('ascii') # python 3
+        return serial_num
     serial_num=property(_get_serial_num)
     '''read the serial number of the box'''
     
@@ -931,12 +2036,35 @@ class USBBox(object):
     
     def enable_loopback(self):
         '''enable loopback (LEDs on/off with button presses)'''
-        rep=self.commands.send_wait_reply(COMMAND.DIRGET,REPORT.DIRREP)
-        self.commands.send_wait_reply(COMMAND.DIRSET,REPORT.DIRREP,1,rep.port2_bits,rep.port0_bits)
+        _read_modify_write(self.commands,[(COMMAND.DIRGET,'port2_mode',1)])
     
     def disable_loopback(self):
-        rep=self.commands.send_wait_reply(COMMAND.DIRGET,REPORT.DIRREP)
-        self.commands.send_wait_reply(COMMAND.DIRSET,REPORT.DIRREP,0,rep.port2_bits,rep.port0_bits)
+        _read_modify_write(self.commands,[(COMMAND.DIRGET,'port2_mode',0)])
+    
+    def set_lines(self,port0=None,port2=None):
+        '''
+        change the state of lines on port 0 and port 2 (the leds) together,
+        in one write (after reading the ports if some lines go high and
+        others low).  each port's lines are given as for Port0_2.set_lines.
+        returns the PXREP from the box (None if nothing was changed)
+        '''
+        return _set_port_lines(self.commands,port0,port2)
+    
+    def invalidate_shadow(self):
+        '''forget the shadowed settings, they will be read from the box again'''
+        if self.commands.shadow is not None:
+            self.commands.shadow.invalidate()
+    
+    def resync_shadow(self):
+        '''read all the shadowed settings from the box again'''
+        if self.commands.shadow is None:
+            return
+        self.commands.shadow.invalidate()
+        transaction=self.commands.transaction()
+        # direction first, the port state is only kept if loopback is off
+        for get_command in [COMMAND.DIRGET,COMMAND.LOGGET,COMMAND.MSKGET,COMMAND.DEBGET,COMMAND.VCKGET,COMMAND.PXGET]:
+            transaction.add(get_command,_SHADOW_GETS[get_command])
+        transaction.run()
     
     def wait_for_keydown(self):
         '''wait for a key to be pressed and returns the report'''
@@ -948,48 +2076,66 @@ class USBBox(object):
     
     def reset_box(self):
         '''set box to some known values'''
-        self.disable_loopback()
-        
-        self.heartbeat=30000 # 30 seconds
-        
-        self.buttons.debounce_up=5 # ms
-        self.buttons.debounce_down=20 # ms
-        self.int0.debounce_up=5 # ms
-        self.int0.debounce_down=20 # ms
-        self.int1.debounce_up=5 # ms
-        self.int1.debounce_down=20 # ms
-        
-        self.port0.logic=0
-        self.port0.state=0xff
-        
-        self.port2.logic=0
-        self.port2.state=0xff
-        
-        self.buttons.enabled=0xff
-        self.int0.enabled=1
-        self.int1.enabled=1
-        
-        self.reset_clock()
+        # send everything in two batches - one reading the registers
+        # that are changed and one writing them and the other settings
+        transaction=self.commands.transaction()
+        _read_modify_write(self.commands,self._reset_changes(),transaction)
+        for command_id,report_id,args in self._reset_commands():
+            transaction.add(command_id,report_id,*args)
+        transaction.run()
         
+        # only once the replies are in, or they'd be purged
         self.purge_queue()
+    
+    def _reset_changes(self):
+        '''register changes (see _read_modify_write) made by reset_box'''
+        return [
+            (COMMAND.DIRGET,'port2_mode',0), # disable loopback
+            
+            (COMMAND.DEBGET,'port1_up',5), # ms
+            (COMMAND.DEBGET,'port1_down',20), # ms
+            (COMMAND.DEBGET,'int0_up',5), # ms
+            (COMMAND.DEBGET,'int0_down',20), # ms
+            (COMMAND.DEBGET,'int1_up',5), # ms
+            (COMMAND.DEBGET,'int1_down',20), # ms
+            
+            (COMMAND.LOGGET,'port0_bits',0),
+            (COMMAND.LOGGET,'port2_bits',0),
+            
+            (COMMAND.MSKGET,'port1_bits',0xff), # all buttons enabled
+            self.int0._enabled_change(1),
+            self.int1._enabled_change(1),
+        ]
+    
+    def _reset_commands(self):
+        '''the other commands sent by reset_box, as (command,reply,args)'''
+        return [
+            (COMMAND.HBSET,None,(30000,)), # 30 seconds
+            (COMMAND.PXSET,REPORT.PXREP,(0xff,0xff)), # port 2 and port 0 state
+            (COMMAND.RESRTC,REPORT.KEYREP,()), # reset clock
+        ]
 
 if __name__ == '__main__':
     import sys
     
     usbbox=USBBox()
     
-    print "USBBox connected"
-    print "serial #:",usbbox.serial_num
-    print "version:",usbbox.version
-    print "voice version:", usbbox.voice_version
+    print("USBBox connected")
+    print("serial #:",usbbox.serial_num)
+    print("version:",usbbox.version)
+    print("voice version:", usbbox.voice_version)
     
     # attached a callback for every report type
     def report_callback(msg):
-        print "received:",msg
+        print("received:",msg)
     for command_id in REPORT.ALL_IDS():
         usbbox.commands.add_callback(command_id,report_callback)
         
-    from StringIO import StringIO
+    try:
+        from StringIO import StringIO
+    except ImportError:
+        from io import StringIO # python 3
+        raw_input=input
     outfile=StringIO()
     # record all incoming reports
     usbbox.start_recording(REPORT_SUMMARY.keys(),outfile)
@@ -1006,14 +2152,14 @@ if __name__ == '__main__':
             continue
         elif command == 'help':
             # print list of available commands
-            print "commands:"
-            print " exit"
-            print " help"
+            print("commands:")
+            print(" exit")
+            print(" help")
             for command_id in COMMAND_SUMMARY.keys():
                 command_name=COMMAND_SUMMARY[command_id][0].lower()
                 command_args=COMMAND_SUMMARY[command_id][2]
                 command_args=['<%s>' % arg for arg in command_args]
-                print " %s %s" % (command_name,' '.join(command_args))
+                print(" %s %s" % (command_name,' '.join(command_args)))
         else:
             try:
                 command_parts=command.split()
@@ -1025,18 +2171,18 @@ if __name__ == '__main__':
                         known=True
                         break
                 if not known:
-                    print "error, unknown command: " + command_name
+                    print("error, unknown command: " + command_name)
                 else:
                     command_fn=getattr(usbbox.commands,command_name)
                     # turn all arguments into int's
                     command_args=[int(arg) for arg in command_args]
                     command_fn(*command_args)
             except:
-                print "error running: " + command
+                print("error running: " + command)
     
     # make sure we process any remaining reports
     usbbox.process_received_reports()
     usbbox.stop_recording()
     
-    print "recorded reports:"
-    print outfile.getvalue()
+    print("recorded reports:")
+    print(outfile.getvalue())
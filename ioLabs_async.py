@@ -0,0 +1,535 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+'''
+asyncio front end for the USBBox (needs python 3.7 or later).
+
+AsyncUSBBox has coroutine versions of the USBBox queries and setters and
+an async iterator over the reports from the box, e.g.
+
+    import asyncio
+    from ioLabs import REPORT
+    from ioLabs_async import AsyncUSBBox
+
+    async def main():
+        usbbox=await AsyncUSBBox.open()
+        print(await usbbox.get_serial_num())
+        await usbbox.leds.set_state(0x00)
+        async for report in usbbox.reports(REPORT.KEYDN):
+            print(report)
+
+    asyncio.run(main())
+
+none of these block the event loop: replies are matched to requests on
+the device's thread (see Commands.submit) and handed over to the loop
+with call_soon_threadsafe.  timeouts and cancellation (e.g. with
+asyncio.wait_for) stop the request waiting for its reply.
+'''
+
+import asyncio
+from collections import deque
+
+from ioLabs import (USBBox, ReportQueue, Transaction, Empty, COMMAND, REPORT,
+                    _REGISTERS, _VCK_OK, _registers_to_change, _register_writes,
+                    _port_line_writes, _line_masks)
+
+# default timeout, meaning the reply_timeout of the Commands
+REPLY_TIMEOUT=object()
+
+
+class AsyncReportQueue(ReportQueue):
+    '''
+    ReportQueue that can be waited on from an asyncio event loop (only
+    one loop per queue).  put() is called on the device's thread and only
+    wakes the loop if a coroutine is waiting in get_async()
+    '''
+    def __init__(self,*args,**kw):
+        ReportQueue.__init__(self,*args,**kw)
+        self._loop=None
+        self._wakeup=None
+        self._async_waiting=0
+
+    def put(self,report,block=True,timeout=None):
+        ReportQueue.put(self,report)
+        if self._async_waiting:
+            try:
+                self._loop.call_soon_threadsafe(self._wakeup.set)
+            except RuntimeError:
+                pass # loop has been closed, don't stop the device's thread
+
+    async def get_async(self):
+        '''remove and return the oldest report, waiting for one if needed'''
+        while True:
+            try:
+                return self.get_nowait()
+            except Empty:
+                pass
+            if self._wakeup is None:
+                self._loop=asyncio.get_running_loop()
+                self._wakeup=asyncio.Event()
+            self._wakeup.clear()
+            self._async_waiting+=1
+            try:
+                # check again, now put() will wake us
+                try:
+                    return self.get_nowait()
+                except Empty:
+                    pass
+                await self._wakeup.wait()
+            finally:
+                self._async_waiting-=1
+
+
+def _wrap(report_future):
+    '''an asyncio future that gets the result of a ReportFuture'''
+    loop=asyncio.get_running_loop()
+    future=loop.create_future()
+    def resolve():
+        if future.done():
+            return # timed out or cancelled
+        if report_future.cancelled():
+            future.cancel()
+        else:
+            future.set_result(report_future.result(0))
+    def done(report_future):
+        # called on the device's thread
+        try:
+            loop.call_soon_threadsafe(resolve)
+        except RuntimeError:
+            pass # loop has been closed
+    report_future.add_done_callback(done)
+    return future
+
+
+class AsyncCommands(object):
+    '''
+    coroutine versions of the Commands methods that wait for the box.
+    timeouts default to the reply_timeout of the Commands, None means
+    wait forever.  on a timeout None is returned, as for Commands
+    '''
+    def __init__(self,commands):
+        self.commands=commands
+
+    async def result(self,report_future,timeout=REPLY_TIMEOUT):
+        '''wait for the report a ReportFuture (from Commands.submit or expect) is waiting for'''
+        if timeout is REPLY_TIMEOUT:
+            timeout=self.commands.reply_timeout
+        try:
+            return await asyncio.wait_for(_wrap(report_future),timeout)
+        except asyncio.TimeoutError:
+            self.commands.cancel(report_future)
+            return report_future.result(0) # in case it arrived just now
+        except asyncio.CancelledError:
+            self.commands.cancel(report_future)
+            raise
+
+    async def send_wait_reply(self,command_id,report_id,*args,match=None,timeout=REPLY_TIMEOUT):
+        '''send a command with the given arguments and wait for the reply'''
+        return await self.result(self.commands.submit(command_id,report_id,*args,match=match),timeout)
+
+    async def send_wait_field(self,command_id,report_id,field_name,*args):
+        '''send a command (with the args), wait for the report and return the field on the report'''
+        return getattr(await self.send_wait_reply(command_id,report_id,*args),field_name)
+
+    async def wait_for_report(self,report_id,match=None,timeout=REPLY_TIMEOUT):
+        '''wait for the next report with the given id (see Commands.expect)'''
+        return await self.result(self.commands.expect(report_id,match),timeout)
+
+    def send(self,command_id,*args):
+        '''send a command the box doesn't reply to'''
+        getattr(self.commands,COMMAND.name_from_id(command_id).lower())(*args)
+
+    def transaction(self):
+        '''return a new AsyncTransaction, for sending a batch of commands'''
+        return AsyncTransaction(self)
+
+
+class AsyncTransaction(Transaction):
+    '''Transaction that is run with "await transaction.run()"'''
+    def __init__(self,commands):
+        Transaction.__init__(self,commands.commands)
+        self._async_commands=commands
+
+    async def run(self):
+        '''
+        send the commands and return a list of the replies in the same
+        order (None for commands without a reply, or if one did not
+        arrive).  the transaction is empty again afterwards
+        '''
+        requests,self._requests=self._requests,[]
+        commands=self._async_commands
+        timeout=commands.commands.reply_timeout
+        futures=[]
+        in_flight=deque()
+        for command_id,report_id,args in requests:
+            if report_id is None:
+                commands.send(command_id,*args)
+                futures.append(None)
+                continue
+            if len(in_flight) >= self.max_in_flight:
+                await commands.result(in_flight.popleft(),timeout)
+            future=commands.commands.submit(command_id,report_id,*args)
+            in_flight.append(future)
+            futures.append(future)
+
+        replies=[]
+        for future in futures:
+            if future is None:
+                replies.append(None)
+                continue
+            report=await commands.result(future,timeout)
+            if report is None:
+                # the box isn't answering, so don't wait for the rest
+                timeout=0
+            replies.append(report)
+        return replies
+
+
+async def _read_modify_write(commands,changes,transaction=None):
+    '''coroutine version of ioLabs._read_modify_write'''
+    registers,current=_registers_to_change(commands.commands,changes)
+    unknown=[get_command for get_command in registers if current[get_command] is None]
+    if unknown:
+        reads=commands.transaction()
+        for get_command in unknown:
+            reads.add(get_command,_REGISTERS[get_command][0])
+        current.update(zip(unknown,await reads.run()))
+
+    writes=transaction
+    if writes is None:
+        writes=commands.transaction()
+    for set_command,reply,values in _register_writes(registers,current,changes):
+        writes.add(set_command,reply,*values)
+    if transaction is None and len(writes):
+        await writes.run()
+
+async def _set_port_lines(commands,port0=None,port2=None):
+    '''coroutine version of ioLabs._set_port_lines'''
+    writes=_port_line_writes(commands.commands,port0,port2)
+    if writes is None:
+        rep=await commands.send_wait_reply(COMMAND.PXGET,REPORT.PXREP)
+        if rep is None:
+            raise RuntimeError("no reply from the box to PXGET")
+        writes=_port_line_writes(commands.commands,port0,port2,(rep.port2_bits,rep.port0_bits))
+    if not writes:
+        return None
+    transaction=commands.transaction()
+    for command_id,report_id,values in writes:
+        transaction.add(command_id,report_id,*values)
+    return (await transaction.run())[-1]
+
+
+class AsyncPort(object):
+    '''asyncio version of Port0_2'''
+    def __init__(self,commands,port_num):
+        self._commands=commands
+        self._port_num=port_num
+        self._port_bits='port%d_bits'%port_num
+        self._port_set=getattr(COMMAND,'P%dSET'%port_num)
+        self._port_and=getattr(COMMAND,'P%dAND'%port_num)
+        self._port_or=getattr(COMMAND,'P%d_OR'%port_num)
+        self._port_xor=getattr(COMMAND,'P%dXOR'%port_num)
+
+    async def _update(self,get_command,bits):
+        await _read_modify_write(self._commands,[(get_command,self._port_bits,bits)])
+
+    async def get_direction(self):
+        return await self._commands.send_wait_field(COMMAND.DIRGET,REPORT.DIRREP,self._port_bits)
+
+    async def set_direction(self,bits):
+        await self._update(COMMAND.DIRGET,bits)
+
+    async def get_logic(self):
+        return await self._commands.send_wait_field(COMMAND.LOGGET,REPORT.LOGREP,self._port_bits)
+
+    async def set_logic(self,bits):
+        await self._update(COMMAND.LOGGET,bits)
+
+    async def get_state(self):
+        return await self._commands.send_wait_field(COMMAND.PXGET,REPORT.PXREP,self._port_bits)
+
+    async def set_state(self,bits):
+        await self._commands.send_wait_reply(self._port_set,REPORT.PXREP,bits)
+
+    async def and_state(self,and_bits):
+        '''logically 'and' the value on the port, returns the port state'''
+        return await self._commands.send_wait_field(self._port_and,REPORT.PXREP,self._port_bits,and_bits)
+
+    async def or_state(self,or_bits):
+        '''logically 'or' the value on the port, returns the port state'''
+        return await self._commands.send_wait_field(self._port_or,REPORT.PXREP,self._port_bits,or_bits)
+
+    async def xor_state(self,xor_bits):
+        '''logically 'xor' the value on the port, returns the port state'''
+        return await self._commands.send_wait_field(self._port_xor,REPORT.PXREP,self._port_bits,xor_bits)
+
+    async def set_lines(self,lines):
+        '''change several lines at once (see Port0_2.set_lines), returns the port state'''
+        rep=await _set_port_lines(self._commands,**{'port%d'%self._port_num:lines})
+        if rep is None:
+            return await self.get_state()
+        return getattr(rep,self._port_bits)
+
+
+class AsyncButtons(object):
+    '''asyncio version of Buttons'''
+    def __init__(self,commands):
+        self._commands=commands
+
+    async def _update_enabled(self,enabled):
+        await _read_modify_write(self._commands,[(COMMAND.MSKGET,'port1_bits',enabled)])
+
+    async def get_enabled(self):
+        return await self._commands.send_wait_field(COMMAND.MSKGET,REPORT.MSKREP,'port1_bits')
+
+    async def set_enabled(self,enabled):
+        await self._update_enabled(enabled)
+
+    async def get_debounce_down(self):
+        return await self._commands.send_wait_field(COMMAND.DEBGET,REPORT.DEBREP,'port1_down')
+
+    async def set_debounce_down(self,debounce):
+        await _read_modify_write(self._commands,[(COMMAND.DEBGET,'port1_down',debounce)])
+
+    async def get_debounce_up(self):
+        return await self._commands.send_wait_field(COMMAND.DEBGET,REPORT.DEBREP,'port1_up')
+
+    async def set_debounce_up(self,debounce):
+        await _read_modify_write(self._commands,[(COMMAND.DEBGET,'port1_up',debounce)])
+
+    async def get_state(self):
+        return await self._commands.send_wait_field(COMMAND.KEYGET,REPORT.KEYREP,'port1_bits')
+
+    async def set_lines(self,lines):
+        '''enable/disable several buttons at once (see Buttons.set_lines)'''
+        set_bits,clear_bits=_line_masks(lines)
+        await self._update_enabled(lambda bits: (bits & (clear_bits ^ 0xFF)) | set_bits)
+
+
+class AsyncInterrupt(object):
+    '''asyncio version of Interrupt'''
+    def __init__(self,commands,interrupt):
+        self._commands=commands
+        self._interrupt=interrupt # the Interrupt this mirrors
+        self._int_num=interrupt._int_num
+
+    async def get_enabled(self):
+        bits=await self._commands.send_wait_field(COMMAND.MSKGET,REPORT.MSKREP,'port3_bits')
+        if bits & self._interrupt._mask != 0:
+            return 1
+        else:
+            return 0
+
+    async def set_enabled(self,enabled):
+        await _read_modify_write(self._commands,[self._interrupt._enabled_change(enabled)])
+
+    async def get_debounce_down(self):
+        return await self._commands.send_wait_field(COMMAND.DEBGET,REPORT.DEBREP,'int%d_down'%self._int_num)
+
+    async def set_debounce_down(self,debounce):
+        await _read_modify_write(self._commands,[(COMMAND.DEBGET,'int%d_down'%self._int_num,debounce)])
+
+    async def get_debounce_up(self):
+        return await self._commands.send_wait_field(COMMAND.DEBGET,REPORT.DEBREP,'int%d_up'%self._int_num)
+
+    async def set_debounce_up(self,debounce):
+        await _read_modify_write(self._commands,[(COMMAND.DEBGET,'int%d_up'%self._int_num,debounce)])
+
+
+class AsyncVoiceKey(AsyncInterrupt):
+    '''asyncio version of VoiceKey'''
+    async def _get_voice_key(self,field):
+        while True:
+            rep=await self._commands.send_wait_reply(COMMAND.VCKGET,REPORT.VCKREP)
+            if rep.status_code in _VCK_OK:
+                return getattr(rep,field)
+            if rep.status_code != 0x48: # basic NAK error is ok
+                raise RuntimeError("error getting voice key code: 0x%x"%rep.status_code)
+            # let the value finish getting written then try again
+            await asyncio.sleep(0.005)
+
+    async def _set_voice_key(self,**fields):
+        rep=await self._commands.send_wait_reply(COMMAND.VCKGET,REPORT.VCKREP)
+        for field,value in fields.items():
+            setattr(rep,field,value)
+        rep=await self._commands.send_wait_reply(
+            COMMAND.VCKSET,
+            REPORT.VCKREP,
+            0xB8,
+            rep.min_duration,
+            rep.min_silence,
+            rep.trigger_level,
+            self._interrupt._mic_pass_thru)
+        if not rep.status_code in _VCK_OK:
+            raise RuntimeError("error setting voice key code: 0x%x"%rep.status_code)
+        # artificial delay to let values be written
+        await asyncio.sleep(0.05)
+
+    async def get_primary_gain(self):
+        return await self._commands.send_wait_field(COMMAND.VCKGET,REPORT.VCKREP,'primary_gain')
+
+    async def set_primary_gain(self,gain):
+        await self._commands.send_wait_reply(COMMAND.VCKSET,REPORT.VCKREP,0xA9,gain,0,0,0)
+
+    async def get_secondary_gain(self):
+        return await self._commands.send_wait_field(COMMAND.VCKGET,REPORT.VCKREP,'secondary_gain')
+
+    async def set_secondary_gain(self,gain):
+        await self._commands.send_wait_reply(COMMAND.VCKSET,REPORT.VCKREP,0xAA,gain,0,0,0)
+
+    async def get_min_duration(self):
+        return await self._get_voice_key('min_duration')
+
+    async def set_min_duration(self,duration):
+        await self._set_voice_key(min_duration=duration)
+
+    async def get_min_silence(self):
+        return await self._get_voice_key('min_silence')
+
+    async def set_min_silence(self,duration):
+        await self._set_voice_key(min_silence=duration)
+
+    async def get_trigger_level(self):
+        return await self._get_voice_key('trigger_level')
+
+    async def set_trigger_level(self,level):
+        await self._set_voice_key(trigger_level=level)
+
+    async def get_mic_pass_thru(self):
+        return self._interrupt._mic_pass_thru
+
+    async def set_mic_pass_thru(self,mic_pass_thru):
+        if mic_pass_thru:
+            self._interrupt._mic_pass_thru=1
+        else:
+            self._interrupt._mic_pass_thru=0
+        await self._set_voice_key()
+
+
+class ReportIterator(object):
+    '''
+    async iterator over the reports on an AsyncReportQueue.  reports with
+    ids that aren't wanted are given to the callbacks instead
+    '''
+    def __init__(self,commands,report_ids=()):
+        self._commands=commands
+        self._report_ids=frozenset(report_ids)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        queue=self._commands.queue
+        while True:
+            report=await queue.get_async()
+            if not self._report_ids or report.id in self._report_ids:
+                return report
+            self._commands._process_report(report)
+
+
+class AsyncUSBBox(object):
+    '''
+    asyncio version of the USBBox.  create one with
+
+        usbbox=await AsyncUSBBox.open()
+
+    (which takes the same arguments as USBBox) or wrap a USBBox that was
+    given an AsyncReportQueue.  the USBBox is available as usbbox.usbbox
+    '''
+    def __init__(self,usbbox):
+        if not isinstance(usbbox.commands.queue,AsyncReportQueue):
+            raise ValueError("USBBox must be created with an AsyncReportQueue")
+        self.usbbox=usbbox
+        self.commands=AsyncCommands(usbbox.commands)
+
+        self.port0=AsyncPort(self.commands,0)
+        self.port1=AsyncButtons(self.commands)
+        self.port2=AsyncPort(self.commands,2)
+        self.int0=AsyncVoiceKey(self.commands,usbbox.int0)
+        self.int1=AsyncInterrupt(self.commands,usbbox.int1)
+
+        # synonyms
+        self.leds=self.port2
+        self.buttons=self.port1
+        self.voice_key=self.int0
+        self.optic_key=self.int1
+
+    @classmethod
+    async def open(cls,do_reset=True,device=None,report_queue=None,shadow=False):
+        '''find the box and open it (see USBBox)'''
+        if report_queue is None:
+            # drop heartbeats before anything else if the queue fills up
+            report_queue=AsyncReportQueue(drop_ids=(REPORT.HBREP,))
+        # finding and opening the box waits for it, so not on the loop
+        loop=asyncio.get_running_loop()
+        usbbox=cls(await loop.run_in_executor(None,USBBox,False,device,report_queue,shadow))
+        if do_reset:
+            await usbbox.reset_box()
+        return usbbox
+
+    def close(self):
+        self.usbbox.device.close()
+
+    def reports(self,*report_ids):
+        '''
+        async iterator over the reports received from the box, all of them
+        or only those with the given ids (the others are given to the
+        callbacks, as process_received_reports would)
+
+            async for report in usbbox.reports(REPORT.KEYDN,REPORT.KEYUP):
+                ...
+        '''
+        return ReportIterator(self.usbbox.commands,report_ids)
+
+    async def get_serial_num(self):
+        serial_num=await self.commands.send_wait_field(COMMAND.NUMGET,REPORT.NUMREP,'serial_num')
+        return serial_num.decode('ascii')
+
+    async def get_version(self):
+        rep=await self.commands.send_wait_reply(COMMAND.VERGET,REPORT.VERREP)
+        return (rep.rel_main,rep.rev_main)
+
+    async def get_voice_version(self):
+        rep=await self.commands.send_wait_reply(COMMAND.VERGET,REPORT.VERREP)
+        return (rep.rel_dtvk,rep.rev_dtvk)
+
+    async def get_clock(self):
+        return await self.commands.send_wait_field(COMMAND.RTCGET,REPORT.RTCREP,'rtc')
+
+    def set_heartbeat(self,value):
+        '''set the heartbeat rate (the box doesn't reply, so this doesn't wait)'''
+        self.commands.send(COMMAND.HBSET,value)
+
+    def purge_queue(self):
+        '''purge the event queue on the box (doesn't wait)'''
+        self.commands.send(COMMAND.QPURGE)
+
+    async def reset_clock(self):
+        '''reset the clock on the box (returns a key report)'''
+        return await self.commands.send_wait_reply(COMMAND.RESRTC,REPORT.KEYREP)
+
+    async def enable_loopback(self):
+        await _read_modify_write(self.commands,[(COMMAND.DIRGET,'port2_mode',1)])
+
+    async def disable_loopback(self):
+        await _read_modify_write(self.commands,[(COMMAND.DIRGET,'port2_mode',0)])
+
+    async def wait_for_keydown(self,timeout=REPLY_TIMEOUT):
+        '''wait for a key to be pressed and return the report (None if timeout passes)'''
+        return await self.commands.wait_for_report(REPORT.KEYDN,timeout=timeout)
+
+    async def wait_for_keyup(self,timeout=REPLY_TIMEOUT):
+        '''wait for a key to be released and return the report (None if timeout passes)'''
+        return await self.commands.wait_for_report(REPORT.KEYUP,timeout=timeout)
+
+    async def set_lines(self,port0=None,port2=None):
+        '''change lines on port 0 and port 2 together (see USBBox.set_lines)'''
+        return await _set_port_lines(self.commands,port0,port2)
+
+    async def reset_box(self):
+        '''set box to some known values (see USBBox.reset_box)'''
+        transaction=self.commands.transaction()
+        await _read_modify_write(self.commands,self.usbbox._reset_changes(),transaction)
+        for command_id,report_id,args in self.usbbox._reset_commands():
+            transaction.add(command_id,report_id,*args)
+        await transaction.run()
+        self.purge_queue()
@@ -0,0 +1,270 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+'''
+synchronization of the box's clock with the host's.
+
+the box time stamps reports with its rtc, a 32 bit count of milliseconds
+since it was reset, which drifts against the host clock (hid.host_ns) by
+up to a few hundred parts per million.  ClockSync fits a straight line
+mapping one onto the other from
+
+* RTCGET round trips - the box read its clock somewhere between the
+  command being sent and the reply arriving, so the middle of the round
+  trip is used and round trips that took longest are thrown away
+* heartbeats (HBREP) - the time they arrived, less the time a report
+  takes to get from the box (estimated from the round trips)
+
+e.g.
+
+    usbbox=USBBox()
+    usbbox.heartbeat=1000 # keeps the fit up to date
+    sync=ClockSync()
+    sync.attach(usbbox.commands)
+    sync.sync(usbbox.commands) # a few round trips to start with
+    ...
+    host_ns=sync.report_host_ns(report) # host time of the rtc on a report
+'''
+
+from threading import Lock
+
+from hid import host_ns
+from ioLabs import COMMAND, REPORT
+
+# the rtc counts whole milliseconds, so the box's time is on average half
+# a millisecond on from the rtc it gives
+_RTC_RESOLUTION_NS=1000000
+
+def unwrap_rtc(rtc,last):
+    '''
+    turn the box's 32 bit rtc into a count that keeps going up when it
+    wraps around (every 49.7 days): the value closest to last (a previous
+    unwrapped rtc, or None for the first)
+    '''
+    if last is None:
+        return rtc
+    rtc+=last & ~0xFFFFFFFF
+    if rtc < last-0x80000000:
+        rtc+=0x100000000
+    elif rtc > last+0x80000000:
+        rtc-=0x100000000
+    return rtc
+
+class ClockSync(object):
+    '''
+    model of the box's clock against the host's:
+
+        host_ns = offset_ns + (rtc+0.5)*ms_ns
+
+    (rtc unwrapped, see unwrap_rtc, and the box time taken as the middle of
+    the millisecond, as the rtc is rounded down) fitted by weighted least
+    squares to the samples added with add_round_trip and add_heartbeat.
+    only the best sample of each kind (shortest round trip, least delayed
+    heartbeat) is kept for each bucket_ms of box time, and the last
+    max_buckets buckets are used, so the fit follows the drift as it
+    changes (e.g. with temperature).  the fit is worked out again when
+    it's next used after samples have been added
+
+    the fit isn't reset when the box's clock is: call reset() after
+    USBBox.reset_clock
+    '''
+    def __init__(self,bucket_ms=10000,max_buckets=360):
+        self.bucket_ms=bucket_ms
+        self.max_buckets=max_buckets
+        self._lock=Lock()
+        self.reset()
+
+    def reset(self):
+        '''forget all the samples (e.g. after the box's clock is reset)'''
+        self._lock.acquire()
+        try:
+            self._last_rtc=None
+            self._round_trips={} # bucket -> (rtt_ns,rtc,middle of round trip)
+            self._heartbeats={} # bucket -> (delay by the last fit,rtc,receive_ns)
+            self.min_rtt_ns=None
+            '''shortest round trip seen'''
+            self._offset_ns=None
+            self._ms_ns=1000000.0
+            self._error_bound_ns=None
+            self._changed=False
+        finally:
+            self._lock.release()
+
+    def _fitted(self,name):
+        self._lock.acquire()
+        try:
+            if self._changed:
+                self._fit()
+            return getattr(self,name)
+        finally:
+            self._lock.release()
+
+    offset_ns=property(lambda self: self._fitted('_offset_ns'))
+    '''host time at the start of rtc 0 (None until there are samples)'''
+
+    ms_ns=property(lambda self: self._fitted('_ms_ns'))
+    '''host nanoseconds per box millisecond'''
+
+    error_bound_ns=property(lambda self: self._fitted('_error_bound_ns'))
+    '''
+    bound on the error of the fit, at the round trips: how far the fit is
+    from the middle of each one, plus how far from the middle the box
+    could have read its clock (None until there are round trips)
+    '''
+
+    def _get_drift_ppm(self):
+        return (1e6/self.ms_ns-1.0)*1e6
+    drift_ppm=property(_get_drift_ppm)
+    '''how much faster the box's clock runs than the host's (parts per million)'''
+
+    def unwrap(self,rtc):
+        '''unwrap an rtc from the box, relative to the latest one seen'''
+        return unwrap_rtc(rtc,self._last_rtc)
+
+    def _bucket(self,rtc):
+        rtc=unwrap_rtc(rtc,self._last_rtc)
+        if self._last_rtc is None or rtc > self._last_rtc:
+            self._last_rtc=rtc
+        return rtc,rtc//self.bucket_ms
+
+    def add_round_trip(self,send_ns,rtc,receive_ns):
+        '''
+        add an RTCGET round trip: the host time the command was sent, the
+        rtc in the reply and the host time the reply arrived
+        '''
+        rtt_ns=receive_ns-send_ns
+        self._lock.acquire()
+        try:
+            rtc,bucket=self._bucket(rtc)
+            best=self._round_trips.get(bucket)
+            if best is None or rtt_ns < best[0]:
+                self._round_trips[bucket]=(rtt_ns,rtc,(send_ns+receive_ns)/2.0)
+                self._changed=True
+            if self.min_rtt_ns is None or rtt_ns < self.min_rtt_ns:
+                self.min_rtt_ns=rtt_ns
+                self._changed=True
+        finally:
+            self._lock.release()
+
+    def add_heartbeat(self,rtc,receive_ns):
+        '''add a heartbeat (or any report sent as soon as the rtc was read)'''
+        self._lock.acquire()
+        try:
+            rtc,bucket=self._bucket(rtc)
+            # the one that arrived soonest after it was sent, going by the
+            # last fit, was the least delayed
+            delay=receive_ns-self._model(rtc)
+            best=self._heartbeats.get(bucket)
+            if best is None or delay < best[0]:
+                self._heartbeats[bucket]=(delay,rtc,receive_ns)
+                self._changed=True
+        finally:
+            self._lock.release()
+
+    def _model(self,rtc):
+        if self._offset_ns is None:
+            return (rtc+0.5)*self._ms_ns
+        return self._offset_ns+(rtc+0.5)*self._ms_ns
+
+    def _samples(self):
+        '''list of (box time,host_ns,uncertainty_ns) for the fit'''
+        # only the latest buckets
+        buckets=sorted(set(self._round_trips) | set(self._heartbeats))
+        if len(buckets) > self.max_buckets:
+            oldest=buckets[-self.max_buckets]
+            for samples in (self._round_trips,self._heartbeats):
+                for bucket in list(samples):
+                    if bucket < oldest:
+                        del samples[bucket]
+        samples=[]
+        for rtt_ns,rtc,middle_ns in self._round_trips.values():
+            samples.append((rtc+0.5,middle_ns,rtt_ns/2.0+_RTC_RESOLUTION_NS/2.0))
+        # a heartbeat takes about half the shortest round trip to arrive
+        one_way_ns=(self.min_rtt_ns or 0)/2.0
+        for delay,rtc,receive_ns in self._heartbeats.values():
+            samples.append((rtc+0.5,receive_ns-one_way_ns,one_way_ns+_RTC_RESOLUTION_NS))
+        return samples
+
+    def _fit(self):
+        self._changed=False
+        samples=self._samples()
+        if not samples:
+            return
+        # shift to the first sample, to keep the numbers small
+        x0,y0,uncertainty=samples[0]
+        total_weight=sum_x=sum_y=0.0
+        for x,y,uncertainty in samples:
+            weight=1.0/(uncertainty*uncertainty)
+            total_weight+=weight
+            sum_x+=weight*(x-x0)
+            sum_y+=weight*(y-y0)
+        mean_x=sum_x/total_weight
+        mean_y=sum_y/total_weight
+        sxx=sxy=0.0
+        for x,y,uncertainty in samples:
+            weight=1.0/(uncertainty*uncertainty)
+            dx=x-x0-mean_x
+            sxx+=weight*dx*dx
+            sxy+=weight*dx*(y-y0-mean_y)
+        # can't tell the drift from a single point in time
+        if sxx > 0:
+            self._ms_ns=sxy/sxx
+        self._offset_ns=y0+mean_y-(x0+mean_x)*self._ms_ns
+
+        bound=None
+        for rtt_ns,rtc,middle_ns in self._round_trips.values():
+            error=abs(self._model(rtc)-middle_ns)+rtt_ns/2.0+_RTC_RESOLUTION_NS/2.0
+            if bound is None or error > bound:
+                bound=error
+        self._error_bound_ns=bound
+
+    def host_ns(self,rtc):
+        '''host time (ns) of an unwrapped rtc, None if there's no fit yet'''
+        self._lock.acquire()
+        try:
+            if self._changed:
+                self._fit()
+            if self._offset_ns is None:
+                return None
+            return int(round(self._model(rtc)))
+        finally:
+            self._lock.release()
+
+    def rtc(self,host_ns):
+        '''the (unwrapped) rtc the box would have given at a host time'''
+        offset_ns=self.offset_ns
+        if offset_ns is None:
+            return None
+        return int((host_ns-offset_ns)//self.ms_ns)
+
+    def report_host_ns(self,report):
+        '''host time (ns) of the rtc on a report'''
+        return self.host_ns(self.unwrap(report.rtc))
+
+    def sync(self,commands,count=8):
+        '''
+        add count RTCGET round trips made with commands (a Commands),
+        returns the number that got a reply
+        '''
+        replies=0
+        for i in range(count):
+            send_ns=host_ns()
+            rep=commands.send_wait_reply(COMMAND.RTCGET,REPORT.RTCREP)
+            if rep is None:
+                continue
+            receive_ns=rep.timestamp_ns
+            if receive_ns is None:
+                receive_ns=host_ns()
+            self.add_round_trip(send_ns,rep.rtc,receive_ns)
+            replies+=1
+        return replies
+
+    def _report_received(self,report_data,report):
+        if report.id == REPORT.HBREP and report.timestamp_ns is not None:
+            self.add_heartbeat(report.rtc,report.timestamp_ns)
+
+    def attach(self,commands):
+        '''add the heartbeats received by commands (a Commands) as they arrive'''
+        commands.add_raw_callback(self._report_received)
+
+    def detach(self,commands):
+        commands.remove_raw_callback(self._report_received)
@@ -0,0 +1,374 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+'''
+several boxes used together, e.g. one per participant.
+
+BoxGroup opens every box that's plugged in and reads the reports from
+all of them on one thread (a hid.ReportReader), rather than a thread per
+box.  the reports go on one queue, in the order they arrived (so ordered
+by their timestamp_ns), tagged with the serial number of the box they
+came from, e.g.
+
+    group=BoxGroup()
+    print(group.serial_nums)
+    group.map(lambda usbbox: usbbox.leds.set_lines({0:0}))
+    while True:
+        box_report=group.get()
+        print(box_report.serial_num,box_report.report)
+
+or the callbacks added to each box's Commands can be called, in the same
+order, with group.process_received_reports().  commands are sent to the
+boxes as usual (group[serial_num] is the USBBox), and map() runs a
+function for every box at once on a pool of threads, so setting up all
+the boxes takes about as long as setting up one.
+
+broadcast() sends one command to all the boxes as close together as it
+can, e.g. to turn on every box's leds with a stimulus:
+
+    result=group.broadcast(COMMAND.P2SET,REPORT.PXREP,0x00)
+    print(result.max_skew_ns,result.replies)
+
+the boxes' clocks all drift differently, so the rtcs on reports from
+different boxes can't be compared.  sync_clocks() fits each box's clock
+to the host's (see ioLabs_clock), after which the rtc on any report can
+be turned into host time, on the same timeline for all the boxes:
+
+    group.sync_clocks(reset=True)
+    box_report=group.wait_for_keydown()
+    press_ns=group.report_host_ns(box_report)
+    print(group.error_bound_ns)
+'''
+
+from multiprocessing.pool import ThreadPool
+from threading import Thread, Event
+
+import hid
+from hid import host_ns
+from ioLabs import (USBBox, ReportQueue, ReportFuture, Empty, COMMAND, REPORT, dict_struct,
+                    IO_LABS_VENDOR_ID, BUTTON_BOX_PRODUCT_ID)
+from ioLabs_clock import ClockSync
+
+
+class BoxReport(object):
+    '''a report and the serial number of the box it came from'''
+    __slots__=('serial_num','report')
+
+    def __init__(self,serial_num,report):
+        self.serial_num=serial_num
+        self.report=report
+
+    # so a ReportQueue can drop them by id
+    id=property(lambda self: self.report.id)
+
+    timestamp_ns=property(lambda self: self.report.timestamp_ns)
+    '''host time the report was received'''
+
+    def __repr__(self):
+        return 'BoxReport(%r,%r)' % (self.serial_num,self.report)
+
+
+class _BoxQueue(object):
+    '''
+    stands in for the ReportQueue of a box in a group, putting its
+    reports on the group's queue
+    '''
+    def __init__(self,queue):
+        self.queue=queue
+        self.serial_num=None
+
+    def put(self,report,block=True,timeout=None):
+        self.queue.put(BoxReport(self.serial_num,report))
+
+    def empty(self):
+        return True
+
+    def get(self,block=True,timeout=None):
+        raise RuntimeError("reports from boxes in a BoxGroup are received with the group")
+
+    get_nowait=get
+
+    def drain(self):
+        return []
+
+
+class _BroadcastSend(object):
+    '''sending an already packed command to one box, for BoxGroup.broadcast'''
+    def __init__(self,usbbox,command_id,report_id,args,report_data):
+        self.usbbox=usbbox
+        self.command_id=command_id
+        self.args=args
+        self.report_data=report_data
+        self.future=None
+        if report_id is not None:
+            self.future=ReportFuture(report_id)
+        self.sent_ns=None
+        self.error=None
+
+    def _write(self):
+        commands=self.usbbox.commands
+        if commands.shadow is not None:
+            commands.shadow.command_sent(self.command_id,self.args)
+        try:
+            commands.device.set_report(self.report_data)
+        except:
+            if commands.shadow is not None:
+                commands.shadow.invalidate()
+            raise
+        self.sent_ns=host_ns()
+
+    def run(self):
+        try:
+            if self.future is None:
+                self._write()
+            else:
+                # waiting for the reply before it's sent, as submit does
+                self.usbbox.commands._wait_for(self.future,self._write)
+        except Exception as e:
+            self.error=e
+
+    def cancel(self):
+        if self.future is not None:
+            self.usbbox.commands.cancel(self.future)
+
+    def reply(self):
+        if self.future is None:
+            return None
+        return self.usbbox.commands.wait_for_reply(self.future)
+
+def _send_in_parallel(sends):
+    '''run the sends on a thread each, let go of all at once'''
+    go=Event()
+    threads=[]
+    for send in sends:
+        ready=Event()
+        def run(send=send,ready=ready):
+            ready.set()
+            go.wait()
+            send.run()
+        thread=Thread(target=run)
+        thread.daemon=True
+        thread.start()
+        threads.append((thread,ready))
+    for thread,ready in threads:
+        ready.wait()
+    go.set()
+    for thread,ready in threads:
+        thread.join()
+
+
+class BoxGroup(object):
+    '''
+    all the boxes plugged in (or the given HIDDevices), read from one
+    thread.  boxes is the list of USBBoxes and serial_nums their serial
+    numbers, in the same order.  the boxes are opened (and reset, if
+    do_reset is set) at the same time on a pool of up to workers threads.
+    report_queue can be used to give a ReportQueue for the reports of all
+    the boxes, with a different capacity or overflow policy
+    '''
+    def __init__(self,do_reset=True,devices=None,report_queue=None,shadow=False,workers=8):
+        if devices is None:
+            devices=hid.find_hid_devices(IO_LABS_VENDOR_ID,BUTTON_BOX_PRODUCT_ID)
+        if not devices:
+            raise RuntimeError("could not find any button boxes - check they're plugged in")
+
+        if report_queue is None:
+            # drop heartbeats before anything else if the queue fills up
+            report_queue=ReportQueue(drop_ids=(REPORT.HBREP,))
+        self.queue=report_queue
+        '''the ReportQueue of BoxReports received from all the boxes'''
+
+        self._reader=hid.ReportReader()
+        self._pool=ThreadPool(min(workers,len(devices)))
+        try:
+            for device in devices:
+                device.open()
+                self._reader.add(device)
+            self._reader.start()
+            self._do_reset=do_reset
+            self._shadow=shadow
+            self.boxes=self.map(self._open_box,devices)
+        except:
+            self.close(devices)
+            raise
+        self.serial_nums=[usbbox.commands.queue.serial_num for usbbox in self.boxes]
+        self._boxes=dict(zip(self.serial_nums,self.boxes))
+        self.clocks={}
+        '''serial number -> the ClockSync for the box (see sync_clocks)'''
+        if len(self._boxes) != len(self.boxes):
+            self.close()
+            raise RuntimeError("boxes have the same serial number: %s" % ','.join(self.serial_nums))
+
+    def _open_box(self,device):
+        queue=_BoxQueue(self.queue)
+        usbbox=USBBox(False,device,queue,self._shadow)
+        queue.serial_num=usbbox.serial_num
+        if self._do_reset:
+            usbbox.reset_box()
+        return usbbox
+
+    def __len__(self):
+        return len(self.boxes)
+
+    def __iter__(self):
+        return iter(self.boxes)
+
+    def __getitem__(self,serial_num):
+        '''the USBBox with the given serial number'''
+        return self._boxes[serial_num]
+
+    def map(self,function,boxes=None):
+        '''
+        call function with each of boxes (all the boxes, if not given) at
+        the same time, on the pool's threads.  returns a list of the
+        results, in the same order.  if any call raises an exception it's
+        raised once they have all finished
+        '''
+        if boxes is None:
+            boxes=self.boxes
+        return self._pool.map(function,boxes,1)
+
+    def broadcast(self,command_id,report_id,*args,**kw):
+        '''
+        send a command (with the args) to all the boxes (or those in
+        boxes=[...]) and, if report_id isn't None, wait for their replies.
+        the command is packed once and written to each box in turn as
+        quickly as possible, before waiting for any replies.  with
+        parallel=True each box is written to by a thread of its own, all
+        started together (quicker if writes block, as on windows).
+        returns a dict_struct of
+        
+        * sent_ns - serial number -> host time the write to the box returned
+        * skew_ns - serial number -> how long after the first box's write
+          returned its write did
+        * max_skew_ns - the largest skew_ns
+        * replies - serial number -> the reply (None if it didn't arrive,
+          or report_id is None)
+        '''
+        boxes=kw.get('boxes')
+        if boxes is None:
+            boxes=self.boxes
+        report_data=getattr(COMMAND,COMMAND.name_from_id(command_id).lower())(*args)
+        sends=[_BroadcastSend(usbbox,command_id,report_id,args,report_data) for usbbox in boxes]
+        try:
+            if kw.get('parallel'):
+                _send_in_parallel(sends)
+            else:
+                for send in sends:
+                    send.run()
+            for send in sends:
+                if send.error is not None:
+                    raise send.error
+        except:
+            for send in sends:
+                send.cancel()
+            raise
+        
+        sent_ns={}
+        replies={}
+        for send in sends:
+            serial_num=send.usbbox.commands.queue.serial_num
+            sent_ns[serial_num]=send.sent_ns
+            replies[serial_num]=send.reply()
+        first_ns=min(sent_ns.values())
+        skew_ns=dict((serial_num,timestamp_ns-first_ns) for serial_num,timestamp_ns in sent_ns.items())
+        return dict_struct(sent_ns=sent_ns,skew_ns=skew_ns,max_skew_ns=max(skew_ns.values()),
+                           replies=replies)
+
+    def sync_clocks(self,reset=False,count=8):
+        '''
+        fit each box's clock to the host's with count RTCGET round trips
+        (to all the boxes at once), and from then on with their heartbeats.
+        if reset is set the boxes' clocks are reset first, with broadcast,
+        so their rtcs start (nearly) together.  can be called again to
+        update the fits (or after resetting the clocks).  returns
+        error_bound_ns
+        '''
+        for serial_num,usbbox in zip(self.serial_nums,self.boxes):
+            if serial_num not in self.clocks:
+                self.clocks[serial_num]=ClockSync()
+                self.clocks[serial_num].attach(usbbox.commands)
+        if reset:
+            self.broadcast(COMMAND.RESRTC,REPORT.KEYREP)
+            for clock in self.clocks.values():
+                clock.reset()
+        def sync(usbbox):
+            self.clocks[usbbox.commands.queue.serial_num].sync(usbbox.commands,count)
+        self.map(sync)
+        return self.error_bound_ns
+
+    def _get_error_bound_ns(self):
+        bounds=[clock.error_bound_ns for clock in self.clocks.values()]
+        if not bounds or None in bounds:
+            return None
+        return max(bounds)
+    error_bound_ns=property(_get_error_bound_ns)
+    '''
+    bound on the error of host times from report_host_ns (the largest
+    ClockSync.error_bound_ns of the boxes), None until sync_clocks is called
+    '''
+
+    def report_host_ns(self,box_report):
+        '''
+        host time (ns) of the rtc on a BoxReport, None if the box's clock
+        hasn't been synchronized
+        '''
+        clock=self.clocks.get(box_report.serial_num)
+        if clock is None:
+            return None
+        return clock.report_host_ns(box_report.report)
+
+    def get(self,block=True,timeout=None):
+        '''
+        remove and return the oldest BoxReport.  raises Queue.Empty if
+        there are none (after waiting up to timeout seconds if block is set)
+        '''
+        return self.queue.get(block,timeout)
+
+    def get_received_reports(self):
+        '''return a list of the BoxReports received (removes them from the queue)'''
+        return self.queue.drain()
+
+    def clear_received_reports(self):
+        self.queue.drain()
+
+    def process_received_reports(self,block=False,timeout=10):
+        '''
+        call the callbacks of each box's Commands for the reports received
+        from it, in the order they arrived.  returns immediately if there
+        are no reports, unless block is set
+        '''
+        while block or not self.queue.empty():
+            box_report=self.queue.get(block,timeout)
+            self._boxes[box_report.serial_num].commands._process_report(box_report.report)
+            block=False
+
+    def wait_for_report(self,report_id,timeout=2):
+        '''
+        wait for a report with the given id from any of the boxes and
+        return the BoxReport (None if none arrives within timeout seconds).
+        earlier reports are processed as by process_received_reports
+        '''
+        try:
+            while True:
+                box_report=self.queue.get(True,timeout)
+                if box_report.id == report_id:
+                    return box_report
+                self._boxes[box_report.serial_num].commands._process_report(box_report.report)
+        except Empty:
+            return None
+
+    def wait_for_keydown(self):
+        '''wait for a key to be pressed on any box and return the BoxReport'''
+        return self.wait_for_report(REPORT.KEYDN)
+
+    def close(self,devices=None):
+        '''stop reading from the boxes and close them'''
+        self._reader.stop()
+        for serial_num,clock in getattr(self,'clocks',{}).items():
+            clock.detach(self[serial_num].commands)
+        if devices is None:
+            devices=[usbbox.device for usbbox in self.boxes]
+        for device in devices:
+            device.close()
+        self._pool.close()
+        self._pool.join()
@@ -0,0 +1,577 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+'''
+binary recordings of the reports received from a box.
+
+a session file is a 64 byte header followed by one 16 byte record per
+report: the 8 bytes of the report as they came from the box and the host
+time it was received, in nanoseconds (little endian 64 bit int).  the
+header holds the box's serial number and firmware versions and the time
+the recording started (both wall clock and host clock).
+
+record with USBBox.start_recording(report_ids,out_file,binary=True), or
+use a SessionRecorder directly.  text logs made by start_recording can be
+converted with
+
+    python ioLabs_session.py convert log.txt session.iolabs
+
+SessionReader gives random access to a session file (without reading it
+all in) and finds the reports in a range of host or box time, e.g.
+
+    reader=SessionReader('session.iolabs')
+    for timestamp_ns,report in reader.between_rtc(60000,120000,[REPORT.KEYDN]):
+        ...
+
+Replay feeds a session back through a USBBox, e.g. to test or profile
+the callbacks of an experiment without a box:
+
+    usbbox=USBBox(do_reset=False,device=ReplayDevice())
+    usbbox.commands.add_callback(REPORT.KEYDN,key_pressed)
+    usbbox.commands.dispatch_directly(REPORT.KEYDN)
+    print(Replay(reader,usbbox,speed=10).run())
+'''
+
+from __future__ import print_function
+
+import bisect
+import re
+import struct
+import sys
+import time
+from collections import deque
+from threading import Thread, Event, Lock
+
+import hid
+from hid import host_ns
+import ioLabs
+from ioLabs import REPORT
+from ioLabs_clock import unwrap_rtc
+
+MAGIC=b'IOLABSRS'
+FORMAT_VERSION=1
+
+HEADER_SIZE=64
+# magic, format version, header size, serial number, main and voice key
+# firmware versions (release,revision), start time (seconds since the
+# epoch), start time (host clock, nanoseconds)
+_HEADER=struct.Struct('<8sHH16sBBBBdq')
+RECORD=struct.Struct('<8sq')
+'''one record: the report data and the host time it was received (ns)'''
+RECORD_SIZE=RECORD.size
+
+class SessionHeader(object):
+    '''the information at the start of a session file'''
+    size=HEADER_SIZE
+    
+    def __init__(self,serial_num='',version=(0,0),voice_version=(0,0),
+                 start_time=None,start_ns=None):
+        if start_time is None:
+            start_time=time.time()
+        if start_ns is None:
+            start_ns=host_ns()
+        self.serial_num=serial_num
+        self.version=tuple(version)
+        self.voice_version=tuple(voice_version)
+        self.start_time=start_time
+        self.start_ns=start_ns
+
+    def pack(self):
+        header=_HEADER.pack(MAGIC,FORMAT_VERSION,HEADER_SIZE,
+                            self.serial_num.encode('ascii'),
+                            self.version[0],self.version[1],
+                            self.voice_version[0],self.voice_version[1],
+                            self.start_time,self.start_ns)
+        return header+b'\0'*(HEADER_SIZE-len(header))
+
+    @classmethod
+    def unpack(cls,data):
+        '''create a SessionHeader from the start of a session file'''
+        if len(data) < _HEADER.size:
+            raise ValueError("not a session file (too short)")
+        (magic,format_version,header_size,serial_num,rel_main,rev_main,
+         rel_dtvk,rev_dtvk,start_time,start_ns)=_HEADER.unpack(data[:_HEADER.size])
+        if magic != MAGIC:
+            raise ValueError("not a session file")
+        if format_version != FORMAT_VERSION:
+            raise ValueError("unsupported session format version: %d" % format_version)
+        header=cls(serial_num.rstrip(b'\0').decode('ascii'),(rel_main,rev_main),
+                   (rel_dtvk,rev_dtvk),start_time,start_ns)
+        header.size=header_size
+        return header
+
+    def wall_time(self,timestamp_ns):
+        '''convert a host time from a record to seconds since the epoch'''
+        return self.start_time+(timestamp_ns-self.start_ns)/1e9
+
+    def __repr__(self):
+        return 'SessionHeader(%r,%r,%r,%r,%r)' % (self.serial_num,self.version,
+            self.voice_version,self.start_time,self.start_ns)
+
+class SessionRecorder(object):
+    '''
+    writes reports to a session file.  record() only adds the report to
+    a buffer, a background thread writes them out every flush_interval
+    seconds, so the thread receiving the reports never waits for the disk.
+    report_ids limits the reports recorded (all of them if None).
+    if writing fails the thread stops, and the error is raised by the
+    next call to record() or close()
+    '''
+    def __init__(self,out_file,header=None,report_ids=None,flush_interval=0.1):
+        if header is None:
+            header=SessionHeader()
+        self.out_file=out_file
+        self.header=header
+        self.report_ids=None
+        if report_ids is not None:
+            self.report_ids=frozenset(report_ids)
+        self.flush_interval=flush_interval
+        self.count=0
+        '''number of reports recorded'''
+        self._records=deque()
+        self._write_lock=Lock()
+        self._closed=Event()
+        self._error=None
+        out_file.write(header.pack())
+        self._thread=Thread(target=self._run)
+        self._thread.daemon=True
+        self._thread.start()
+
+    def record(self,report_data,report=None,timestamp_ns=None):
+        '''
+        add a report to the session.  the arguments match those given to
+        Commands raw callbacks, so this can be passed to add_raw_callback
+        '''
+        if self._error is not None:
+            raise self._error
+        if timestamp_ns is None and report is not None:
+            timestamp_ns=getattr(report,'timestamp_ns',None)
+        if timestamp_ns is None:
+            timestamp_ns=host_ns()
+        if self.report_ids is not None:
+            if report is None:
+                report=REPORT.parse(report_data)
+            if report.id not in self.report_ids:
+                return
+        self._records.append(RECORD.pack(bytes(report_data),timestamp_ns))
+        self.count+=1
+
+    def _run(self):
+        closed=self._closed
+        while not closed.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                # for record() or close() to raise
+                self._error=e
+                return
+
+    def flush(self):
+        '''write out the reports that have been recorded'''
+        self._write_lock.acquire()
+        try:
+            records=self._records
+            popleft=records.popleft
+            data=[]
+            try:
+                for i in range(len(records)):
+                    data.append(popleft())
+            except IndexError:
+                pass
+            if data:
+                self.out_file.write(b''.join(data))
+            self.out_file.flush()
+        finally:
+            self._write_lock.release()
+
+    def close(self):
+        '''stop the background thread and write out any remaining reports'''
+        if self._closed.is_set():
+            return
+        self._closed.set()
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+        self.flush()
+
+def read_header(in_file):
+    '''read the SessionHeader from an open session file'''
+    header=SessionHeader.unpack(in_file.read(HEADER_SIZE))
+    if header.size > HEADER_SIZE:
+        in_file.read(header.size-HEADER_SIZE)
+    return header
+
+def read_records(in_file):
+    '''
+    generator giving (timestamp_ns,report_data) for each record in an
+    open session file (after read_header)
+    '''
+    unpack=RECORD.unpack
+    while True:
+        data=in_file.read(RECORD_SIZE*1024)
+        if not data:
+            break
+        for offset in range(0,len(data)-RECORD_SIZE+1,RECORD_SIZE):
+            report_data,timestamp_ns=unpack(data[offset:offset+RECORD_SIZE])
+            yield timestamp_ns,report_data
+
+# reports with an rtc (always the last field, so in the last 4 bytes)
+_RTC_IDS=frozenset([report_id for report_id,(name,format,field_names) in ioLabs.REPORT_SUMMARY.items()
+                    if field_names and field_names[-1] == 'rtc'])
+_RTC=struct.Struct('>I')
+_TIMESTAMP=struct.Struct('<q')
+
+class SessionReader(object):
+    '''
+    random access to the records in a session file, which is memory
+    mapped so only the parts that are looked at are read from disk.
+    records are decoded when they are asked for: reader[i] gives the
+    (timestamp_ns,report) of record i.
+    
+    records are in the order they were received, so finding a host time
+    is a binary search of the file itself.  finding a box time (rtc) uses
+    a sparse index - the rtc at the start of every index_interval records
+    - built the first time it is needed, which assumes the box's clock
+    isn't reset during the session.  rtc values are unwrapped (see
+    unwrapped_rtc) so they keep going up if the clock wraps around
+    '''
+    def __init__(self,path,index_interval=1024):
+        import mmap
+        self._file=open(path,'rb')
+        try:
+            self._map=mmap.mmap(self._file.fileno(),0,access=mmap.ACCESS_READ)
+        except:
+            self._file.close()
+            raise
+        self.header=SessionHeader.unpack(self._map[:HEADER_SIZE])
+        self._start=self.header.size
+        self._count=(len(self._map)-self._start)//RECORD_SIZE
+        self.index_interval=index_interval
+        self._rtc_index=None
+    
+    def close(self):
+        self._map.close()
+        self._file.close()
+    
+    def __len__(self):
+        return self._count
+    
+    def _offset(self,index):
+        if index < 0:
+            index+=self._count
+        if not 0 <= index < self._count:
+            raise IndexError("record index out of range")
+        return self._start+index*RECORD_SIZE
+    
+    def record(self,index):
+        '''(timestamp_ns,report_data) of a record, without parsing the report'''
+        report_data,timestamp_ns=RECORD.unpack_from(self._map,self._offset(index))
+        return timestamp_ns,report_data
+    
+    def __getitem__(self,index):
+        timestamp_ns,report_data=self.record(index)
+        return timestamp_ns,REPORT.parse(report_data)
+    
+    def __iter__(self):
+        for index in range(self._count):
+            yield self[index]
+    
+    def timestamp(self,index):
+        '''host time of a record (ns)'''
+        return _TIMESTAMP.unpack_from(self._map,self._offset(index)+8)[0]
+    
+    def _rtc(self,index):
+        '''rtc of a record, or None for reports without one'''
+        offset=self._offset(index)
+        if ord(self._map[offset:offset+1]) not in _RTC_IDS:
+            return None
+        return _RTC.unpack_from(self._map,offset+4)[0]
+    
+    def index_at_time(self,timestamp_ns):
+        '''
+        index of the first record received at or after timestamp_ns.
+        this is a binary search, so assumes the timestamps never go down,
+        which they can in files from convert_text_log (where rtcs stand in
+        for the host times that weren't logged)
+        '''
+        low,high=0,self._count
+        while low < high:
+            middle=(low+high)//2
+            if self.timestamp(middle) < timestamp_ns:
+                low=middle+1
+            else:
+                high=middle
+        return low
+    
+    def _build_rtc_index(self):
+        '''
+        list of (unwrapped rtc,index) for the first record with an rtc in
+        each block of index_interval records.  only the start of each block
+        is read (up to its first record with an rtc), the blocks are much
+        closer together than the 2^31 ms unwrapping can cope with
+        '''
+        rtc_index=[]
+        last=None
+        for start in range(0,self._count,self.index_interval):
+            for index in range(start,min(start+self.index_interval,self._count)):
+                rtc=self._rtc(index)
+                if rtc is not None:
+                    last=unwrap_rtc(rtc,last)
+                    rtc_index.append((last,index))
+                    break
+        return rtc_index
+    
+    def index_at_rtc(self,rtc):
+        '''
+        index of the first record with an (unwrapped) rtc at or after rtc.
+        records without an rtc go with the record before them
+        '''
+        if self._rtc_index is None:
+            self._rtc_index=self._build_rtc_index()
+        rtc_index=self._rtc_index
+        # the last block starting before rtc, then look through from there
+        block=bisect.bisect_left(rtc_index,(rtc,-1))-1
+        if block < 0:
+            return 0
+        last,index=rtc_index[block]
+        index+=1
+        while index < self._count:
+            record_rtc=self._rtc(index)
+            if record_rtc is not None:
+                last=unwrap_rtc(record_rtc,last)
+                if last >= rtc:
+                    return index
+            index+=1
+        return self._count
+    
+    def _between(self,start,end,report_ids):
+        if report_ids is None:
+            for index in range(start,end):
+                yield self[index]
+            return
+        report_ids=frozenset(report_ids)
+        mapped=self._map
+        for index in range(start,end):
+            offset=self._start+index*RECORD_SIZE
+            if ord(mapped[offset:offset+1]) in report_ids:
+                yield self[index]
+    
+    def between(self,start_ns,end_ns,report_ids=None):
+        '''
+        generator giving the (timestamp_ns,report) of the records received
+        from start_ns up to (but not including) end_ns, only those with the
+        given report ids if report_ids is given
+        '''
+        return self._between(self.index_at_time(start_ns),self.index_at_time(end_ns),report_ids)
+    
+    def between_rtc(self,start_rtc,end_rtc,report_ids=None):
+        '''as between, for the box's time (ms) - see index_at_rtc'''
+        return self._between(self.index_at_rtc(start_rtc),self.index_at_rtc(end_rtc),report_ids)
+
+class ReplayDevice(hid.HIDDevice):
+    '''
+    stands in for the box when replaying a session: it is always open,
+    reads nothing and keeps the commands sent to it in 'sent' (it never
+    replies, so create the USBBox with do_reset=False)
+    '''
+    def __init__(self):
+        hid.HIDDevice.__init__(self,ioLabs.IO_LABS_VENDOR_ID,ioLabs.BUTTON_BOX_PRODUCT_ID)
+        self.sent=[]
+    
+    def is_open(self):
+        return True
+    
+    def open(self):
+        pass
+    
+    def set_report(self,report_data,report_id=0):
+        hid.HIDDevice.set_report(self,report_data,report_id)
+        self.sent.append(bytes(report_data))
+    
+    def set_interrupt_report_callback(self,callback,report_buffer_size=8):
+        # the reports come from Replay, so there is no thread to start
+        self._callback=callback
+
+class Replay(object):
+    '''
+    feeds the reports in a session (a SessionReader, or any sequence of
+    (timestamp_ns,report_data)) back in through the callback of the
+    device of a USBBox or Commands, as if they had come from the box, so
+    they are parsed, matched, queued and dispatched in the usual way.
+    
+    speed sets how fast: 1.0 keeps the original timing, 2.0 is twice as
+    fast and None as fast as possible.  the reports are given the host
+    times they were recorded with.  run() replays on the current
+    thread (start() on a new one) and returns a dict_struct of:
+    
+    * reports - number of reports replayed
+    * elapsed - seconds taken
+    * reports_per_s - reports replayed per second
+    * max_lag - the most a report was late (seconds, 0 if speed is None)
+    * dropped - reports dropped from the Commands' queue, by id
+    * dropped_total - total reports dropped
+    '''
+    def __init__(self,records,target,speed=1.0):
+        commands=getattr(target,'commands',target)
+        self.records=records
+        self.commands=commands
+        self.device=commands.device
+        self.speed=speed
+        self.stats=None
+        self._stopped=Event()
+        self._thread=None
+    
+    def run(self):
+        '''replay the session and return the stats'''
+        self._stopped.clear()
+        queue=self.commands.queue
+        dropped_before=dict(getattr(queue,'dropped',{}))
+        device=self.device
+        callback=device._callback
+        speed=self.speed
+        stopped=self._stopped.is_set
+        # waiting on the event, so stop() doesn't have to wait for the gap
+        wait=self._stopped.wait
+        now=ioLabs._now
+        
+        count=0
+        max_lag=0.0
+        first_ns=None
+        start=now()
+        for timestamp_ns,report_data in self._records():
+            if speed:
+                if first_ns is None:
+                    first_ns=timestamp_ns
+                due=start+(timestamp_ns-first_ns)/(1e9*speed)
+                delay=due-now()
+                if delay > 0:
+                    if wait(delay):
+                        break
+                    delay=due-now()
+                if -delay > max_lag:
+                    max_lag=-delay
+            if stopped():
+                break
+            device.report_timestamp_ns=timestamp_ns
+            callback(device,report_data)
+            count+=1
+        elapsed=now()-start
+        
+        dropped={}
+        for report_id,total in getattr(queue,'dropped',{}).items():
+            if total > dropped_before.get(report_id,0):
+                dropped[report_id]=total-dropped_before.get(report_id,0)
+        if elapsed > 0:
+            reports_per_s=count/elapsed
+        else:
+            reports_per_s=None
+        self.stats=ioLabs.dict_struct(reports=count,elapsed=elapsed,reports_per_s=reports_per_s,
+                                      max_lag=max_lag,dropped=dropped,
+                                      dropped_total=sum(dropped.values()))
+        return self.stats
+    
+    def _records(self):
+        records=self.records
+        if isinstance(records,SessionReader):
+            # the raw data, so each report is only parsed by Commands
+            return (records.record(index) for index in range(len(records)))
+        return records
+    
+    def start(self):
+        '''replay on a new thread, join() waits for it to finish'''
+        self._thread=Thread(target=self.run)
+        self._thread.daemon=True
+        self._thread.start()
+    
+    def stop(self):
+        '''stop replaying (from another thread)'''
+        self._stopped.set()
+    
+    def join(self,timeout=None):
+        '''wait for a replay started with start() and return the stats'''
+        self._thread.join(timeout)
+        return self.stats
+
+def _string_fields(report_id):
+    '''names of the fields of a report that are strings rather than ints'''
+    name,format,field_names=ioLabs.REPORT_SUMMARY[report_id]
+    codes=[code for count,code in re.findall(r'(\d*)([a-zA-Z?])',format) if code != 'x']
+    return set([field for field,code in zip(field_names,codes) if code == 's'])
+
+def _text_fields(line):
+    '''dictionary of the fields of a report printed with str()'''
+    fields={}
+    for item in line.strip().split(','):
+        name,value=item.split('=',1)
+        fields[name]=value
+    return fields
+
+def _pack_text_fields(fields):
+    report_id=int(fields['id'])
+    if report_id not in ioLabs.REPORT_SUMMARY:
+        raise ValueError("unknown report id: %d" % report_id)
+    name,format,field_names=ioLabs.REPORT_SUMMARY[report_id]
+    strings=_string_fields(report_id)
+    values=[]
+    for field in field_names:
+        value=fields[field]
+        if field in strings:
+            if value[:2] in ("b'",'b"'):
+                value=value[2:-1] # bytes as printed by python 3
+            values.append(value.encode('ascii'))
+        else:
+            values.append(int(value))
+    return getattr(REPORT,name.lower())(*values)
+
+def parse_text_report(line):
+    '''
+    turn a line written by the text recording (a report printed with
+    str()) back into the report data
+    '''
+    return _pack_text_fields(_text_fields(line))
+
+def convert_text_log(in_file,out_file,header=None):
+    '''
+    convert a text log from start_recording to a session file, returns the
+    number of reports converted.  the host times the reports were received
+    are used if they were logged, older logs don't have them so the box's
+    clock (rtc) is used instead, or the time of the report before for
+    reports without one.  raises ValueError, giving the line, for a line
+    that isn't a report that can be converted
+    '''
+    if header is None:
+        header=SessionHeader(start_ns=0)
+    out_file.write(header.pack())
+    timestamp_ns=header.start_ns
+    count=0
+    for line_num,line in enumerate(in_file):
+        if not line.strip():
+            continue
+        try:
+            fields=_text_fields(line)
+            report_data=_pack_text_fields(fields)
+        except (ValueError,KeyError,struct.error) as e:
+            raise ValueError("can't convert line %d (%s): %s" % (line_num+1,e,line.strip()))
+        if fields.get('timestamp_ns','None') != 'None':
+            timestamp_ns=int(fields['timestamp_ns'])
+        elif 'rtc' in fields:
+            timestamp_ns=header.start_ns+int(fields['rtc'])*1000000
+        out_file.write(RECORD.pack(report_data,timestamp_ns))
+        count+=1
+    return count
+
+def main(argv):
+    if len(argv) != 3 or argv[0] != 'convert':
+        print('usage: ioLabs_session.py convert <text log> <session file>')
+        return 1
+    in_file=open(argv[1])
+    out_file=open(argv[2],'wb')
+    try:
+        count=convert_text_log(in_file,out_file)
+    finally:
+        in_file.close()
+        out_file.close()
+    print('converted %d reports' % count)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
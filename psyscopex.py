@@ -9,7 +9,6 @@ the same way as for a HID device
 '''
 
 import logging
-import struct
 from ctypes import *
 
 from hid import HIDDevice
@@ -334,14 +333,15 @@ class PsyScopeXUSBDevice(HIDDevice):
         '''
         HIDDevice.set_report(self,report_data,report_id)
 
-        # copy data into a ctypes buffer
-        report_buffer=(c_ubyte*len(report_data))()
-        for i,c in enumerate(report_data):
-            report_buffer[i]=struct.unpack('B',c)[0]
-        
-        ioret=self._devInterface.WritePipe(2, report_buffer, len(report_data))
+        self._write_lock.acquire()
+        try:
+            # copy data into a ctypes buffer
+            report_buffer,size=self._copy_to_output_buffer(report_data)
+            ioret=self._devInterface.WritePipe(2, report_buffer, size)
+        finally:
+            self._write_lock.release()
         if ioret != kIOReturnSuccess:
-            logging.info("error writing to device: 0x%x" % long(ioret))
+            logging.info("error writing to device: 0x%x" % int(ioret))
     
     def _run_interrupt_callback_loop(self,report_buffer_size):
         if not self.is_open():
@@ -357,12 +357,6 @@ class PsyScopeXUSBDevice(HIDDevice):
             size=UInt32(report_buffer_size)
             ioret=self._devInterface.ReadPipe(1, byref(report_buffer), byref(size))
             if ioret == kIOReturnSuccess:
-                report_data="".join([struct.pack('B',b) for b in report_buffer])
-                # zero buffer after to ensure we don't get weird-ness
-                # if it's not fully written to later
-                for i in range(len(report_buffer)):
-                    report_buffer[i]=0
-                logging.info('interrupt_report_callback(%r)',report_data)
-                self._callback(self,report_data)
+                self._deliver_report(report_buffer,report_buffer_size)
             else:
-                logging.info("error reading from device: 0x%x" % long(ioret))
+                logging.info("error reading from device: 0x%x" % int(ioret))
@@ -5,13 +5,21 @@ try:#handy to build eggs if possible so people can easy_install
 except:#distutils fallback
     from distutils.core import setup
 
+import sys
+
 import ioLabs
+
+py_modules=['ioLabs', 'ioLabs_clock', 'ioLabs_group', 'ioLabs_session', 'psyscopex']
+if sys.version_info >= (3,5):
+    # uses async def
+    py_modules.append('ioLabs_async')
+
 setup(name='ioLabs',
       version=ioLabs.__version__,
       description='ioLab response box library',
       author='John Montgomery',
       url='http://www.ioLab.co.uk/',
-      py_modules=['ioLabs', 'psyscopex'],
+      py_modules=py_modules,
       packages=['hid'],
 	  license='BSD-3',
       classifiers=['Development Status :: 4 - Beta',
@@ -0,0 +1,173 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+# the coroutines are driven with run_until_complete (no async syntax
+# here) so this still compiles under python 2, where they are skipped
+from ioLabs import *
+from hid.emulator import EmulatedHIDDevice, BoxFirmware
+
+import time
+import unittest
+
+try:
+    import asyncio
+    import ioLabs_async
+except (ImportError,SyntaxError):
+    raise unittest.SkipTest("ioLabs_async needs python 3.5 or later")
+
+def _open(**kw):
+    loop=asyncio.new_event_loop()
+    asyncio.set_event_loop(loop) # for gather
+    firmware=BoxFirmware(**kw)
+    usbbox=loop.run_until_complete(ioLabs_async.AsyncUSBBox.open(device=EmulatedHIDDevice(firmware)))
+    return loop,firmware,usbbox
+
+def _close(loop,usbbox):
+    usbbox.close()
+    asyncio.set_event_loop(None)
+    loop.close()
+
+def test_queries_and_setters():
+    loop,firmware,usbbox=_open()
+    run=loop.run_until_complete
+    try:
+        assert run(usbbox.get_serial_num()) == '00001'
+        assert run(usbbox.get_version()) == (3,2)
+        assert run(usbbox.buttons.get_debounce_down()) == 20
+        run(usbbox.port0.set_direction(0x0F))
+        assert firmware.dir_port0 == 0x0F
+        run(usbbox.int1.set_enabled(0))
+        assert run(usbbox.int1.get_enabled()) == 0
+        assert run(usbbox.leds.set_lines({0:0,1:0})) == 0xFC
+        assert run(usbbox.leds.set_lines({0:1,2:0})) == 0xF9 # read, then one PXSET
+        run(usbbox.voice_key.set_trigger_level(7))
+        assert run(usbbox.voice_key.get_trigger_level()) == 7
+    finally:
+        _close(loop,usbbox)
+
+def test_requests_in_flight_together():
+    loop,firmware,usbbox=_open(latency=0.05)
+    try:
+        start=time.time()
+        serial_num,state,clock=loop.run_until_complete(asyncio.gather(
+            usbbox.get_serial_num(),
+            usbbox.leds.get_state(),
+            usbbox.get_clock()))
+        assert time.time()-start < 0.14 # not one after the other
+        assert serial_num == '00001'
+        assert state == 0xFF
+        assert clock is not None
+    finally:
+        _close(loop,usbbox)
+
+def test_timeout_does_not_block_loop():
+    loop,firmware,usbbox=_open()
+    firmware.latency=0.5
+    usbbox.usbbox.commands.reply_timeout=0.1
+    ticks=[]
+    def tick():
+        ticks.append(time.time())
+        loop.call_later(0.005,tick)
+    loop.call_soon(tick)
+    try:
+        rep=loop.run_until_complete(usbbox.commands.send_wait_reply(COMMAND.RTCGET,REPORT.RTCREP))
+        assert rep is None
+        # the loop kept running while waiting for the reply
+        assert len(ticks) > 5
+        # and the request isn't waiting any more
+        assert not usbbox.usbbox.commands._pending.get(REPORT.RTCREP)
+    finally:
+        _close(loop,usbbox)
+
+def test_cancel():
+    loop,firmware,usbbox=_open()
+    firmware.latency=0.5
+    try:
+        task=loop.create_task(usbbox.get_clock())
+        loop.run_until_complete(asyncio.sleep(0.01))
+        assert usbbox.usbbox.commands._pending.get(REPORT.RTCREP)
+        task.cancel()
+        try:
+            loop.run_until_complete(task)
+        except asyncio.CancelledError:
+            pass
+        else:
+            assert False
+        assert not usbbox.usbbox.commands._pending.get(REPORT.RTCREP)
+    finally:
+        _close(loop,usbbox)
+
+def test_reports():
+    loop,firmware,usbbox=_open()
+    received=[]
+    def keyup(report):
+        received.append(report)
+    usbbox.usbbox.commands.add_callback(REPORT.KEYUP,keyup)
+    try:
+        reports=usbbox.reports(REPORT.KEYDN)
+        firmware.press(3)
+        report=loop.run_until_complete(reports.__anext__())
+        assert (report.name,report.key_code) == ('KEYDN',3)
+        firmware.release(3)
+        firmware.press(4)
+        report=loop.run_until_complete(reports.__anext__())
+        assert (report.name,report.key_code) == ('KEYDN',4)
+        # reports that weren't wanted went to the callbacks
+        assert [report.key_code for report in received] == [3]
+    finally:
+        _close(loop,usbbox)
+
+def test_wait_for_keydown():
+    loop,firmware,usbbox=_open()
+    try:
+        assert loop.run_until_complete(usbbox.wait_for_keydown(timeout=0.05)) is None
+        loop.call_later(0.01,firmware.press,5)
+        report=loop.run_until_complete(usbbox.wait_for_keydown(timeout=1))
+        assert report.key_code == 5
+    finally:
+        _close(loop,usbbox)
+
+def test_needs_async_queue():
+    usbbox=USBBox(False,EmulatedHIDDevice(BoxFirmware()))
+    try:
+        ioLabs_async.AsyncUSBBox(usbbox)
+    except ValueError:
+        pass
+    else:
+        assert False
+    finally:
+        usbbox.device.close()
+
+def test_put_after_loop_closed():
+    loop=asyncio.new_event_loop()
+    queue=ioLabs_async.AsyncReportQueue()
+    # as if a coroutine was left waiting in get_async when the loop closed
+    queue._loop=loop
+    queue._wakeup=asyncio.Event()
+    queue._async_waiting=1
+    loop.close()
+    report=REPORT.parse(REPORT.keydn(1,0))
+    queue.put(report)
+    assert queue.get_nowait() is report
+
+class SlowToOpen(EmulatedHIDDevice):
+    '''device that takes a while to open, as finding a real box can'''
+    def open(self):
+        time.sleep(0.1)
+        EmulatedHIDDevice.open(self)
+
+def test_open_does_not_block_loop():
+    loop=asyncio.new_event_loop()
+    task=loop.create_task(ioLabs_async.AsyncUSBBox.open(do_reset=False,device=SlowToOpen(BoxFirmware())))
+    ticks=[]
+    def tick():
+        ticks.append(time.time())
+        if not task.done():
+            loop.call_later(0.01,tick)
+    loop.call_soon(tick)
+    usbbox=loop.run_until_complete(task)
+    try:
+        # the loop kept running while the box was opened
+        assert len(ticks) > 3
+    finally:
+        usbbox.close()
+        loop.close()
@@ -0,0 +1,141 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+from ioLabs import *
+from ioLabs_clock import *
+from hid.emulator import EmulatedHIDDevice, BoxFirmware
+
+import random
+import time
+
+class DriftingBox(object):
+    '''
+    simulated box whose clock runs drift_ppm fast, with reports taking
+    latency_ns plus a random (exponential) delay to get to the host
+    '''
+    def __init__(self,drift_ppm,start_rtc=0,latency_ns=400000,jitter_ns=300000,seed=1):
+        self.drift_ppm=drift_ppm
+        self.start_rtc=start_rtc
+        self.latency_ns=latency_ns
+        self.jitter_ns=jitter_ns
+        self.random=random.Random(seed)
+        self.host_ns=10**12 # "now", on the host
+        self.origin_ns=self.host_ns # host time of start_rtc
+
+    def box_ms(self,host_ns):
+        '''the exact box time (ms) at a host time'''
+        return self.start_rtc+(host_ns-self.origin_ns)*(1+self.drift_ppm*1e-6)/1e6
+
+    def host_time_of(self,box_ms):
+        return self.origin_ns+(box_ms-self.start_rtc)*1e6/(1+self.drift_ppm*1e-6)
+
+    def set_drift(self,drift_ppm):
+        self.start_rtc=self.box_ms(self.host_ns)
+        self.origin_ns=self.host_ns
+        self.drift_ppm=drift_ppm
+
+    def rtc(self,host_ns):
+        return int(self.box_ms(host_ns)) & 0xFFFFFFFF
+
+    def delay(self):
+        return self.latency_ns+int(self.random.expovariate(1.0/self.jitter_ns))
+
+    def round_trip(self):
+        '''returns (send_ns,rtc,receive_ns) of an RTCGET'''
+        send_ns=self.host_ns
+        read_ns=send_ns+self.delay()
+        receive_ns=read_ns+self.delay()
+        self.host_ns=receive_ns
+        return send_ns,self.rtc(read_ns),receive_ns
+
+    def heartbeat(self):
+        '''returns (rtc,receive_ns) of a heartbeat sent now'''
+        return self.rtc(self.host_ns),self.host_ns+self.delay()
+
+def _simulate(sync,box,seconds,heartbeat_ms=1000,round_trip_every=60):
+    for second in range(0,seconds*1000,heartbeat_ms):
+        box.host_ns+=heartbeat_ms*1000000
+        sync.add_heartbeat(*box.heartbeat())
+        if second % (round_trip_every*1000) == 0:
+            for i in range(4):
+                sync.add_round_trip(*box.round_trip())
+
+def _max_error_ms(sync,box,count=200):
+    '''largest error converting rtcs from the last minute to host time'''
+    worst=0
+    for i in range(count):
+        host_ns=box.host_ns-box.random.uniform(0,60e9)
+        rtc=box.rtc(host_ns)
+        # the host time of the middle of that millisecond
+        expected=box.host_time_of(box.box_ms(host_ns)//1+0.5)
+        worst=max(worst,abs(sync.host_ns(sync.unwrap(rtc))-expected)/1e6)
+    return worst
+
+def test_unwrap_rtc():
+    assert unwrap_rtc(10,None) == 10
+    assert unwrap_rtc(10,0xFFFFFFF0) == 0x10000000A
+    assert unwrap_rtc(0xFFFFFFF0,0x10000000A) == 0xFFFFFFF0
+    assert unwrap_rtc(20,0x10000000A) == 0x100000014
+
+def test_drift_accuracy():
+    box=DriftingBox(drift_ppm=150)
+    sync=ClockSync()
+    assert sync.host_ns(0) is None
+    _simulate(sync,box,2*3600)
+    assert abs(sync.drift_ppm-150) < 1
+    assert _max_error_ms(sync,box) < 0.5
+    assert sync.error_bound_ns < 2e6
+    # the box's time at a host time
+    assert abs(sync.rtc(box.host_ns)-int(box.box_ms(box.host_ns))) <= 1
+
+def test_drift_changes():
+    box=DriftingBox(drift_ppm=-80,seed=2)
+    sync=ClockSync(max_buckets=60) # ten minutes
+    _simulate(sync,box,1800)
+    # the crystal warms up
+    box.set_drift(-40)
+    _simulate(sync,box,1800)
+    assert abs(sync.drift_ppm+40) < 2
+    assert _max_error_ms(sync,box) < 0.5
+
+def test_rtc_wraps():
+    box=DriftingBox(drift_ppm=30,start_rtc=0xFFFFFFFF-1800*1000,seed=3)
+    sync=ClockSync()
+    _simulate(sync,box,3600)
+    assert sync.unwrap(box.rtc(box.host_ns)) > 0xFFFFFFFF
+    assert _max_error_ms(sync,box) < 0.5
+
+def test_heartbeats_only():
+    box=DriftingBox(drift_ppm=200,latency_ns=0,seed=4)
+    sync=ClockSync()
+    _simulate(sync,box,3600,round_trip_every=10**6)
+    assert abs(sync.drift_ppm-200) < 2
+    assert sync.error_bound_ns is None
+
+def test_reset():
+    box=DriftingBox(drift_ppm=10)
+    sync=ClockSync()
+    _simulate(sync,box,60)
+    sync.reset()
+    assert sync.offset_ns is None
+    assert sync.min_rtt_ns is None
+
+def test_emulated_box():
+    firmware=BoxFirmware(drift_ppm=300)
+    usbbox=USBBox(device=EmulatedHIDDevice(firmware))
+    try:
+        sync=ClockSync(bucket_ms=20)
+        sync.attach(usbbox.commands)
+        usbbox.heartbeat=10
+        for i in range(5):
+            assert sync.sync(usbbox.commands,4) == 4
+            time.sleep(0.02)
+        usbbox.heartbeat=0
+        sync.detach(usbbox.commands)
+        assert sync.min_rtt_ns < 50e6
+        firmware.press(3)
+        report=usbbox.wait_for_keydown()
+        # the key press happened just before the report arrived
+        lag_ms=(report.timestamp_ns-sync.report_host_ns(report))/1e6
+        assert -1.5 < lag_ms < 5
+    finally:
+        usbbox.device.close()
@@ -0,0 +1,508 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+from ioLabs import *
+import hid
+from hid.emulator import EmulatedHIDDevice, BoxFirmware, VirtualClock
+
+try:
+    from Queue import Empty
+except ImportError:
+    from queue import Empty # python 3
+import threading
+import time
+
+def _keydn(key_code):
+    return REPORT.parse(REPORT.keydn(key_code,0))
+
+def _hbrep():
+    return REPORT.parse(REPORT.hbrep(0,100,0))
+
+def _key_codes(reports):
+    return [report.key_code for report in reports]
+
+def test_queue_drop_oldest():
+    queue=ReportQueue(capacity=3,overflow=DROP_OLDEST)
+    for i in range(5):
+        queue.put(_keydn(i))
+    assert _key_codes(queue.drain()) == [2,3,4]
+    assert queue.dropped == {REPORT.KEYDN:2}
+    assert queue.empty()
+
+def test_queue_drop_newest():
+    queue=ReportQueue(capacity=3,overflow=DROP_NEWEST)
+    for i in range(5):
+        queue.put(_keydn(i))
+    assert _key_codes(queue.drain()) == [0,1,2]
+    assert queue.dropped_total == 2
+
+def test_queue_drop_ids_first():
+    queue=ReportQueue(capacity=3,overflow=DROP_NEWEST,drop_ids=(REPORT.HBREP,))
+    queue.put(_keydn(0))
+    queue.put(_hbrep())
+    queue.put(_keydn(1))
+    queue.put(_keydn(2)) # heartbeat makes way
+    queue.put(_hbrep()) # dropped straight away
+    queue.put(_keydn(3)) # no heartbeats left, so policy applies
+    assert _key_codes(queue.drain()) == [0,1,2]
+    assert queue.dropped == {REPORT.HBREP:2,REPORT.KEYDN:1}
+
+def test_queue_drop_ids_oldest():
+    queue=ReportQueue(capacity=3,overflow=DROP_OLDEST,drop_ids=(REPORT.HBREP,))
+    queue.put(_keydn(0))
+    queue.put(_hbrep())
+    queue.put(_keydn(1))
+    queue.put(_keydn(2)) # heartbeat makes way
+    assert len(queue) == 3
+    queue.put(_keydn(3)) # no heartbeats left, so the oldest goes
+    assert queue.get(False).key_code == 1
+    queue.put(_hbrep())
+    assert [report.name for report in queue.drain()] == ['KEYDN','KEYDN','HBREP']
+    assert queue.dropped == {REPORT.HBREP:1,REPORT.KEYDN:1}
+    assert queue.empty() and len(queue) == 0
+
+def test_queue_drop_ids_many():
+    # heartbeats all through the queue make way, oldest first
+    queue=ReportQueue(capacity=200,drop_ids=(REPORT.HBREP,))
+    for i in range(100):
+        queue.put(_keydn(i))
+        queue.put(_hbrep())
+    for i in range(100,200):
+        queue.put(_keydn(i))
+    assert len(queue) == 200
+    assert queue.dropped == {REPORT.HBREP:100}
+    assert _key_codes(queue.drain()) == list(range(200))
+
+def test_queue_get():
+    queue=ReportQueue()
+    try:
+        queue.get(False)
+    except Empty:
+        pass
+    else:
+        assert False
+    start=time.time()
+    try:
+        queue.get(True,0.05)
+    except Empty:
+        pass
+    else:
+        assert False
+    assert time.time()-start >= 0.05
+
+def test_queue_get_wakes_on_put():
+    queue=ReportQueue()
+    timer=threading.Timer(0.05,lambda: queue.put(_keydn(7)))
+    timer.start()
+    assert queue.get(True,5).key_code == 7
+    timer.join()
+
+def test_commands_bounded_queue():
+    firmware=BoxFirmware(clock=VirtualClock(rate=1000))
+    device=EmulatedHIDDevice(firmware)
+    device.open()
+    try:
+        commands=Commands(device,ReportQueue(capacity=10,drop_ids=(REPORT.HBREP,)))
+        commands.hbset(1) # heartbeat every ms (1us real)
+        time.sleep(0.1)
+        commands.hbset(0)
+        time.sleep(0.01)
+        reports=commands.get_received_reports()
+        assert 0 < len(reports) <= 10
+        assert commands.queue.dropped[REPORT.HBREP] > 0
+    finally:
+        device.close()
+
+def _emulated_commands(**kw):
+    device=EmulatedHIDDevice(BoxFirmware(**kw))
+    device.open()
+    return Commands(device)
+
+def test_submit_several_in_flight():
+    commands=_emulated_commands(latency=0.05)
+    try:
+        start=time.time()
+        futures=[
+            commands.submit(COMMAND.P2SET,REPORT.PXREP,0x0F),
+            commands.submit(COMMAND.NUMGET,REPORT.NUMREP),
+            commands.submit(COMMAND.P0SET,REPORT.PXREP,0xF0),
+            commands.submit(COMMAND.VERGET,REPORT.VERREP),
+        ]
+        reports=[future.result(2) for future in futures]
+        # replies overlap rather than taking a round trip each
+        assert time.time()-start < 0.15
+        assert reports[0].port2_bits == 0x0F
+        assert reports[1].serial_num == b'00001'
+        assert (reports[2].port2_bits,reports[2].port0_bits) == (0x0F,0xF0)
+        assert reports[3].name == 'VERREP'
+        # replies do not go through the queue or the callbacks
+        assert commands.get_received_reports() == []
+    finally:
+        commands.device.close()
+
+def test_send_wait_reply_threads():
+    commands=_emulated_commands()
+    errors=[]
+    def set_port(bits):
+        for i in range(50):
+            rep=commands.send_wait_reply(COMMAND.P2SET,REPORT.PXREP,bits)
+            if rep is None or rep.port2_bits != bits:
+                errors.append((bits,rep))
+    try:
+        threads=[threading.Thread(target=set_port,args=(bits,)) for bits in (0x01,0x02,0x04,0x08)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert errors == []
+    finally:
+        commands.device.close()
+
+def test_submit_match():
+    commands=_emulated_commands()
+    try:
+        commands.device.firmware.receive_serial(b'a')
+        time.sleep(0.05)
+        future=commands.submit(COMMAND.SEROUT,REPORT.SERIN,1,ord('b'),0,0,0,0,0,
+                               match=lambda rep: rep.status_code > 6)
+        assert future.result(2).status_code == 0xF0
+        # the received byte is left for the Serial callback
+        reports=commands.get_received_reports()
+        assert [(rep.status_code,rep.data1) for rep in reports] == [(1,ord('a'))]
+    finally:
+        commands.device.close()
+
+def test_reply_timeout():
+    commands=_emulated_commands(latency=0.5)
+    commands.reply_timeout=0.05
+    try:
+        assert commands.send_wait_reply(COMMAND.RTCGET,REPORT.RTCREP) is None
+        assert not commands._pending[REPORT.RTCREP]
+        # the late reply is queued as it is no longer wanted
+        time.sleep(0.6)
+        assert [rep.name for rep in commands.get_received_reports()] == ['RTCREP']
+    finally:
+        commands.device.close()
+
+def test_future_done_callback():
+    future=ReportFuture(REPORT.PXREP)
+    done=[]
+    future.add_done_callback(done.append)
+    assert not future.done()
+    report=REPORT.parse(REPORT.pxrep(1,2,3))
+    future._set_result(report)
+    assert done == [future]
+    assert future.done() and future.result() is report
+    future.add_done_callback(done.append)
+    assert done == [future,future]
+
+def test_transaction():
+    commands=_emulated_commands()
+    try:
+        transaction=commands.transaction()
+        transaction.add(COMMAND.DEBGET,REPORT.DEBREP)
+        transaction.add(COMMAND.HBSET,None,0)
+        transaction.add(COMMAND.P2SET,REPORT.PXREP,0x3C)
+        transaction.add(COMMAND.MSKGET,REPORT.MSKREP)
+        assert len(transaction) == 4
+        debounce,nothing,state,mask=transaction.run()
+        assert len(transaction) == 0
+        assert debounce.port1_down == 20
+        assert nothing is None
+        assert state.port2_bits == 0x3C
+        assert (mask.port3_bits,mask.port1_bits) == (0x0C,0xFF)
+    finally:
+        commands.device.close()
+
+def test_transaction_in_flight_limit():
+    commands=_emulated_commands()
+    try:
+        transaction=commands.transaction()
+        transaction.max_in_flight=2
+        for bits in range(10):
+            transaction.add(COMMAND.P0SET,REPORT.PXREP,bits)
+        assert [rep.port0_bits for rep in transaction.run()] == list(range(10))
+    finally:
+        commands.device.close()
+
+def test_transaction_timeout():
+    commands=_emulated_commands(latency=0.5)
+    commands.reply_timeout=0.05
+    try:
+        transaction=commands.transaction()
+        for i in range(5):
+            transaction.add(COMMAND.RTCGET,REPORT.RTCREP)
+        start=time.time()
+        assert transaction.run() == [None]*5
+        # only waits for the first reply
+        assert time.time()-start < 0.25
+    finally:
+        commands.device.close()
+
+def test_reset_box_round_trips():
+    firmware=BoxFirmware(latency=0.02)
+    usbbox=USBBox(device=EmulatedHIDDevice(firmware))
+    try:
+        firmware.port2_mode=1
+        firmware.debounce=[1,2,3,4,5,6]
+        firmware.logic_port0=firmware.logic_port2=0x0F
+        firmware.port0=firmware.port2=0
+        firmware.mask_port1=0
+        firmware.mask_port3=0x01
+        runs=[]
+        transaction=usbbox.commands.transaction
+        def counting_transaction():
+            runs.append(1)
+            return transaction()
+        usbbox.commands.transaction=counting_transaction
+        start=time.time()
+        usbbox.reset_box()
+        # sequentially this is ~27 round trips (over half a second here)
+        assert time.time()-start < 0.25
+        assert len(runs) == 2
+        assert firmware.port2_mode == 0
+        assert firmware.debounce == [20,5,20,5,20,5]
+        assert (firmware.logic_port0,firmware.logic_port2) == (0,0)
+        assert (firmware.port0,firmware.port2) == (0xFF,0xFF)
+        assert (firmware.mask_port1,firmware.mask_port3) == (0xFF,0x0D)
+        assert firmware.heartbeat_rate == 30000
+    finally:
+        usbbox.device.close()
+
+def _shadowed_usbbox():
+    firmware=BoxFirmware()
+    return firmware,USBBox(device=EmulatedHIDDevice(firmware),shadow=True)
+
+def test_shadow_reads_are_local():
+    firmware,usbbox=_shadowed_usbbox()
+    try:
+        sent=firmware.commands_received
+        assert usbbox.port0.direction == 0
+        assert usbbox.port2.logic == 0
+        assert usbbox.port2.state == 0xFF
+        assert usbbox.buttons.enabled == 0xFF
+        assert usbbox.int1.debounce_down == 20
+        assert firmware.commands_received == sent
+    finally:
+        usbbox.device.close()
+
+def test_shadow_read_modify_write():
+    firmware,usbbox=_shadowed_usbbox()
+    try:
+        sent=firmware.commands_received
+        usbbox.port0.direction=0x0F # one DIRSET, no DIRGET
+        assert firmware.commands_received == sent+1
+        assert firmware.dir_port0 == 0x0F
+        assert usbbox.port0.direction == 0x0F
+        usbbox.port0.lines[7].direction=1
+        assert firmware.commands_received == sent+2
+        assert firmware.dir_port0 == 0x8F
+        # already set, so nothing is sent
+        usbbox.port0.direction=0x8F
+        usbbox.port2.state=0xFF
+        usbbox.port2.or_state(0x01)
+        assert firmware.commands_received == sent+2
+        assert usbbox.port2.and_state(0x0F) == 0x0F
+        assert firmware.commands_received == sent+3
+    finally:
+        usbbox.device.close()
+
+def test_shadow_invalidate_resync():
+    firmware,usbbox=_shadowed_usbbox()
+    try:
+        firmware.mask_port1=0x0F # changed behind our back
+        assert usbbox.buttons.enabled == 0xFF
+        usbbox.invalidate_shadow()
+        assert usbbox.buttons.enabled == 0x0F
+        firmware.debounce=[1,2,3,4,5,6]
+        usbbox.resync_shadow()
+        sent=firmware.commands_received
+        assert usbbox.buttons.debounce_up == 2
+        assert firmware.commands_received == sent
+    finally:
+        usbbox.device.close()
+
+def test_shadow_loopback():
+    firmware,usbbox=_shadowed_usbbox()
+    try:
+        usbbox.leds.state=0x00
+        usbbox.enable_loopback()
+        firmware.press(0)
+        time.sleep(0.05)
+        # the leds follow the buttons, so the state is read from the box
+        assert usbbox.leds.state == 0x01
+        firmware.release(0)
+        usbbox.disable_loopback()
+        usbbox.leds.state=0xFF
+        sent=firmware.commands_received
+        assert usbbox.leds.state == 0xFF
+        assert firmware.commands_received == sent
+    finally:
+        usbbox.device.close()
+
+def test_lines_are_cached():
+    firmware,usbbox=_shadowed_usbbox()
+    try:
+        assert usbbox.port0.line3 is usbbox.port0.line3
+        assert usbbox.port0.lines == usbbox.port0.lines
+        assert usbbox.port0.lines[3] is usbbox.port0.line3
+        assert usbbox.buttons.line5 is usbbox.buttons.lines[5]
+        assert type(usbbox.port0.line0) is type(usbbox.port2.line7)
+        usbbox.port2.line1.state=0
+        assert firmware.port2 == 0xFD
+    finally:
+        usbbox.device.close()
+
+def test_set_lines():
+    firmware=BoxFirmware()
+    usbbox=USBBox(device=EmulatedHIDDevice(firmware))
+    try:
+        sent=firmware.commands_received
+        command_ids=[]
+        command=firmware.command
+        def logged_command(data):
+            command_ids.append(bytearray(data)[0])
+            command(data)
+        firmware.command=logged_command
+        # lines going low: a PXAND
+        assert usbbox.leds.set_lines({0:0,1:0,7:None}) == 0xFC
+        # lines going high and low: read the ports, then one PXSET
+        rep=usbbox.set_lines(port0=[0,1,None,1],port2={0:1,5:0})
+        assert (rep.port2_bits,rep.port0_bits) == (0xDD,0xFE)
+        assert (firmware.port2,firmware.port0) == (0xDD,0xFE)
+        assert command_ids == [COMMAND.PXAND,COMMAND.PXGET,COMMAND.PXSET]
+        assert firmware.commands_received == sent+3
+        # every line given: one PXSET
+        rep=usbbox.set_lines(port0=[1]*8,port2=[0]*8)
+        assert (firmware.port2,firmware.port0) == (0x00,0xFF)
+        assert firmware.commands_received == sent+4
+        assert usbbox.set_lines() is None
+        usbbox.buttons.set_lines([0,0,1])
+        assert firmware.mask_port1 == 0xFC
+        try:
+            usbbox.leds.set_lines({8:1})
+        except ValueError:
+            pass
+        else:
+            assert False
+    finally:
+        usbbox.device.close()
+
+def test_set_lines_shadowed():
+    firmware,usbbox=_shadowed_usbbox()
+    try:
+        sent=firmware.commands_received
+        assert usbbox.leds.set_lines({0:0,1:0,7:None}) == 0xFC
+        usbbox.set_lines(port0={2:0},port2=[1,1])
+        # port state is known, so just one PXSET each
+        assert firmware.commands_received == sent+2
+        assert (firmware.port2,firmware.port0) == (0xFF,0xFB)
+    finally:
+        usbbox.device.close()
+
+def test_set_lines_numpy():
+    try:
+        import numpy
+    except ImportError:
+        return # numpy is optional
+    firmware=BoxFirmware()
+    usbbox=USBBox(device=EmulatedHIDDevice(firmware))
+    try:
+        lines=numpy.zeros(8,dtype=bool)
+        lines[[1,3]]=True
+        assert usbbox.leds.set_lines(lines) == 0x0A
+    finally:
+        usbbox.device.close()
+
+def test_dispatch_directly():
+    firmware=BoxFirmware()
+    usbbox=USBBox(device=EmulatedHIDDevice(firmware))
+    commands=usbbox.commands
+    try:
+        pressed=threading.Event()
+        keydn_threads=[]
+        def keydn(report):
+            keydn_threads.append(threading.current_thread())
+            pressed.set()
+        keyups=[]
+        def keyup(report):
+            keyups.append(report)
+        commands.add_callback(REPORT.KEYDN,keydn)
+        commands.add_callback(REPORT.KEYUP,keyup)
+        commands.dispatch_directly(REPORT.KEYDN)
+        firmware.press(3)
+        # called without process_received_reports, and not on this thread
+        assert pressed.wait(1)
+        assert keydn_threads[0] is not threading.current_thread()
+        assert commands.queue.empty()
+        # other reports are still queued
+        firmware.release(3)
+        commands.process_received_reports(block=True,timeout=1)
+        assert _key_codes(keyups) == [3]
+        # replies still go to the request waiting for them
+        assert usbbox.serial_num == '00001'
+        commands.dispatch_queued()
+        pressed.clear()
+        firmware.press(4)
+        commands.process_received_reports(block=True,timeout=1)
+        assert len(keydn_threads) == 2
+        assert keydn_threads[1] is threading.current_thread()
+    finally:
+        usbbox.device.close()
+
+def test_dispatch_directly_callback_error():
+    firmware=BoxFirmware()
+    usbbox=USBBox(device=EmulatedHIDDevice(firmware))
+    commands=usbbox.commands
+    try:
+        def broken(report):
+            raise ValueError('broken callback')
+        commands.add_callback(REPORT.KEYDN,broken)
+        commands.dispatch_directly(REPORT.KEYDN)
+        firmware.press(3)
+        time.sleep(0.1)
+        # the device's thread carries on
+        assert usbbox.serial_num == '00001'
+    finally:
+        usbbox.device.close()
+
+def test_dispatch_timing():
+    firmware=BoxFirmware()
+    usbbox=USBBox(device=EmulatedHIDDevice(firmware))
+    commands=usbbox.commands
+    try:
+        pressed=threading.Event()
+        commands.add_callback(REPORT.KEYDN,lambda report: pressed.set())
+        commands.dispatch_directly(REPORT.KEYDN)
+        timing=commands.timing=DispatchTiming()
+        firmware.press(3)
+        assert pressed.wait(1)
+        firmware.release(3)
+        commands.process_received_reports(block=True,timeout=1)
+        usbbox.clock
+        count,mean,longest=timing.summary()['callbacks']
+        assert count == 1 and 0 < mean <= longest
+        assert timing.count['queue'] == 1
+        assert timing.count['parse'] == timing.count['total'] == 3
+        assert 'callbacks' in str(timing)
+        timing.reset()
+        assert timing.mean('total') is None
+    finally:
+        usbbox.device.close()
+
+def test_report_timestamps():
+    firmware=BoxFirmware()
+    usbbox=USBBox(device=EmulatedHIDDevice(firmware))
+    commands=usbbox.commands
+    try:
+        timing=commands.timing=DispatchTiming()
+        before=hid.host_ns()
+        rep=commands.send_wait_reply(COMMAND.RTCGET,REPORT.RTCREP)
+        firmware.press(3)
+        commands.process_received_reports(block=True,timeout=1)
+        after=hid.host_ns()
+        # replies and queued reports both carry the time they arrived
+        assert before <= rep.timestamp_ns <= after
+        assert timing.count['queued'] == 1
+        assert 0 < timing.max['queued'] < (after-before)/1e9
+    finally:
+        usbbox.device.close()
@@ -75,7 +75,7 @@ def test_parse_var():
 def test_parse_var_type():
     var=parse('int')
     assert var.type_name == 'int'
-    print var.name
+    print(var.name)
     assert var.name == ''
     
     var=parse('void')
@@ -84,7 +84,7 @@ def test_parse_var_type():
     
     var=parse('void*')
     assert var.type_name == 'void*'
-    print var.name
+    print(var.name)
     assert var.name == ''
 
 def test_parse_void_ctype():
@@ -0,0 +1,151 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+from hid.emulator import *
+from hid.emulator import VCK_OK, VCK_NAK, SERIAL_SENT
+
+import struct
+import time
+
+def _collect(firmware,duration=0.2):
+    '''gather reports from the firmware for the given (real) duration'''
+    reports=[]
+    end=time.time()+duration
+    while time.time() < end:
+        reports.extend(firmware.wait_for_reports(0.01))
+    return reports
+
+def _ids(reports):
+    return [struct.unpack('B',report[:1])[0] for report in reports]
+
+def test_virtual_clock_rate():
+    clock=VirtualClock(rate=100)
+    start=clock.now()
+    time.sleep(0.01)
+    assert clock.now()-start >= 1.0
+    clock.advance(5)
+    assert clock.now()-start >= 6.0
+    assert clock.real_delay(1.0) == 0.01
+
+def test_find_hid_devices():
+    devices=find_hid_devices()
+    assert len(devices) == len(boxes)
+    assert devices[0].vendor == 0x19BC
+    assert devices[0].product == 0x0001
+
+def test_reply_latency():
+    firmware=BoxFirmware(latency=0.05)
+    firmware.command(struct.pack('>B7x',0x59)) # VERGET
+    assert firmware.wait_for_reports(0) == []
+    reports=_collect(firmware,0.1)
+    assert _ids(reports) == [0x59]
+    assert struct.unpack('>BBBBBBxx',reports[0]) == (0x59,0,3,2,1,4)
+
+def test_replies_stay_in_order():
+    firmware=BoxFirmware(latency=0.001,jitter=0.005,seed=1)
+    for command_id in [0x59,0x5A,0x54,0x3F,0x46,0x44,0x42,0x50]:
+        firmware.command(struct.pack('>B7x',command_id))
+    assert _ids(_collect(firmware,0.05)) == [0x59,0x5A,0x54,0x4D,0x4A,0x57,0x4C,0x50]
+
+def test_port_registers():
+    firmware=BoxFirmware(latency=0)
+    firmware.command(struct.pack('>Bx2B5x',0x3D,0xF0,0x0F)) # PXSET
+    firmware.command(struct.pack('>B7B',0x41,0x03,0,0,0,0,0,0)) # P0AND
+    firmware.command(struct.pack('>B7B',0x78,0xFF,0,0,0,0,0,0)) # P2XOR
+    reports=_collect(firmware,0.01)
+    assert [struct.unpack('>BxBBI',report)[1:3] for report in reports] == [(0xF0,0x0F),(0xF0,0x03),(0x0F,0x03)]
+
+def test_heartbeat():
+    firmware=BoxFirmware(clock=VirtualClock(rate=100))
+    firmware.command(struct.pack('>BH5x',0x48,100)) # every 100ms (1ms real)
+    reports=_collect(firmware,0.05)
+    assert len(reports) > 5
+    assert set(_ids(reports)) == set([0x48])
+    firmware.command(struct.pack('>BH5x',0x48,0))
+    _collect(firmware,0.01)
+    assert _collect(firmware,0.02) == []
+
+def test_key_debounce_and_mask():
+    firmware=BoxFirmware()
+    firmware.press(3)
+    assert firmware.wait_for_reports(0) == [] # still debouncing
+    reports=_collect(firmware,0.05)
+    assert _ids(reports) == [0x44]
+    assert struct.unpack('>BxxBI',reports[0])[1] == 3
+    firmware.release(3)
+    assert _ids(_collect(firmware,0.05)) == [0x55]
+
+    # short glitches are filtered out by the debounce
+    firmware.press(2)
+    firmware.release(2)
+    assert _collect(firmware,0.05) == []
+
+    # masked keys do not generate reports
+    firmware.command(struct.pack('>BxBB5x',0x4D,0x00,0xFE)) # MSKSET
+    _collect(firmware,0.01)
+    firmware.press(0)
+    assert _collect(firmware,0.05) == []
+    assert firmware.keys_port1 == 0x01
+
+def test_voice_key_busy():
+    firmware=BoxFirmware(latency=0,vck_write_time=0.05)
+    firmware.command(struct.pack('>B5B2x',0x43,0xB8,10,20,30,0)) # VCKSET
+    firmware.command(struct.pack('>B7x',0x56)) # VCKGET
+    reports=_collect(firmware,0.01)
+    assert [struct.unpack('B',report[1:2])[0] for report in reports] == [VCK_OK,VCK_NAK]
+    time.sleep(0.05)
+    firmware.command(struct.pack('>B7x',0x56))
+    report=_collect(firmware,0.01)[0]
+    assert struct.unpack('>B7B',report)[1:5] == (VCK_OK,10,20,30)
+
+def test_serial():
+    firmware=BoxFirmware(latency=0)
+    firmware.command(struct.pack('>B7B',0x53,2,ord('h'),ord('i'),0,0,0,0)) # SEROUT
+    firmware.receive_serial(b'hello world')
+    reports=_collect(firmware,0.01)
+    assert [struct.unpack('>B7B',report)[1] for report in reports] == [SERIAL_SENT,6,5]
+    assert firmware.serial_out == [ord('h'),ord('i')]
+
+def test_qpurge():
+    firmware=BoxFirmware(latency=0.05)
+    firmware.command(struct.pack('>B7x',0x54)) # RTCGET
+    firmware.command(struct.pack('>B7x',0x51)) # QPURGE
+    assert _collect(firmware,0.1) == []
+
+def test_report_reader():
+    import hid
+    firmwares=[BoxFirmware(serial_num='0000%d' % i,latency=0) for i in range(3)]
+    devices=[EmulatedHIDDevice(firmware) for firmware in firmwares]
+    received=[]
+    def callback(device,report_data):
+        received.append((devices.index(device),report_data))
+    reader=hid.ReportReader()
+    try:
+        for device in devices:
+            device.open()
+            reader.add(device)
+        reader.start()
+        for device in devices:
+            device.set_interrupt_report_callback(callback)
+            # read by the reader, not a thread of its own
+            assert device._thread is None
+        for i in (2,0,1):
+            firmwares[i].command(struct.pack('>B7x',0x54)) # RTCGET
+            time.sleep(0.02)
+        assert [i for i,report_data in received] == [2,0,1]
+        # closed devices are no longer read from
+        devices[0].close()
+        assert reader.devices == devices[1:]
+        firmwares[0].command(struct.pack('>B7x',0x54))
+        firmwares[1].command(struct.pack('>B7x',0x54))
+        time.sleep(0.02)
+        assert [i for i,report_data in received[3:]] == [1]
+    finally:
+        reader.stop()
+        assert not reader.is_alive()
+        for device in devices:
+            device.close()
+
+def test_find_hid_devices_filtered():
+    assert len(find_hid_devices(0x19BC,0x0001)) == len(boxes)
+    assert len(find_hid_devices(0x19BC)) == len(boxes)
+    assert find_hid_devices(0x046D,0xC077) == []
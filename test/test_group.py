@@ -0,0 +1,179 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+from ioLabs import *
+from ioLabs_group import *
+from hid.emulator import EmulatedHIDDevice, BoxFirmware
+
+import time
+
+def _open(count=3,**kw):
+    firmwares=[BoxFirmware(serial_num='0000%d' % (i+1),**kw) for i in range(count)]
+    group=BoxGroup(devices=[EmulatedHIDDevice(firmware) for firmware in firmwares])
+    return firmwares,group
+
+def _wait_for(group,count):
+    reports=[]
+    end_time=time.time()+2
+    while len(reports) < count and time.time() < end_time:
+        reports.extend(group.get_received_reports())
+        time.sleep(0.01)
+    return reports
+
+def test_open():
+    firmwares,group=_open(4)
+    try:
+        assert len(group) == 4
+        assert group.serial_nums == ['00001','00002','00003','00004']
+        assert group['00003'].device.firmware is firmwares[2]
+        assert [usbbox.device.firmware for usbbox in group] == firmwares
+        # all reset
+        assert [firmware.heartbeat_rate for firmware in firmwares] == [30000]*4
+        # read from one thread, not one per box
+        assert [usbbox.device._thread for usbbox in group] == [None]*4
+        assert [device.firmware for device in group._reader.devices] == firmwares
+    finally:
+        group.close()
+    assert not group._reader.is_alive()
+
+def test_no_boxes():
+    try:
+        BoxGroup(devices=[])
+    except RuntimeError:
+        pass
+    else:
+        assert False
+
+def test_merged_reports():
+    firmwares,group=_open()
+    try:
+        for i in (2,0,1,0):
+            firmwares[i].press(i)
+            time.sleep(0.03)
+        reports=_wait_for(group,4)
+        assert [(box_report.serial_num,box_report.report.key_code) for box_report in reports] == [
+            ('00003',2),('00001',0),('00002',1)]
+        timestamps=[box_report.timestamp_ns for box_report in reports]
+        assert timestamps == sorted(timestamps)
+        assert reports[0].id == REPORT.KEYDN
+    finally:
+        group.close()
+
+def test_process_received_reports():
+    firmwares,group=_open(2)
+    try:
+        keys=[]
+        def callback(report):
+            keys.append(report.key_code)
+        for usbbox in group:
+            usbbox.commands.add_callback(REPORT.KEYDN,callback)
+        firmwares[1].press(5)
+        time.sleep(0.01)
+        firmwares[0].press(6)
+        time.sleep(0.05)
+        group.process_received_reports()
+        assert keys == [5,6]
+        firmwares[1].press(7)
+        box_report=group.wait_for_keydown()
+        assert (box_report.serial_num,box_report.report.key_code) == ('00002',7)
+        # the reports are the group's
+        try:
+            group['00001'].wait_for_keydown()
+        except RuntimeError:
+            pass
+        else:
+            assert False
+    finally:
+        group.close()
+
+def test_map_concurrently():
+    firmwares,group=_open(4,latency=0.05)
+    try:
+        start=time.time()
+        versions=group.map(lambda usbbox: usbbox.version)
+        assert time.time()-start < 0.15 # not one after the other
+        assert versions == [(3,2)]*4
+        group.map(lambda usbbox: usbbox.leds.set_lines({0:0,1:0}),group.boxes[1:])
+        assert [firmware.port2 for firmware in firmwares] == [0xFF,0xFC,0xFC,0xFC]
+    finally:
+        group.close()
+
+def test_broadcast():
+    firmwares,group=_open(4,latency=0.05)
+    try:
+        start=time.time()
+        result=group.broadcast(COMMAND.P2SET,REPORT.PXREP,0x0F)
+        # replies waited for together
+        assert time.time()-start < 0.15
+        assert [firmware.port2 for firmware in firmwares] == [0x0F]*4
+        assert sorted(result.replies) == group.serial_nums
+        assert [result.replies[serial_num].port2_bits for serial_num in group.serial_nums] == [0x0F]*4
+        assert sorted(result.skew_ns.values())[0] == 0
+        assert 0 <= result.max_skew_ns < 10e6
+        assert result.max_skew_ns == max(result.skew_ns.values())
+        assert result.sent_ns['00001'] <= result.sent_ns['00004']
+
+        # no reply wanted, or from some of the boxes
+        result=group.broadcast(COMMAND.HBSET,None,1000,boxes=group.boxes[:2])
+        assert result.replies == {'00001':None,'00002':None}
+        assert [firmware.heartbeat_rate for firmware in firmwares] == [1000,1000,30000,30000]
+    finally:
+        group.close()
+
+def test_broadcast_parallel():
+    firmwares,group=_open(3)
+    try:
+        time.sleep(0.05)
+        clocks=[firmware.rtc() for firmware in firmwares]
+        result=group.broadcast(COMMAND.RESRTC,REPORT.KEYREP,parallel=True)
+        assert len(result.replies) == 3
+        assert [firmware.rtc() < clock for firmware,clock in zip(firmwares,clocks)] == [True]*3
+        assert result.max_skew_ns < 50e6
+        # the replies were matched, they don't go on the queue
+        assert [box_report.id for box_report in group.get_received_reports()] == []
+    finally:
+        group.close()
+
+def test_broadcast_shadow():
+    firmwares=[BoxFirmware(serial_num='0000%d' % (i+1)) for i in range(2)]
+    group=BoxGroup(devices=[EmulatedHIDDevice(firmware) for firmware in firmwares],shadow=True)
+    try:
+        group.broadcast(COMMAND.P2SET,REPORT.PXREP,0x3C)
+        commands_received=firmwares[0].commands_received
+        # read from the shadow, not the box
+        assert group['00001'].leds.state == 0x3C
+        assert firmwares[0].commands_received == commands_received
+    finally:
+        group.close()
+
+def test_sync_clocks():
+    firmwares=[BoxFirmware(serial_num='0000%d' % (i+1),drift_ppm=drift_ppm)
+               for i,drift_ppm in enumerate([0,300,-200])]
+    group=BoxGroup(devices=[EmulatedHIDDevice(firmware) for firmware in firmwares],do_reset=False)
+    try:
+        # the boxes were reset at different times
+        firmwares[1]._rtc_origin-=5.0
+        firmwares[2]._rtc_origin-=12.3
+        assert group.error_bound_ns is None
+        assert group.sync_clocks(count=4) < 5e6
+        assert sorted(group.clocks) == group.serial_nums
+
+        for firmware in firmwares:
+            firmware.press(2)
+        reports=_wait_for(group,3)
+        assert len(reports) == 3
+        rtcs=[box_report.report.rtc for box_report in reports]
+        assert max(rtcs)-min(rtcs) > 12000
+        # but they happened at the same time
+        times_ns=[group.report_host_ns(box_report) for box_report in reports]
+        assert max(times_ns)-min(times_ns) < 2e6
+        for box_report,time_ns in zip(reports,times_ns):
+            assert -2e6 < box_report.timestamp_ns-time_ns < 5e6
+
+        # the clocks start together after a reset
+        assert group.sync_clocks(reset=True,count=4) < 5e6
+        offsets=[group.clocks[serial_num].offset_ns for serial_num in group.serial_nums]
+        assert max(offsets)-min(offsets) < 2e6
+        assert max([firmware.rtc() for firmware in firmwares]) < 1000
+    finally:
+        group.close()
+    assert group.report_host_ns(BoxReport('00009',None)) is None
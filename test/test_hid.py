@@ -0,0 +1,314 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+import hid
+from hid import HIDDevice
+
+from ctypes import Array, c_ubyte, memmove
+import time
+
+class CountingBuffer(Array):
+    '''report buffer that counts accesses to individual bytes from python'''
+    _type_=c_ubyte
+    _length_=9
+    byte_accesses=0
+
+    def __getitem__(self,index):
+        CountingBuffer.byte_accesses+=1
+        return Array.__getitem__(self,index)
+
+    def __setitem__(self,index,value):
+        CountingBuffer.byte_accesses+=1
+        return Array.__setitem__(self,index,value)
+
+class FakeHIDDevice(HIDDevice):
+    '''device that "reads" reports into a buffer when told to'''
+    def __init__(self,offset=0):
+        HIDDevice.__init__(self,0x19BC,0x0001)
+        self.report_buffer=CountingBuffer()
+        self.offset=offset
+
+    def is_open(self):
+        return True
+
+    def read(self,report_data):
+        # stands in for the OS writing into the buffer
+        memmove(self.report_buffer,report_data,len(report_data))
+        self._deliver_report(self.report_buffer,8,self.offset)
+
+class CountingCopy(object):
+    def __init__(self,copy):
+        self.copy=copy
+        self.count=0
+
+    def __call__(self,*args):
+        self.count+=1
+        return self.copy(*args)
+
+def _receive_reports(device,reports):
+    received=[]
+    device._callback=lambda device,report_data: received.append(report_data)
+    string_at=hid.string_at
+    hid.string_at=CountingCopy(string_at)
+    try:
+        CountingBuffer.byte_accesses=0
+        for report_data in reports:
+            device.read(report_data)
+        return received,hid.string_at.count
+    finally:
+        hid.string_at=string_at
+
+def test_one_copy_per_report():
+    reports=[b'D\x00\x00\x01\x00\x00\x03\xe8',b'U\x00\x00\x01\x00\x00\x03\xe9']
+    device=FakeHIDDevice()
+    received,copies=_receive_reports(device,reports)
+    assert received == reports
+    assert copies == len(reports)
+    assert CountingBuffer.byte_accesses == 0
+    assert list(bytearray(device.report_buffer)) == [0]*9 # cleared after each report
+
+def test_report_timestamp():
+    device=FakeHIDDevice()
+    timestamps=[]
+    device._callback=lambda device,report_data: timestamps.append(device.report_timestamp_ns)
+    before=hid.host_ns()
+    device.read(b'D\x00\x00\x01\x00\x00\x03\xe8')
+    device.read(b'U\x00\x00\x01\x00\x00\x03\xe9')
+    after=hid.host_ns()
+    assert before <= timestamps[0] <= timestamps[1] <= after
+
+def test_report_offset():
+    # e.g. on windows the first byte is the report id
+    device=FakeHIDDevice(offset=1)
+    received,copies=_receive_reports(device,[b'\x00P\x0f\xf0\x00\x00\x00\x10\x00'])
+    assert received == [b'P\x0f\xf0\x00\x00\x00\x10\x00']
+    assert copies == 1
+    assert CountingBuffer.byte_accesses == 0
+
+class WritingHIDDevice(HIDDevice):
+    '''device that keeps a copy of each report written to it'''
+    def __init__(self):
+        HIDDevice.__init__(self,0x19BC,0x0001)
+        self.written=[]
+        self.buffers=set()
+
+    def is_open(self):
+        return True
+
+    def set_report(self,report_data,report_id=0):
+        HIDDevice.set_report(self,report_data,report_id)
+        report_buffer,size=self._copy_to_output_buffer(report_data,1)
+        report_buffer[0]=report_id
+        self.buffers.add(id(report_buffer))
+        self.written.append(hid.string_at(report_buffer,size))
+
+def test_set_report_bytes_like():
+    device=WritingHIDDevice()
+    report=b'2\x55\x00\x00\x00\x00\x00\x00'
+    device.set_report(report)
+    device.set_report(bytearray(report))
+    device.set_report(memoryview(report))
+    device.set_report((c_ubyte*8).from_buffer_copy(report))
+    try:
+        device.set_report(buffer(report))
+    except NameError:
+        device.set_report(report) # no buffer in python 3
+    assert device.written == [b'\x00'+report]*5
+    # the same buffer is used each time
+    assert len(device.buffers) == 1
+
+class ListedHIDDevice(HIDDevice):
+    '''device as found by a FakeEnumerator'''
+    def __init__(self,path,vendor,product):
+        HIDDevice.__init__(self,vendor,product)
+        self.path=path
+
+    def is_open(self):
+        return False
+
+    def copy(self):
+        return ListedHIDDevice(self.path,self.vendor,self.product)
+
+class FakeEnumerator(object):
+    '''lists the devices "plugged in", counting the calls'''
+    def __init__(self):
+        self.devices=[('a',0x19BC,0x0001),('b',0x046D,0xC077),('c',0x19BC,0x0001)]
+        self.calls=[]
+
+    def __call__(self,vendor=None,product=None):
+        self.calls.append((vendor,product))
+        devices=[ListedHIDDevice(*device) for device in self.devices]
+        return [device for device in devices if device.matches(vendor,product)]
+
+def _paths(devices):
+    return [device.path for device in devices]
+
+def test_device_cache():
+    enumerator=FakeEnumerator()
+    cache=hid.DeviceCache(enumerator)
+    devices=cache.find(0x19BC,0x0001)
+    assert _paths(devices) == ['a','c']
+    again=cache.find(0x19BC,0x0001)
+    assert _paths(again) == ['a','c']
+    assert enumerator.calls == [(0x19BC,0x0001)]
+    assert cache.enumerations == 1
+    # each caller gets devices of their own
+    assert again[0] is not devices[0]
+
+    assert _paths(cache.find()) == ['a','b','c']
+    # which will do for any other filter
+    assert _paths(cache.find(0x046D)) == ['b']
+    assert enumerator.calls == [(0x19BC,0x0001),(None,None)]
+
+def test_device_cache_invalidate():
+    enumerator=FakeEnumerator()
+    cache=hid.DeviceCache(enumerator)
+    assert _paths(cache.find(0x19BC,0x0001)) == ['a','c']
+    # unplugged, but still cached
+    del enumerator.devices[0]
+    assert _paths(cache.find(0x19BC,0x0001)) == ['a','c']
+    cache.invalidate()
+    assert _paths(cache.find(0x19BC,0x0001)) == ['c']
+    assert len(enumerator.calls) == 2
+
+def test_device_cache_ttl():
+    enumerator=FakeEnumerator()
+    cache=hid.DeviceCache(enumerator,ttl=0.05)
+    cache.find()
+    cache.find()
+    assert len(enumerator.calls) == 1
+    time.sleep(0.06)
+    cache.find()
+    assert len(enumerator.calls) == 2
+
+class PooledHIDDevice(FakeHIDDevice):
+    '''device that counts how often it's opened, and has no thread'''
+    opened=0
+
+    def __init__(self,name):
+        FakeHIDDevice.__init__(self)
+        self.name=name
+        self._open=False
+        self.written=[]
+
+    def is_open(self):
+        return self._open
+
+    def open(self):
+        if not self._open:
+            PooledHIDDevice.opened+=1
+            self._open=True
+
+    def close(self):
+        self._open=False
+        HIDDevice.close(self)
+
+    def copy(self):
+        return PooledHIDDevice(self.name)
+
+    def physical_id(self):
+        return self.name
+
+    def set_interrupt_report_callback(self,callback,report_buffer_size=8):
+        self._callback=callback
+
+    def set_report(self,report_data,report_id=0):
+        self.written.append(report_data)
+
+def test_device_pool():
+    pool=hid.DevicePool()
+    PooledHIDDevice.opened=0
+    device=PooledHIDDevice('a')
+    first=pool.acquire(device)
+    second=pool.acquire(device.copy())
+    other=pool.acquire(PooledHIDDevice('b'))
+    assert PooledHIDDevice.opened == 2
+    assert first.is_open() and second.is_open()
+    assert second.device is device
+    assert len(pool) == 2
+    assert pool.handles(device) == 2
+
+    received=[]
+    def callback(handle,report_data):
+        received.append((handle,handle.report_timestamp_ns,report_data))
+    first.set_interrupt_report_callback(callback)
+    second.set_interrupt_report_callback(callback)
+    device.read(b'D\x00\x00\x01\x00\x00\x03\xe8')
+    # every owner gets the report
+    assert [(handle,report_data) for handle,timestamp_ns,report_data in received] == [
+        (first,b'D\x00\x00\x01\x00\x00\x03\xe8'),(second,b'D\x00\x00\x01\x00\x00\x03\xe8')]
+    assert received[0][1] == received[1][1] == device.report_timestamp_ns
+
+    second.set_report(b'T\x00\x00\x00\x00\x00\x00\x00')
+    assert device.written == [b'T\x00\x00\x00\x00\x00\x00\x00']
+
+    first.close()
+    assert device.is_open()
+    del received[:]
+    device.read(b'U\x00\x00\x01\x00\x00\x03\xe9')
+    assert [handle for handle,timestamp_ns,report_data in received] == [second]
+    second.close()
+    assert not device.is_open()
+    assert pool.handles(device) == 0
+    try:
+        second.set_report(b'T\x00\x00\x00\x00\x00\x00\x00')
+    except RuntimeError:
+        pass
+    else:
+        assert False
+
+    # and opened again when it's next wanted
+    third=pool.acquire(device)
+    third.set_interrupt_report_callback(callback)
+    del received[:]
+    device.read(b'D\x00\x00\x02\x00\x00\x03\xea')
+    assert [handle for handle,timestamp_ns,report_data in received] == [third]
+    assert PooledHIDDevice.opened == 3
+    third.close()
+    other.close()
+    assert len(pool) == 0
+
+def test_device_pool_callback_error():
+    pool=hid.DevicePool()
+    device=PooledHIDDevice('a')
+    first=pool.acquire(device)
+    second=pool.acquire(device)
+    received=[]
+    def fail(handle,report_data):
+        raise ValueError(report_data)
+    first.set_interrupt_report_callback(fail)
+    second.set_interrupt_report_callback(lambda handle,report_data: received.append(report_data))
+    device.read(b'D\x00\x00\x01\x00\x00\x03\xe8')
+    assert received == [b'D\x00\x00\x01\x00\x00\x03\xe8']
+    first.close()
+    second.close()
+
+def test_device_pool_replies():
+    '''a reply goes to the handle that sent the command, in the order they were sent'''
+    pool=hid.DevicePool()
+    device=PooledHIDDevice('a')
+    first=pool.acquire(device)
+    second=pool.acquire(device)
+    received=[]
+    def callback(handle,report_data):
+        received.append((handle,report_data))
+    first.set_interrupt_report_callback(callback)
+    second.set_interrupt_report_callback(callback)
+    second.send_expecting(ord('K'),second.set_report,b'R\x00\x00\x00\x00\x00\x00\x00')
+    first.send_expecting(ord('K'),first.set_report,b'R\x00\x00\x00\x00\x00\x00\x00')
+    assert len(device.written) == 2
+    device.read(b'K\x00\x00\x00\x00\x00\x00\x01')
+    device.read(b'K\x00\x00\x00\x00\x00\x00\x02')
+    # no one is waiting for this one
+    device.read(b'K\x00\x00\x00\x00\x00\x00\x03')
+    assert received == [(second,b'K\x00\x00\x00\x00\x00\x00\x01'),
+                        (first,b'K\x00\x00\x00\x00\x00\x00\x02'),
+                        (first,b'K\x00\x00\x00\x00\x00\x00\x03'),
+                        (second,b'K\x00\x00\x00\x00\x00\x00\x03')]
+    # a cancelled request doesn't get a reply
+    del received[:]
+    first.send_expecting(ord('K'),first.set_report,b'R\x00\x00\x00\x00\x00\x00\x00')
+    first.cancel_expected(ord('K'))
+    device.read(b'K\x00\x00\x00\x00\x00\x00\x04')
+    assert [handle for handle,report_data in received] == [first,second]
+    first.close()
+    second.close()
@@ -1,8 +1,11 @@
 # emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
 # vi: set ft=python sts=4 ts=4 sw=4 et:
 from ioLabs import *
+import hid
 
 import random
+import threading
+import time
 import unittest
 
 def test_plugged_in():
@@ -12,6 +15,75 @@ def test_plugged_in():
     except:
         assert False
 
+def test_found_once():
+    '''the box isn't looked for again each time'''
+    usbbox=USBBox(do_reset=False)
+    usbbox.device.close()
+    enumerations=hid.device_cache.enumerations
+    usbbox=USBBox(do_reset=False)
+    usbbox.device.close()
+    assert hid.device_cache.enumerations == enumerations
+
+def test_shared():
+    '''USBBoxes for the same box share the device, and get all its reports'''
+    first=USBBox(do_reset=False)
+    second=USBBox(do_reset=False)
+    try:
+        assert first.device.device is second.device.device
+        assert hid.device_pool.handles(first.device) == 2
+        # read by the one thread
+        assert first.device._thread is None and second.device._thread is None
+        first.clear_received_reports()
+        # the reply only goes to the one that asked
+        assert second.reset_clock() is not None
+        time.sleep(0.05)
+        assert first.commands.get_received_reports() == []
+        # but reports no one asked for go to both
+        keydns=[]
+        def callback(report):
+            keydns.append(report)
+        first.commands.add_callback(REPORT.KEYDN,callback)
+        second.commands.add_callback(REPORT.KEYDN,callback)
+        firmware=first.device.device.firmware
+        firmware.press(1)
+        try:
+            first.commands.process_received_reports(True,2)
+            second.commands.process_received_reports(True,2)
+        finally:
+            firmware.release(1)
+        assert len(keydns) == 2
+    finally:
+        first.device.close()
+        second.device.close()
+    assert hid.device_pool.handles(second.device) == 0
+
+def test_shared_replies():
+    '''replies to commands sent at the same time by USBBoxes sharing a box don't get mixed up'''
+    boxes=[USBBox(do_reset=False) for i in range(2)]
+    try:
+        for usbbox in boxes:
+            usbbox.clear_received_reports()
+        replies=[[],[]]
+        def send(usbbox,replies,high_bit):
+            for i in range(20):
+                replies.append((high_bit|i,usbbox.commands.send_wait_reply(COMMAND.P0SET,REPORT.PXREP,high_bit|i)))
+        threads=[threading.Thread(target=send,args=(usbbox,box_replies,high_bit))
+                 for usbbox,box_replies,high_bit in zip(boxes,replies,(0x00,0x80))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for usbbox,box_replies in zip(boxes,replies):
+            assert len(box_replies) == 20
+            # each reply is the port state after the box's own command
+            for bits,reply in box_replies:
+                assert reply.port0_bits == bits
+            # and none of the other box's replies were queued
+            assert usbbox.commands.get_received_reports() == []
+    finally:
+        for usbbox in boxes:
+            usbbox.device.close()
+
 def test_synonyms():
     '''make sure we have the correct port
     synonyms setup
@@ -35,8 +107,11 @@ def test_attributes():
 
 class TestUSBBox(unittest.TestCase):
     
+    def _create_usbbox(self):
+        return USBBox()
+    
     def setUp(self):
-        self.usbbox=USBBox()
+        self.usbbox=self._create_usbbox()
         # set sensible initial values
         self.usbbox.port0.direction=0
         self.usbbox.port0.logic=0
@@ -351,7 +426,7 @@ class TestUSBBox(unittest.TestCase):
     def test_read_serial(self):
         '''check we get back an empty string (as nothing else writing to serial port)'''
         bytes=self.usbbox.serial.read()
-        assert bytes == ''
+        assert bytes == b''
     
     def test_send_command(self):
         '''check we can manually send a command'''
@@ -367,4 +442,11 @@ class TestUSBBox(unittest.TestCase):
         self.usbbox.send_command(COMMAND.P0SET,bytes)
         rep=self.usbbox.commands.wait_for_report(REPORT.PXREP)
         assert rep is not None
-        assert self.usbbox.port0.state == p0
\ No newline at end of file
+        assert self.usbbox.port0.state == p0
+
+
+class TestUSBBoxShadow(TestUSBBox):
+    '''the same tests, with the box's settings shadowed'''
+    
+    def _create_usbbox(self):
+        return USBBox(shadow=True)
@@ -0,0 +1,96 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+from ioLabs import *
+
+import pickle
+import struct
+
+def test_parse_all_reports():
+    '''pack every report with dummy values and check it parses back'''
+    for report_id,(name,format,field_names) in REPORT_SUMMARY.items():
+        values=[]
+        for i,field in enumerate(field_names):
+            if field == 'serial_num':
+                values.append(b'12345')
+            else:
+                values.append(i+1)
+        packing_function=getattr(REPORT,name.lower())
+        report=REPORT.parse(packing_function(*values))
+        assert report.id == report_id
+        assert report.name == name
+        for field,value in zip(field_names,values):
+            assert getattr(report,field) == value
+
+def test_parse_fields():
+    report=REPORT.parse(struct.pack('>BxxBI',REPORT.KEYDN,3,1000))
+    assert report.name == 'KEYDN'
+    assert report.key_code == 3
+    assert report.rtc == 1000
+    # fields can be changed, as they are by the read-modify-write code
+    report.rtc=2000
+    assert report.rtc == 2000
+
+def test_parse_unknown():
+    data=b'\xff\x01\x02\x03\x04\x05\x06\x07'
+    report=REPORT.parse(data)
+    assert report.id == 0xff
+    assert report.message_data == data
+
+def test_parse_short_report():
+    try:
+        REPORT.parse(struct.pack('>BxxB',REPORT.KEYDN,3))
+    except struct.error:
+        pass
+    else:
+        assert False
+
+def test_pack_command():
+    assert COMMAND.p2set(0x55) == struct.pack('>BB6x',COMMAND.P2SET,0x55)
+    assert COMMAND.dirset(1,2,3) == struct.pack('>BBBB4x',COMMAND.DIRSET,1,2,3)
+
+def test_pack_wrong_args():
+    try:
+        COMMAND.p2set(1,2)
+    except RuntimeError:
+        pass
+    else:
+        assert False
+
+def test_pickle():
+    report=REPORT.parse(REPORT.pxrep(1,2,3),timestamp_ns=1000)
+    for protocol in range(pickle.HIGHEST_PROTOCOL+1):
+        copy=pickle.loads(pickle.dumps(report,protocol))
+        assert copy.__class__ is report.__class__
+        assert repr(copy) == repr(report)
+    command=COMMAND.parse(COMMAND.dirset(1,2,3))
+    assert repr(pickle.loads(pickle.dumps(command))) == repr(command)
+
+def test_pickle_all_messages():
+    for message_types,summary in ((COMMAND,COMMAND_SUMMARY),(REPORT,REPORT_SUMMARY)):
+        for message_id,(name,format,field_names) in summary.items():
+            values=[b'12345' if field == 'serial_num' else 1 for field in field_names]
+            message=message_types.parse(getattr(message_types,name.lower())(*values))
+            assert repr(pickle.loads(pickle.dumps(message,2))) == repr(message)
+
+def test_report_is_compact():
+    report=REPORT.parse(REPORT.pxrep(1,2,3))
+    assert not hasattr(report,'__dict__')
+    try:
+        report.not_a_field=1
+    except AttributeError:
+        pass
+    else:
+        assert False
+
+def test_report_str():
+    report=REPORT.parse(REPORT.pxrep(1,2,3))
+    assert str(report) == 'name=PXREP,id=80,port2_bits=1,port0_bits=2,rtc=3'
+    assert repr(report) == "dict_struct(name='PXREP',id=80,port2_bits=1,port0_bits=2,rtc=3)"
+
+def test_report_timestamp():
+    report=REPORT.parse(REPORT.pxrep(1,2,3),123456789)
+    assert report.timestamp_ns == 123456789
+    assert report.copy().timestamp_ns == 123456789
+    assert str(report) == 'name=PXREP,id=80,port2_bits=1,port0_bits=2,rtc=3,timestamp_ns=123456789'
+    assert REPORT.parse(REPORT.pxrep(1,2,3)).timestamp_ns is None
+    assert REPORT.parse(b'\xff\x01\x02\x03\x04\x05\x06\x07',5).timestamp_ns == 5
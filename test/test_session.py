@@ -0,0 +1,332 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+from ioLabs import *
+from ioLabs_session import *
+from hid.emulator import EmulatedHIDDevice, BoxFirmware
+
+from io import BytesIO
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO # python 3
+import os
+import tempfile
+import time
+
+def _read(data):
+    in_file=BytesIO(data)
+    header=read_header(in_file)
+    return header,list(read_records(in_file))
+
+def _wait_for_keys(usbbox,count):
+    keys=[]
+    def callback(report):
+        keys.append(report)
+    usbbox.commands.add_callback(REPORT.KEYDN,callback)
+    usbbox.commands.add_callback(REPORT.KEYUP,callback)
+    end_time=time.time()+2
+    while len(keys) < count and time.time() < end_time:
+        usbbox.process_received_reports()
+        time.sleep(0.01)
+    return keys
+
+def test_record_binary():
+    firmware=BoxFirmware()
+    usbbox=USBBox(device=EmulatedHIDDevice(firmware))
+    out_file=BytesIO()
+    try:
+        recorder=usbbox.start_recording(REPORT.ALL_IDS(),out_file,binary=True)
+        firmware.press(3)
+        _wait_for_keys(usbbox,1)
+        assert usbbox.clock is not None
+        usbbox.stop_recording()
+    finally:
+        usbbox.device.close()
+
+    header,records=_read(out_file.getvalue())
+    assert header.serial_num == '00001'
+    assert header.version == (3,2)
+    assert header.voice_version == (1,4)
+    assert len(records) == recorder.count
+    reports=[REPORT.parse(report_data) for timestamp_ns,report_data in records]
+    # the reply to the command is recorded too
+    assert [report.name for report in reports] == ['KEYDN','RTCREP']
+    timestamps=[timestamp_ns for timestamp_ns,report_data in records]
+    assert timestamps == sorted(timestamps)
+    assert header.start_ns <= timestamps[0]
+    assert abs(header.wall_time(timestamps[0])-time.time()) < 10
+
+def test_recorder_report_ids():
+    out_file=BytesIO()
+    recorder=SessionRecorder(out_file,SessionHeader('00002'),report_ids=[REPORT.KEYDN])
+    recorder.record(REPORT.keydn(1,100),timestamp_ns=5)
+    recorder.record(REPORT.hbrep(0,100,200),timestamp_ns=6)
+    recorder.record(REPORT.keydn(2,300),REPORT.parse(REPORT.keydn(2,300)),7)
+    recorder.close()
+    header,records=_read(out_file.getvalue())
+    assert header.serial_num == '00002'
+    assert records == [(5,REPORT.keydn(1,100)),(7,REPORT.keydn(2,300))]
+    assert len(out_file.getvalue()) == HEADER_SIZE+2*RECORD_SIZE
+
+class SlowFile(object):
+    '''file that takes a while to write to'''
+    def __init__(self):
+        self.data=BytesIO()
+        self.writes=0
+
+    def write(self,data):
+        time.sleep(0.05)
+        self.writes+=1
+        self.data.write(data)
+
+    def flush(self):
+        pass
+
+def test_recorder_does_not_block():
+    out_file=SlowFile()
+    recorder=SessionRecorder(out_file,flush_interval=0.01)
+    start=time.time()
+    for i in range(1000):
+        recorder.record(REPORT.keydn(i % 8,i))
+    assert time.time()-start < 0.05
+    recorder.close()
+    header,records=_read(out_file.data.getvalue())
+    assert len(records) == 1000
+    # written out in a few large writes
+    assert out_file.writes < 20
+
+class FullFile(SlowFile):
+    '''file that can't be written to after the header'''
+    def write(self,data):
+        if self.writes:
+            raise IOError(28,'No space left on device')
+        SlowFile.write(self,data)
+
+def test_recorder_write_error():
+    recorder=SessionRecorder(FullFile(),flush_interval=0.01)
+    recorder.record(REPORT.keydn(1,100))
+    recorder._thread.join(2)
+    assert not recorder._thread.is_alive()
+    for method,args in ((recorder.record,(REPORT.keydn(2,200),)),(recorder.close,())):
+        try:
+            method(*args)
+        except IOError:
+            pass
+        else:
+            assert False
+    assert recorder.count == 1
+
+def test_convert_text_log():
+    firmware=BoxFirmware()
+    usbbox=USBBox(device=EmulatedHIDDevice(firmware))
+    log=StringIO()
+    try:
+        usbbox.start_recording(REPORT.ALL_IDS(),log)
+        firmware.press(3)
+        firmware.press(4)
+        _wait_for_keys(usbbox,2)
+        usbbox.stop_recording()
+    finally:
+        usbbox.device.close()
+    log.write(u'\n')
+    # python 2 and 3 print the serial number differently
+    log.write(u'name=NUMREP,id=90,error_code=0,serial_num=12345\n')
+    log.write(u"name=NUMREP,id=90,error_code=0,serial_num=b'12345'\n")
+    # old logs printed dict_structs, in any order
+    log.write(u'rtc=5000,key_code=6,id=68,name=KEYDN\n')
+    log.seek(0)
+
+    out_file=BytesIO()
+    assert convert_text_log(log,out_file) == 5
+    header,records=_read(out_file.getvalue())
+    reports=[REPORT.parse(report_data) for timestamp_ns,report_data in records]
+    assert [(report.name,getattr(report,'key_code',None)) for report in reports] == [
+        ('KEYDN',3),('KEYDN',4),('NUMREP',None),('NUMREP',None),('KEYDN',6)]
+    assert reports[2].serial_num == reports[3].serial_num == b'12345'
+    # the host times are logged
+    assert 0 < records[0][0] <= records[1][0] <= host_ns()
+    assert records[2][0] == records[1][0]
+    # but not in older logs, so the box's clock stands in for them
+    assert records[4][0] == 5000*1000000
+
+def test_convert_text_log_bad_line():
+    # an unknown report (printed with its raw data), and a missing field
+    for line in (u"id=255,message_data=b'\\xff\\x00',timestamp_ns=None",u'name=KEYDN,id=68,rtc=5000'):
+        log=StringIO(u'name=KEYDN,id=68,key_code=6,rtc=5000\n\n%s\n' % line)
+        try:
+            convert_text_log(log,BytesIO())
+        except ValueError as e:
+            assert 'line 3' in str(e)
+            assert line in str(e)
+        else:
+            assert False
+
+def test_not_a_session():
+    try:
+        read_header(BytesIO(b'name=KEYDN,id=68,key_code=6,rtc=5000\n'))
+    except ValueError:
+        pass
+    else:
+        assert False
+
+def _write_session(records):
+    '''write a session file with the given records, returns its path'''
+    fd,path=tempfile.mkstemp(suffix='.iolabs')
+    out_file=os.fdopen(fd,'wb')
+    try:
+        out_file.write(SessionHeader('00003',start_ns=0).pack())
+        for timestamp_ns,report_data in records:
+            out_file.write(RECORD.pack(report_data,timestamp_ns))
+    finally:
+        out_file.close()
+    return path
+
+def _session_records(count,start_rtc=0):
+    '''a key press every 10ms, with a heartbeat (and no rtc) report after every other one'''
+    records=[]
+    for i in range(count):
+        rtc=(start_rtc+i*10) & 0xFFFFFFFF
+        records.append((i*10000000,REPORT.keydn(i % 8,rtc)))
+        if i % 2:
+            records.append((i*10000000+1,REPORT.serin(0,0,0,0,0,0,0)))
+    return records
+
+def test_reader():
+    path=_write_session(_session_records(1000))
+    reader=SessionReader(path,index_interval=16)
+    try:
+        assert reader.header.serial_num == '00003'
+        assert len(reader) == 1500
+        timestamp_ns,report=reader[3]
+        assert (timestamp_ns,report.name,report.key_code) == (20000000,'KEYDN',2)
+        assert reader[-1][1].name == 'SERIN'
+        assert reader.record(0) == (0,REPORT.keydn(0,0))
+        try:
+            reader[1500]
+        except IndexError:
+            pass
+        else:
+            assert False
+
+        # by host time
+        found=list(reader.between(100000000,150000000))
+        assert [timestamp_ns for timestamp_ns,report in found] == [
+            100000000,110000000,110000001,120000000,130000000,130000001,140000000]
+        found=list(reader.between(100000000,150000000,[REPORT.KEYDN]))
+        assert [report.rtc for timestamp_ns,report in found] == [100,110,120,130,140]
+        assert list(reader.between(20000000000,30000000000)) == []
+
+        # by box time, reports without an rtc go with the one before
+        found=list(reader.between_rtc(5000,5030))
+        assert [(report.name,getattr(report,'rtc',None)) for timestamp_ns,report in found] == [
+            ('KEYDN',5000),('KEYDN',5010),('SERIN',None),('KEYDN',5020)]
+        assert reader.index_at_rtc(0) == 0
+        assert reader.index_at_rtc(10**9) == len(reader)
+        # the index is sparse
+        assert len(reader._rtc_index) == 1500//16+1
+    finally:
+        reader.close()
+        os.remove(path)
+
+def test_reader_rtc_index_is_sparse():
+    '''building the rtc index only reads the start of each block'''
+    path=_write_session(_session_records(1000))
+    reader=SessionReader(path,index_interval=100)
+    read=[]
+    rtc=reader._rtc
+    def counting_rtc(index):
+        read.append(index)
+        return rtc(index)
+    reader._rtc=counting_rtc
+    try:
+        assert reader.index_at_rtc(5000) == reader.index_at_time(500*10000000)
+        # the first record of each of the 15 blocks, then a search of one block
+        assert len(read) < 15+100
+    finally:
+        reader.close()
+        os.remove(path)
+
+def test_reader_rtc_wraps():
+    path=_write_session(_session_records(100,start_rtc=0xFFFFFFFF-495))
+    reader=SessionReader(path,index_interval=4)
+    try:
+        found=list(reader.between_rtc(0xFFFFFFFF-15,0xFFFFFFFF+26,[REPORT.KEYDN]))
+        assert [report.rtc for timestamp_ns,report in found] == [
+            0xFFFFFFFF-15,0xFFFFFFFF-5,4,14,24]
+    finally:
+        reader.close()
+        os.remove(path)
+
+def _replay_usbbox(**kw):
+    return USBBox(do_reset=False,device=ReplayDevice(),**kw)
+
+def test_replay():
+    path=_write_session(_session_records(100))
+    reader=SessionReader(path)
+    usbbox=_replay_usbbox()
+    try:
+        keys=[]
+        def callback(report):
+            keys.append(report)
+        usbbox.commands.add_callback(REPORT.KEYDN,callback)
+        stats=Replay(reader,usbbox,speed=None).run()
+        assert stats.reports == 150
+        assert stats.dropped_total == 0
+        assert stats.max_lag == 0
+        usbbox.process_received_reports()
+        assert [report.rtc for report in keys] == list(range(0,1000,10))
+        # with the times they were recorded with
+        assert [report.timestamp_ns for report in keys] == list(range(0,1000000000,10000000))
+
+        # sequences of records work too, and replies are still matched
+        replay=Replay([(0,REPORT.rtcrep(0,1234))],usbbox.commands,speed=None)
+        future=usbbox.commands.submit(COMMAND.RTCGET,REPORT.RTCREP)
+        replay.run()
+        assert future.result(0).rtc == 1234
+        assert usbbox.device.sent == [COMMAND.rtcget()]
+    finally:
+        reader.close()
+        os.remove(path)
+
+def test_replay_speed():
+    # 100 reports over 0.2 seconds
+    records=[(i*2000000,REPORT.keydn(0,i*2)) for i in range(100)]
+    usbbox=_replay_usbbox()
+    for speed,expected in [(1.0,0.2),(4.0,0.05)]:
+        stats=Replay(records,usbbox,speed=speed).run()
+        assert stats.reports == 100
+        assert expected*0.9 < stats.elapsed < expected*1.5+0.05
+        assert stats.max_lag < 0.05
+        assert stats.reports_per_s > 0
+    assert len(usbbox.commands.get_received_reports()) == 200
+
+def test_replay_overflow():
+    records=[(0,REPORT.keydn(0,i)) for i in range(50)]+[(0,REPORT.hbrep(0,100,i)) for i in range(10)]
+    usbbox=_replay_usbbox(report_queue=ReportQueue(capacity=20))
+    stats=Replay(records,usbbox,speed=None).run()
+    assert stats.reports == 60
+    assert stats.dropped == {REPORT.KEYDN:40}
+    assert stats.dropped_total == 40
+
+def test_replay_stop():
+    records=[(i*10000000,REPORT.keydn(0,i)) for i in range(1000)]
+    usbbox=_replay_usbbox()
+    replay=Replay(records,usbbox)
+    replay.start()
+    time.sleep(0.05)
+    replay.stop()
+    stats=replay.join(1)
+    assert 0 < stats.reports < 1000
+
+def test_replay_stop_during_gap():
+    # a long gap between reports, as there can be between heartbeats
+    records=[(0,REPORT.keydn(0,0)),(30000000000,REPORT.keydn(0,30000))]
+    usbbox=_replay_usbbox()
+    replay=Replay(records,usbbox)
+    replay.start()
+    time.sleep(0.05)
+    start=time.time()
+    replay.stop()
+    stats=replay.join(1)
+    assert time.time()-start < 0.5
+    assert stats.reports == 1